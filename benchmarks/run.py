@@ -0,0 +1,206 @@
+"""Benchmarks for extraction trees, chunking and consensus, using mock models with simulated latency.
+
+Results are written as JSON so they can be compared across releases:
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --quick --latency 0.05 --jitter 0.02 --failure-rate 0.01
+"""
+import argparse
+import importlib.metadata
+import json
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List
+
+import doxstractor as dxc
+from doxstractor.chunking import clear_chunk_cache
+from doxstractor.utils import most_common, parseNumber
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank percentile, q in [0, 100]."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(name: str, params: Dict, timings: List[float], calls: int = 0) -> Dict:
+    total = sum(timings)
+    return {
+        "benchmark": name,
+        "params": params,
+        "runs": len(timings),
+        "docs_per_sec": len(timings) / total if total > 0 else None,
+        "calls_per_doc": calls / len(timings),
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+    }
+
+
+def time_runs(fn: Callable, runs: int) -> List[float]:
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def build_tree(model, depth: int, fanout: int, prefix: str = "n") -> dxc.Node:
+    """A tree following category "c0" at every level. Each level has one category node leading deeper
+    and fanout - 1 text leaves."""
+    categories = [f"c{i}" for i in range(fanout)]
+    extractor = dxc.CategoryExtractor(
+        name=prefix, query="Which category?", categories=categories, model=model
+    )
+    if depth <= 1:
+        return dxc.Node(extractor)
+
+    children = [build_tree(model, depth - 1, fanout, prefix + "_0")]
+    children += [
+        dxc.Node(dxc.TextExtractor(name=f"{prefix}_{i}", query="Content?", model=model))
+        for i in range(1, fanout)
+    ]
+    return dxc.Node(extractor, children={"c0": children})
+
+
+def bench_trees(args) -> List[Dict]:
+    results = []
+    for depth in args.depths:
+        for fanout in args.fanouts:
+            for model_class in [dxc.MockModel, dxc.MockModelWithScores]:
+                model = model_class(
+                    latency=args.latency,
+                    jitter=args.jitter,
+                    failure_rate=args.failure_rate,
+                    seed=0,
+                )
+                node = build_tree(model, depth, fanout)
+                failures = [0]
+
+                def extract():
+                    try:
+                        node.extract("c0")
+                    except RuntimeError:
+                        failures[0] += 1
+
+                timings = time_runs(extract, args.docs)
+                result = summarize(
+                    "tree_extract",
+                    {
+                        "model": model_class.__name__,
+                        "depth": depth,
+                        "fanout": fanout,
+                        "latency": args.latency,
+                        "jitter": args.jitter,
+                        "failure_rate": args.failure_rate,
+                    },
+                    timings,
+                    calls=model.call_count,
+                )
+                result["failed_docs"] = failures[0]
+                results.append(result)
+    return results
+
+
+def make_document(size: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    words = ["lease", "salary", "tenant", "employer", "the", "of", "2024", "EUR", "term"]
+    lines = []
+    length = 0
+    while length < size:
+        sentence = " ".join(rng.choice(words) for _ in range(12)) + "."
+        line = " ".join([sentence] * rng.randint(1, 6))
+        if rng.random() < 0.2:
+            line += "\n"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)[:size]
+
+
+def bench_chunking(args) -> List[Dict]:
+    results = []
+    for size in args.doc_sizes:
+        doc = make_document(size)
+        for boundary in ["line", "sentence"]:
+            chunker = dxc.Chunker(max_chunk_size=10_000, overlap=200, boundary=boundary)
+
+            def chunk():
+                clear_chunk_cache()
+                chunker.chunk(doc)
+
+            timings = time_runs(chunk, args.chunk_runs)
+            result = summarize(
+                "chunker", {"doc_bytes": size, "boundary": boundary}, timings
+            )
+            result["mb_per_sec"] = size / 1e6 / percentile(timings, 50)
+            results.append(result)
+    return results
+
+
+def bench_consensus(args) -> List[Dict]:
+    results = []
+    rng = random.Random(0)
+    for n in args.vote_sizes:
+        votes = [rng.choice(["lease", "employment", "NA"]) for _ in range(n)]
+        timings = time_runs(lambda: most_common(votes), args.consensus_runs)
+        results.append(summarize("most_common", {"votes": n}, timings))
+
+        numbers = [f"{rng.randint(0, 10**6):,}.{rng.randint(0, 99):02d} EUR" for _ in range(n)]
+        timings = time_runs(
+            lambda: [parseNumber(text) for text in numbers], args.consensus_runs
+        )
+        results.append(summarize("parseNumber", {"texts": n}, timings))
+    return results
+
+
+def package_version():
+    try:
+        return importlib.metadata.version("doxstractor")
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--output", help="Write results to this file instead of stdout.")
+    parser.add_argument("--quick", action="store_true", help="Small sizes for smoke runs.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds per model call.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Max random extra seconds per call.")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability a call fails.")
+    parser.add_argument("--docs", type=int, default=200, help="Documents per tree benchmark.")
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        args.docs = min(args.docs, 10)
+        args.depths, args.fanouts = [1, 2], [2]
+        args.doc_sizes, args.chunk_runs = [1_000, 100_000], 3
+        args.vote_sizes, args.consensus_runs = [10, 1_000], 3
+    else:
+        args.depths, args.fanouts = [1, 2, 3, 4], [2, 4, 8]
+        args.doc_sizes, args.chunk_runs = [1_000, 100_000, 1_000_000, 10_000_000, 50_000_000], 5
+        args.vote_sizes, args.consensus_runs = [10, 1_000, 100_000], 20
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = {
+        "doxstractor_version": package_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": bench_trees(args) + bench_chunking(args) + bench_consensus(args),
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,14 +4,46 @@ from .extractors import (
     CategoryExtractor,
     TextExtractor,
 )
-from .nodes import Node
+from .chunking import Chunk, Chunker, TokenChunker
+from .retrieval import BM25Retriever
+from .near_duplicates import MinHashIndex, TemplateChunker
+from .nodes import Node, DocumentResult
+from .plan import ExecutionPlan
+from .corpus import CorpusRunner, iter_directory, iter_jsonl
+from . import tracing
+from .tracing import ProfileAggregator, Tracer
 
 from .models import (
     BaseModel,
-    AnthropicAPIModel,
+    AnthropicBatchModel,
+    PendingResults,
     MockModel,
     MockModelWithScores,
-    TransformersQAModel,
-    TransformerClassifierModel,
-    HFEndPointQAModel,
+    CachedModel,
+    CascadeModel,
+    MemoryCache,
+    SQLiteCache,
+    RateLimiter,
+    set_default_rate_limiter,
 )
+from . import models as _models
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .models import (
+        AnthropicAPIModel,
+        TransformersQAModel,
+        TransformerClassifierModel,
+        HFEndPointQAModel,
+    )
+
+
+def __getattr__(name: str):
+    # Model backends are imported lazily, see `doxstractor.models`.
+    if name in _models._LAZY_MODELS:
+        return getattr(_models, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_models._LAZY_MODELS))
@@ -0,0 +1,223 @@
+from typing import Iterator, List, NamedTuple, Tuple
+import collections
+import re
+import threading
+
+
+class Chunk(NamedTuple):
+    """A chunk of a document. `text` is always `doc_text[start:end]`."""
+
+    text: str
+    start: int
+    end: int
+
+
+# Separators between segments for every boundary type. Segments which are too long for a chunk
+# are split again at the next finer boundary, and finally into pieces of max_chunk_size characters.
+_SEPARATORS = {
+    "paragraph": re.compile(r"\n[ \t\r\f\v]*\n\s*"),
+    "line": re.compile(r"\n"),
+    "sentence": re.compile(r"(?<=[.!?])\s+|\n"),
+}
+_FINER_BOUNDARY = {"paragraph": "line", "line": "sentence", "sentence": None}
+
+_CACHE_SIZE = 32
+_chunk_cache = collections.OrderedDict()
+_chunk_cache_lock = threading.Lock()
+
+
+def clear_chunk_cache():
+    """Drops all memoized chunkings."""
+    with _chunk_cache_lock:
+        _chunk_cache.clear()
+
+
+class Chunker:
+    def __init__(
+        self,
+        max_chunk_size: float = 10_000,
+        overlap: int = 0,
+        boundary: str = "line",
+    ) -> None:
+        """Splits documents into chunks of at most max_chunk_size characters in a single pass.
+
+        Chunks only end at the chosen boundary, unless a single paragraph, line or sentence is longer
+        than max_chunk_size. Results are memoized per document and chunking configuration, so all
+        extractors of a tree which chunk the same way share one chunking.
+
+        Args:
+            max_chunk_size (float, optional): Maximum number of characters per chunk. Defaults to 10_000.
+            overlap (int, optional): Number of characters the start of a chunk may repeat from the end of
+                the previous chunk. The overlap consists of whole segments. Defaults to 0.
+            boundary (str, optional): "line", "sentence" or "paragraph". Defaults to "line".
+
+        Raises:
+            ValueError: If the boundary is unknown or the overlap is not smaller than max_chunk_size.
+        """
+        if boundary not in _SEPARATORS:
+            raise ValueError(
+                f"Unknown boundary {boundary}, valid boundaries are {list(_SEPARATORS)}"
+            )
+        if overlap >= max_chunk_size:
+            raise ValueError("overlap needs to be smaller than max_chunk_size")
+        self.max_chunk_size = int(max_chunk_size)
+        self.overlap = overlap
+        self.boundary = boundary
+
+    def config_key(self) -> Tuple:
+        """Identifies the chunking configuration. Chunkers with equal keys produce equal chunks."""
+        return (type(self).__name__, self.max_chunk_size, self.overlap, self.boundary)
+
+    def chunk(self, doc_text: str) -> List[Chunk]:
+        """Chunks a document, reusing earlier results for the same document and configuration.
+
+        Args:
+            doc_text (str): The full document to chunk.
+
+        Returns:
+            List[Chunk]: The chunks in document order. The list is shared, do not modify it.
+        """
+        key = (self.config_key(), doc_text)
+        with _chunk_cache_lock:
+            if key in _chunk_cache:
+                _chunk_cache.move_to_end(key)
+                return _chunk_cache[key]
+
+        chunks = self.split(doc_text)
+
+        with _chunk_cache_lock:
+            _chunk_cache[key] = chunks
+            while len(_chunk_cache) > _CACHE_SIZE:
+                _chunk_cache.popitem(last=False)
+        return chunks
+
+    def preview(self, doc_text: str) -> List[Chunk]:
+        """Chunks a document like `chunk`, without changing the state of chunkers which learn from the
+        documents they see, e.g. `TemplateChunker`. Used for cost estimates.
+
+        Args:
+            doc_text (str): The full document to chunk.
+
+        Returns:
+            List[Chunk]: The chunks in document order.
+        """
+        return self.chunk(doc_text)
+
+    def split(self, doc_text: str) -> List[Chunk]:
+        """Chunks a document without memoization.
+
+        Args:
+            doc_text (str): The full document to chunk.
+
+        Returns:
+            List[Chunk]: The chunks in document order.
+        """
+        chunks = []
+        current = []  # (start, end) of the segments in the current chunk
+        for segment in self._segments(doc_text, 0, len(doc_text), self.boundary):
+            if current and segment[1] - current[0][0] > self.max_chunk_size:
+                chunks.append(_make_chunk(doc_text, current))
+                current = self._overlap(current, segment[1])
+            current.append(segment)
+
+        if current:
+            chunks.append(_make_chunk(doc_text, current))
+        if len(chunks) == 0:
+            # Empty or whitespace only documents still get one chunk.
+            chunks.append(Chunk(doc_text, 0, len(doc_text)))
+        return chunks
+
+    def _segments(
+        self, doc_text: str, start: int, end: int, boundary: str
+    ) -> Iterator[Tuple[int, int]]:
+        """Yields the non empty spans between separators, each at most max_chunk_size long."""
+        pos = start
+        for match in _SEPARATORS[boundary].finditer(doc_text, start, end):
+            if match.start() > pos:
+                yield from self._fit(doc_text, pos, match.start(), boundary)
+            pos = match.end()
+        if end > pos:
+            yield from self._fit(doc_text, pos, end, boundary)
+
+    def _fit(
+        self, doc_text: str, start: int, end: int, boundary: str
+    ) -> Iterator[Tuple[int, int]]:
+        if end - start <= self.max_chunk_size:
+            yield (start, end)
+        elif _FINER_BOUNDARY[boundary]:
+            yield from self._segments(doc_text, start, end, _FINER_BOUNDARY[boundary])
+        else:
+            for pos in range(start, end, self.max_chunk_size):
+                yield (pos, min(pos + self.max_chunk_size, end))
+
+    def _overlap(
+        self, segments: List[Tuple[int, int]], next_end: int
+    ) -> List[Tuple[int, int]]:
+        """Trailing segments of the finished chunk which are repeated at the start of the next one."""
+        if self.overlap <= 0:
+            return []
+        chunk_end = segments[-1][1]
+        kept = []
+        for segment in reversed(segments):
+            if (chunk_end - segment[0] > self.overlap) or (
+                next_end - segment[0] > self.max_chunk_size
+            ):
+                break
+            kept.append(segment)
+        kept.reverse()
+        return kept
+
+
+class TokenChunker(Chunker):
+    def __init__(self, tokenizer, max_tokens: int, stride: int = 0) -> None:
+        """Splits documents into windows of at most max_tokens tokens of a model's own tokenizer, so
+        every chunk fills one forward pass of the model.
+
+        Args:
+            tokenizer: A huggingface fast tokenizer (needs `return_offsets_mapping`).
+            max_tokens (int): Maximum number of tokens per chunk.
+            stride (int, optional): Number of tokens shared by consecutive chunks. Defaults to 0.
+
+        Raises:
+            ValueError: If stride is not smaller than max_tokens.
+        """
+        if stride >= max_tokens:
+            raise ValueError("stride needs to be smaller than max_tokens")
+        # Windows are measured in tokens, so there is no character limit or text boundary.
+        self.max_chunk_size = None
+        self.overlap = 0
+        self.boundary = None
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.stride = stride
+
+    def config_key(self) -> Tuple:
+        return (
+            type(self).__name__,
+            getattr(self.tokenizer, "name_or_path", id(self.tokenizer)),
+            self.max_tokens,
+            self.stride,
+        )
+
+    def split(self, doc_text: str) -> List[Chunk]:
+        offsets = self.tokenizer(
+            doc_text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        if len(offsets) == 0:
+            return [Chunk(doc_text, 0, len(doc_text))]
+
+        chunks = []
+        step = self.max_tokens - self.stride
+        for first in range(0, len(offsets), step):
+            last = min(first + self.max_tokens, len(offsets)) - 1
+            start, end = offsets[first][0], offsets[last][1]
+            chunks.append(Chunk(doc_text[start:end], start, end))
+            if last == len(offsets) - 1:
+                break
+        return chunks
+
+
+def _make_chunk(doc_text: str, segments: List[Tuple[int, int]]) -> Chunk:
+    start = segments[0][0]
+    end = segments[-1][1]
+    return Chunk(doc_text[start:end], start, end)
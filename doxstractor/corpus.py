@@ -0,0 +1,165 @@
+from .nodes import Node
+from .utils import to_builtin
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple
+import hashlib
+import json
+import os
+import sqlite3
+
+
+def read_text(path: Path) -> str:
+    return path.read_text(encoding="utf-8", errors="replace")
+
+
+def iter_directory(
+    path: str,
+    pattern: str = "*",
+    reader: Callable[[Path], str] = read_text,
+) -> Iterator[Tuple[str, str]]:
+    """Reads the documents of a directory lazily, one file at a time, in sorted path order.
+
+    Args:
+        path (str): The directory.
+        pattern (str, optional): Glob pattern of the files, searched recursively. Defaults to "*".
+        reader (Callable[[Path], str], optional): Turns a file into document text, e.g. to strip HTML.
+            Defaults to reading the file as UTF-8 text.
+
+    Yields:
+        Tuple[str, str]: (document id, document text). The id is the path relative to the directory.
+    """
+    root = Path(path)
+    for file_path in sorted(p for p in root.rglob(pattern) if p.is_file()):
+        yield file_path.relative_to(root).as_posix(), reader(file_path)
+
+
+def iter_jsonl(
+    path: str, text_field: str = "text", id_field: Optional[str] = "id"
+) -> Iterator[Tuple[str, str]]:
+    """Reads documents lazily from a JSONL file with one JSON object per line.
+
+    Args:
+        path (str): The JSONL file.
+        text_field (str, optional): Field holding the document text. Defaults to "text".
+        id_field (Optional[str], optional): Field holding the document id. Documents without it are
+            identified by their line number. Defaults to "id".
+
+    Yields:
+        Tuple[str, str]: (document id, document text).
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            doc_id = record.get(id_field) if id_field else None
+            yield str(doc_id if doc_id is not None else line_number), record[text_field]
+
+
+def document_hash(doc_id: str, doc_text: str) -> str:
+    return hashlib.sha256(f"{doc_id}\0{doc_text}".encode("utf-8")).hexdigest()
+
+
+class CorpusRunner:
+    def __init__(
+        self,
+        node: Node,
+        output_path: str,
+        checkpoint_path: Optional[str] = None,
+        max_workers: int = 4,
+        backend: str = "thread",
+        max_pending: Optional[int] = None,
+    ) -> None:
+        """Runs a tree over a corpus, streaming one JSONL row per document and checkpointing finished
+        documents so a restarted run skips them.
+
+        Documents are read lazily and at most `max_pending` are held at once, so memory does not depend on
+        the size of the corpus. A document is checkpointed after its row was written, a crash in between
+        writes that row again on restart. Failed documents get an error row and are not checkpointed, so
+        they are retried by the next run.
+
+        Args:
+            node (Node): The tree to run.
+            output_path (str): JSONL file rows are appended to. Rows look like {"id": ..., "result": {...}}
+                or {"id": ..., "error": "..."}.
+            checkpoint_path (Optional[str], optional): SQLite file with the hashes of finished documents.
+                Defaults to output_path + ".checkpoint".
+            max_workers (int, optional): See `Node.extract_many`. Defaults to 4.
+            backend (str, optional): See `Node.extract_many`. Defaults to "thread".
+            max_pending (Optional[int], optional): See `Node.extract_many`. Defaults to 2 * max_workers.
+        """
+        self.node = node
+        self.output_path = os.fspath(output_path)
+        self.checkpoint_path = os.fspath(
+            checkpoint_path or self.output_path + ".checkpoint"
+        )
+        self.max_workers = max_workers
+        self.backend = backend
+        self.max_pending = max_pending
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.checkpoint_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS finished (doc_hash TEXT PRIMARY KEY, doc_id TEXT)"
+        )
+        return conn
+
+    def run(self, documents: Iterable[Tuple[str, str]]) -> Dict:
+        """Extracts all documents which are not checkpointed yet.
+
+        Args:
+            documents (Iterable[Tuple[str, str]]): (document id, document text) pairs, e.g. from
+                `iter_directory` or `iter_jsonl`.
+
+        Returns:
+            Dict: Counts of "processed", "failed" and "skipped" documents in this run.
+        """
+        counts = {"processed": 0, "failed": 0, "skipped": 0}
+        conn = self._connect()
+        in_flight = {}  # position in the submitted documents -> (doc_id, doc_hash)
+        submitted = 0
+
+        def unfinished():
+            nonlocal submitted
+            for doc_id, doc_text in documents:
+                doc_hash = document_hash(doc_id, doc_text)
+                finished = conn.execute(
+                    "SELECT 1 FROM finished WHERE doc_hash = ?", (doc_hash,)
+                ).fetchone()
+                if finished:
+                    counts["skipped"] += 1
+                    continue
+                in_flight[submitted] = (doc_id, doc_hash)
+                submitted += 1
+                yield doc_text
+
+        try:
+            with open(self.output_path, "a", encoding="utf-8") as output:
+                for document_result in self.node.extract_many(
+                    unfinished(),
+                    max_workers=self.max_workers,
+                    backend=self.backend,
+                    ordered=False,
+                    max_pending=self.max_pending,
+                ):
+                    doc_id, doc_hash = in_flight.pop(document_result.index)
+                    if document_result.error is None:
+                        row = {"id": doc_id, "result": document_result.result}
+                    else:
+                        row = {"id": doc_id, "error": repr(document_result.error)}
+                    output.write(json.dumps(row, default=to_builtin) + "\n")
+                    output.flush()
+
+                    if document_result.error is None:
+                        with conn:
+                            conn.execute(
+                                "INSERT OR IGNORE INTO finished VALUES (?, ?)",
+                                (doc_hash, doc_id),
+                            )
+                        counts["processed"] += 1
+                    else:
+                        counts["failed"] += 1
+        finally:
+            conn.close()
+        return counts
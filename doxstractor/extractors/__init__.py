@@ -2,3 +2,5 @@ from .base import BaseExtractor
 from .category import CategoryExtractor
 from .numeric import NumericExtractor
 from .text import TextExtractor
+from .fused import FusedExtractor
+from .batched import BatchedExtractor
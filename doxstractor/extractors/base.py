@@ -1,5 +1,13 @@
+from ..chunking import Chunk, Chunker
 from ..models import BaseModel
-from typing import List
+from ..models.base import calling_extractor
+from ..retrieval import BM25Retriever
+from ..utils import most_common
+from .. import tracing
+from typing import Dict, List, Optional
+import collections
+
+import numpy as np
 
 
 class BaseExtractor:
@@ -8,24 +16,60 @@ class BaseExtractor:
         name: str,  # Has to be unique within graph as it identifies extractor
         query: str,
         model: BaseModel,
-        max_chunk_size: float = 10_000,
+        max_chunk_size: Optional[float] = None,
+        chunker: Optional[Chunker] = None,
+        retriever: Optional[BM25Retriever] = None,
+        early_stopping: bool = False,
+        wave_size: int = 4,
+        score_threshold: Optional[float] = None,
     ) -> None:
         """Create a new extractor
 
         Args:
             name (str): A unique name. This identifies the extractor within a graph and provides the attribute name.
             model (BaseModel): The natural language model which is used to extract text.
-            max_chunk_size (float, optional): Maximum size to chunk data into.. Defaults to 10_000.
+            max_chunk_size (Optional[float], optional): Maximum size to chunk data into, in characters. If not
+                given, the model's `default_chunker` is used, otherwise chunks of 10_000 characters.
+            chunker (Optional[Chunker], optional): Splits documents into chunks. Overrides max_chunk_size.
+                Defaults to a line based `Chunker` with max_chunk_size.
+            retriever (Optional[BM25Retriever], optional): If set, only the chunks most relevant to the query
+                are sent to the model. Defaults to None (all chunks).
+            early_stopping (bool, optional): Send chunks to the model in waves of wave_size and stop once the
+                answer is decided. Defaults to False.
+            wave_size (int, optional): Number of chunks per wave when early_stopping is set. Defaults to 4.
+            score_threshold (Optional[float], optional): For models with scores, early stopping needs a valid
+                answer with at least this score. Defaults to None (models with scores never stop early).
         """
-        # TODO: This maybe should be a model attribute.
-        self.max_chunk_size = max_chunk_size
+        if chunker is None and max_chunk_size is None:
+            chunker = model.default_chunker()
+        self.chunker = chunker or Chunker(max_chunk_size=max_chunk_size or 10_000)
+        # Characters per chunk of the chunker in use, None for token based chunkers.
+        self.max_chunk_size = getattr(self.chunker, "max_chunk_size", None)
+        self.retriever = retriever
+        self.early_stopping = early_stopping
+        self.wave_size = wave_size
+        self.score_threshold = score_threshold
         self.model = model
         self.query = query
         self.name = name
 
+    def _chunks(self, doc_text: str) -> List[Chunk]:
+        """Chunks the document with the extractor's chunker. Extractors with the same chunking
+        configuration share the result.
+
+        Args:
+            doc_text (str): The full document to chunk.
+
+        Returns:
+            List[Chunk]: Chunks including their character offsets.
+        """
+        with tracing.span(tracing.CHUNKING, self.name, doc_chars=len(doc_text)) as span:
+            chunks = self.chunker.chunk(doc_text)
+            span.set(chunks=len(chunks))
+        return chunks
+
     def _chunk_text(self, doc_text: str) -> List[str]:
-        """Splits a document by newlines. Then generates chunks which are shorter than
-        max_chunk_size.
+        """Splits a document into chunks which are shorter than max_chunk_size.
 
         Args:
             doc_text (str): The full document to chunk.
@@ -33,17 +77,207 @@ class BaseExtractor:
         Returns:
             List[str]: A list of chunks
         """
-        chunks = doc_text.split("\n")
+        return [chunk.text for chunk in self._chunks(doc_text)]
+
+    def _select_chunks(self, doc_text: str, chunks: Optional[List[Chunk]] = None) -> List[str]:
+        """The chunks which are sent to the model. All chunks, unless a retriever is set.
+
+        Args:
+            doc_text (str): The full document.
+            chunks (Optional[List[Chunk]], optional): The document chunked by the extractor's chunker, if
+                already known. Defaults to None.
+
+        Returns:
+            List[str]: Chunk texts in document order.
+        """
+        if chunks is None:
+            chunks = self._chunks(doc_text)
+        if self.retriever is None:
+            return [chunk.text for chunk in chunks]
+        indices = self.retriever.select(
+            self._retrieval_query(), doc_text, self.chunker, chunks
+        )
+        return [chunks[i].text for i in indices]
+
+    def _retrieval_query(self) -> str:
+        """Text used to score chunks for relevance."""
+        return self.query
+
+    def _model_query(self):
+        """The query passed to the model. Classifier models take a list of categories instead."""
+        return self.query
+
+    def _task_description(self) -> Optional[str]:
+        raise NotImplementedError
+
+    def _system_prompt(self) -> Optional[str]:
+        raise NotImplementedError
+
+    def _uses_scores(self) -> bool:
+        return self.model.model_description()["scores"]
+
+    def _model_kwargs(self, chunks: List[str]) -> Dict:
+        return dict(
+            query=self._model_query(),
+            context=chunks,
+            task_description=self._task_description(),
+            system_prompt=self._system_prompt(),
+        )
+
+    def _run_model(self, chunks: List[str]) -> List:
+        """Asks the model for an answer on every chunk.
+
+        Returns:
+            List: Answers as strings, or as {'score', 'answer'} dictionaries for models with scores.
+        """
+        kwargs = self._model_kwargs(chunks)
+        with calling_extractor(self.name), tracing.span(
+            tracing.MODEL, self.model.model, **tracing.request_sizes([kwargs])
+        ) as span:
+            if self._uses_scores():
+                results = self.model.batch_complete_with_scores(**kwargs)
+            else:
+                results = self.model.batch_complete(**kwargs)
+            if tracing.enabled():
+                span.set(response_chars=tracing.response_chars(results))
+        return results
 
-        merged_chunks = [""]
-        for chunk in chunks:
-            prev_chunk = merged_chunks[-1]
-            if (len(prev_chunk) + len(chunk)) < (self.max_chunk_size - 1):
-                merged_chunks[-1] = prev_chunk + "\n" + chunk
+    async def _arun_model(self, chunks: List[str]) -> List:
+        """Async version of `_run_model`."""
+        kwargs = self._model_kwargs(chunks)
+        with calling_extractor(self.name), tracing.span(
+            tracing.MODEL, self.model.model, **tracing.request_sizes([kwargs])
+        ) as span:
+            if self._uses_scores():
+                results = await self.model.abatch_complete_with_scores(**kwargs)
             else:
-                merged_chunks.append(chunk)
+                results = await self.model.abatch_complete(**kwargs)
+            if tracing.enabled():
+                span.set(response_chars=tracing.response_chars(results))
+        return results
+
+    def _vote(self, answer: str) -> Optional[str]:
+        """Normalizes one answer for voting. Returns None for answers which are not valid."""
+        raise NotImplementedError
+
+    def _consensus(self, results: List[str]):
+        """Combines the answers for all chunks into one answer by majority vote."""
+        votes = [v for v in map(self._vote, results) if v is not None]
+
+        if len(votes) > 0:
+            consensus = most_common(votes)
+        else:
+            consensus = "NA"
+        return consensus
+
+    def _consensus_with_scores(self, results_with_scores: List[Dict]):
+        """Picks the valid answer with the highest score."""
+        candidates = []
+        for r in results_with_scores:
+            vote = self._vote(r["answer"])
+            if vote is not None:
+                candidates.append((r["score"], vote))
+
+        if len(candidates) == 0:
+            return "NA"
+        idx = np.argmax([score for score, _ in candidates])
+        return candidates[idx][1]
+
+    def _resolve(self, results: List):
+        if self._uses_scores():
+            return self._consensus_with_scores(results)
+        return self._consensus(results)
+
+    def _is_decided(self, results: List, remaining: int) -> bool:
+        """Whether the chunks still remaining can no longer change the answer.
+
+        Args:
+            results (List): Model answers for the chunks processed so far.
+            remaining (int): Number of chunks not processed yet.
+        """
+        if self._uses_scores():
+            if self.score_threshold is None:
+                return False
+            return any(
+                (r["score"] >= self.score_threshold)
+                and (self._vote(r["answer"]) is not None)
+                for r in results
+            )
 
-        return merged_chunks
+        counts = collections.Counter(
+            v for v in map(self._vote, results) if v is not None
+        ).most_common(2)
+        leader = counts[0][1] if len(counts) > 0 else 0
+        runner_up = counts[1][1] if len(counts) > 1 else 0
+        return leader > runner_up + remaining
+
+    def _waves(self, merged_chunks: List[str]) -> List[List[str]]:
+        if not self.early_stopping:
+            return [merged_chunks]
+        return [
+            merged_chunks[start : start + self.wave_size]
+            for start in range(0, len(merged_chunks), self.wave_size)
+        ]
+
+    def _collect(self, doc_text: str, chunks: Optional[List[Chunk]] = None) -> List:
+        """Model answers for the selected chunks of a document, in waves if early_stopping is set. Pass
+        chunks to reuse a chunking of the document."""
+        merged_chunks = self._select_chunks(doc_text, chunks)
+        results = []
+        for wave in self._waves(merged_chunks):
+            results.extend(self._run_model(wave))
+            if self._is_decided(results, remaining=len(merged_chunks) - len(results)):
+                break
+        return results
+
+    async def _acollect(self, doc_text: str, chunks: Optional[List[Chunk]] = None) -> List:
+        """Async version of `_collect`."""
+        merged_chunks = self._select_chunks(doc_text, chunks)
+        results = []
+        for wave in self._waves(merged_chunks):
+            results.extend(await self._arun_model(wave))
+            if self._is_decided(results, remaining=len(merged_chunks) - len(results)):
+                break
+        return results
+
+    def task_key(self):
+        """Identifies the model work of the extractor. Extractors with equal keys send the same requests
+        for every document, so an execution plan runs them once and shares the answers."""
+        retriever = self.retriever
+        if retriever is not None:
+            retriever = (
+                self._retrieval_query(),
+                retriever.top_k,
+                retriever.min_score,
+                retriever.k1,
+                retriever.b,
+            )
+        return (
+            id(self.model),
+            self._uses_scores(),
+            repr(self._model_query()),
+            self._task_description(),
+            self._system_prompt(),
+            self.chunker.config_key(),
+            retriever,
+            # Early stopping depends on the extractor's own voting, so it is never shared.
+            id(self) if self.early_stopping else None,
+        )
 
     def extract(self, doc_text: str):
-        raise NotImplementedError
+        """Extracts the attribute from a document.
+
+        Args:
+            doc_text (str): The document text from which to extract.
+        """
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            return self._resolve(self._collect(doc_text))
+
+    async def aextract(self, doc_text: str):
+        """Async version of `extract`.
+
+        Args:
+            doc_text (str): The document text from which to extract.
+        """
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            return self._resolve(await self._acollect(doc_text))
@@ -0,0 +1,76 @@
+from .base import BaseExtractor
+from ..models.base import calling_extractor
+from .. import tracing
+from typing import Dict, List, Optional, Tuple
+
+
+class BatchedExtractor:
+    def __init__(self, extractors: List[BaseExtractor]) -> None:
+        """Runs several extractors which share a model with one `batch_complete_many` call, so the model
+        can batch the (query, chunk) pairs of all extractors together. Every extractor keeps its own
+        chunking, prompts and consensus logic.
+
+        Args:
+            extractors (List[BaseExtractor]): Extractors to batch. They all need the same `batching_key`.
+
+        Raises:
+            ValueError: If the extractors can't be batched together.
+        """
+        keys = set(batching_key(extractor) for extractor in extractors)
+        if None in keys or len(keys) != 1:
+            raise ValueError(
+                "Only extractors sharing a model which supports cross batching can be batched"
+            )
+        self.extractors = extractors
+        self.model = extractors[0].model
+        self.name = "+".join(e.name for e in extractors)
+
+    def _requests(self, doc_text: str) -> List[Dict]:
+        return [e._model_kwargs(e._select_chunks(doc_text)) for e in self.extractors]
+
+    def _resolve(self, all_results: List[List]) -> Dict:
+        return {
+            e.name: e._resolve(results)
+            for e, results in zip(self.extractors, all_results)
+        }
+
+    def extract(self, doc_text: str) -> Dict:
+        """Runs all extractors on a document.
+
+        Args:
+            doc_text (str): The document text from which to extract.
+
+        Returns:
+            Dict: {extractor_name: result}
+        """
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            requests = self._requests(doc_text)
+            with calling_extractor(self.name), tracing.span(
+                tracing.MODEL, self.model.model, **tracing.request_sizes(requests)
+            ) as span:
+                all_results = self.model.batch_complete_many(requests)
+                if tracing.enabled():
+                    span.set(response_chars=sum(map(tracing.response_chars, all_results)))
+            return self._resolve(all_results)
+
+    async def aextract(self, doc_text: str) -> Dict:
+        """Async version of `extract`."""
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            requests = self._requests(doc_text)
+            with calling_extractor(self.name), tracing.span(
+                tracing.MODEL, self.model.model, **tracing.request_sizes(requests)
+            ) as span:
+                all_results = await self.model.abatch_complete_many(requests)
+                if tracing.enabled():
+                    span.set(response_chars=sum(map(tracing.response_chars, all_results)))
+            return self._resolve(all_results)
+
+
+def batching_key(extractor: BaseExtractor) -> Optional[Tuple]:
+    """Extractors with equal keys can be batched, None if the extractor can't be batched at all.
+    Extractors with early stopping send their chunks in waves and are never batched."""
+    if extractor.early_stopping:
+        return None
+    if not extractor.model.model_description().get("cross_batching", False):
+        return None
+    return (id(extractor.model),)
@@ -1,9 +1,8 @@
-from ..utils import most_common
+from ..chunking import Chunker
 from ..models import BaseModel
+from ..retrieval import BM25Retriever
 from .base import BaseExtractor
-from typing import List
-
-import numpy as np
+from typing import List, Optional
 
 
 TASK_DESCRIPTION = (
@@ -19,7 +18,12 @@ class CategoryExtractor(BaseExtractor):
         query: str,
         categories: List[str],
         model: BaseModel,
-        max_chunk_size: float = 10_000,
+        max_chunk_size: Optional[float] = None,
+        chunker: Optional[Chunker] = None,
+        retriever: Optional[BM25Retriever] = None,
+        early_stopping: bool = False,
+        wave_size: int = 4,
+        score_threshold: Optional[float] = None,
     ) -> None:
         """Create a new extractor
 
@@ -27,65 +31,61 @@ class CategoryExtractor(BaseExtractor):
             name (str): A unique name. This identifies the extractor within a graph and provides the attribute name.
             categories (list): Allowed categories.
             model (BaseModel): The natural language model which is used to extract text.
-            max_chunk_size (float, optional): Maximum size to chunk data into.. Defaults to 10_000.
+            max_chunk_size (Optional[float], optional): Maximum size to chunk data into, in characters. If not
+                given, the model's `default_chunker` is used, otherwise chunks of 10_000 characters.
+            chunker (Optional[Chunker], optional): Splits documents into chunks. Overrides max_chunk_size.
+                Defaults to a line based `Chunker` with max_chunk_size.
+            retriever (Optional[BM25Retriever], optional): If set, only the chunks most relevant to the query
+                and categories are sent to the model. Defaults to None (all chunks).
+            early_stopping (bool, optional): Send chunks to the model in waves of wave_size and stop once the
+                category is decided. Defaults to False.
+            wave_size (int, optional): Number of chunks per wave when early_stopping is set. Defaults to 4.
+            score_threshold (Optional[float], optional): For models with scores, early stopping needs a valid
+                category with at least this score. Defaults to None (models with scores never stop early).
         """
         super().__init__(
             name=name,
             query=query,
             max_chunk_size=max_chunk_size,
             model=model,
+            chunker=chunker,
+            retriever=retriever,
+            early_stopping=early_stopping,
+            wave_size=wave_size,
+            score_threshold=score_threshold,
         )
         self.categories = categories
 
-    def extract(self, doc_text: str) -> str:
-        """Extracts a category from a document, similar to zero shot classification.
-
-        Args:
-            doc_text (str): The document from which to extract
+    def _model_query(self):
+        # Classifier models don't have actual queries, you just provide the possible categories.
+        if self.model.model_description()["type"] == "classifier":
+            return self.categories
+        return self.query
 
-        Returns:
-            str: The extracted category. Guaranteed to be one of the categories provided on init or 'NA'
-        """
+    def _retrieval_query(self) -> str:
+        return self.query + " " + " ".join(self.categories)
 
-        merged_chunks = self._chunk_text(doc_text)
+    def _task_description(self) -> str:
         categories_str = "The possible categories are " + ", ".join(
             [f'"{w}"' for w in self.categories]
         )
+        return TASK_DESCRIPTION.format(categories_str=categories_str)
 
-        # Classifier models don't have actual queries, you just provide the possible categories.
-        if self.model.model_description()["type"] == "classifier":
-            query = self.categories
-        else:
-            query = self.query
+    def _system_prompt(self) -> str:
+        return SYSTEM_PROMPT
+
+    def _vote(self, answer: str) -> Optional[str]:
+        if (answer == "NA") or (answer not in self.categories):
+            return None
+        return answer
 
-        if self.model.model_description()["scores"]:
-            results_with_scores = self.model.batch_complete_with_scores(
-                query=query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION.format(categories_str=categories_str),
-                system_prompt=SYSTEM_PROMPT,
-            )
-            filtered = [
-                r for r in results_with_scores if (r["answer"] in self.categories)
-            ]
-            all_scores = [r["score"] for r in filtered]
-            idx = np.argmax(all_scores)
-            consensus = results_with_scores[idx]["answer"]
-            return consensus
-        else:
-            results = self.model.batch_complete(
-                query=query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION.format(categories_str=categories_str),
-                system_prompt=SYSTEM_PROMPT,
-            )
-            valid_answers = [
-                m for m in results if (m != "NA") and (m in self.categories)
-            ]
+    def extract(self, doc_text: str) -> str:
+        """Extracts a category from a document, similar to zero shot classification.
 
-            if len(valid_answers) > 0:
-                consensus = most_common(valid_answers)
-            else:
-                consensus = "NA"
+        Args:
+            doc_text (str): The document from which to extract
 
-            return consensus
+        Returns:
+            str: The extracted category. Guaranteed to be one of the categories provided on init or 'NA'
+        """
+        return super().extract(doc_text)
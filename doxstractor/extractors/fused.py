@@ -0,0 +1,124 @@
+from .base import BaseExtractor
+from ..models.base import calling_extractor
+from .. import tracing
+from typing import Dict, List, Optional, Tuple
+import json
+
+TASK_DESCRIPTION = "Use the information given below."
+SYSTEM_PROMPT = 'Your job is to answer several questions about the same text. Respond only with a JSON object which has the id of every question as key and your answer as a string value. Follow the instructions given for each question. If there is no relevant information in the text provided for a question, use "NA" as its answer. Do not make things up.'
+
+
+class FusedExtractor:
+    def __init__(self, extractors: List[BaseExtractor]) -> None:
+        """Runs several extractors which share a model with one model call per chunk.
+
+        All queries are combined into one prompt asking for a JSON object, the answers are split
+        back up and every extractor applies its own consensus logic.
+
+        Args:
+            extractors (List[BaseExtractor]): Extractors to fuse. They all need the same `fusion_key`.
+
+        Raises:
+            ValueError: If the extractors can't be fused.
+        """
+        keys = set(fusion_key(extractor) for extractor in extractors)
+        if None in keys or len(keys) != 1:
+            raise ValueError(
+                "Only extractors with the same text model and chunking can be fused"
+            )
+        self.extractors = extractors
+        self.model = extractors[0].model
+        self.name = "+".join(e.name for e in extractors)
+
+    def _query(self) -> str:
+        ids = ", ".join([f'"{e.name}"' for e in self.extractors])
+        questions = []
+        for extractor in self.extractors:
+            instructions = extractor._system_prompt()
+            categories = getattr(extractor, "categories", None)
+            if categories:
+                instructions += " Valid categories are: " + ", ".join(
+                    [f'"{c}"' for c in categories]
+                )
+            questions.append(
+                f'Question "{extractor.name}": {extractor.query}\nInstructions: {instructions}'
+            )
+        return (
+            f"Answer the questions below. Respond with a JSON object with the keys {ids}.\n"
+            + "\n\n".join(questions)
+        )
+
+    def _split_answer(self, answer: str) -> Dict[str, str]:
+        """Parses the JSON answer for one chunk. Missing, null or unparsable answers become "NA"."""
+        try:
+            parsed = json.loads(answer[answer.index("{") : answer.rindex("}") + 1])
+        except ValueError:
+            parsed = {}
+        if not isinstance(parsed, dict):
+            parsed = {}
+        answers = {}
+        for e in self.extractors:
+            value = parsed.get(e.name)
+            answers[e.name] = "NA" if value is None else str(value).strip()
+        return answers
+
+    def _model_kwargs(self, chunks: List[str]) -> Dict:
+        return dict(
+            query=self._query(),
+            context=chunks,
+            task_description=TASK_DESCRIPTION,
+            system_prompt=SYSTEM_PROMPT,
+        )
+
+    def _resolve(self, answers: List[str]) -> Dict:
+        split_answers = [self._split_answer(answer) for answer in answers]
+        return {
+            e.name: e._consensus([answer[e.name] for answer in split_answers])
+            for e in self.extractors
+        }
+
+    def extract(self, doc_text: str) -> Dict:
+        """Runs all extractors on a document.
+
+        Args:
+            doc_text (str): The document text from which to extract.
+
+        Returns:
+            Dict: {extractor_name: result}
+        """
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            chunks = self.extractors[0]._chunk_text(doc_text)
+            kwargs = self._model_kwargs(chunks)
+            with calling_extractor(self.name), tracing.span(
+                tracing.MODEL, self.model.model, **tracing.request_sizes([kwargs])
+            ) as span:
+                answers = self.model.batch_complete(**kwargs)
+                if tracing.enabled():
+                    span.set(response_chars=tracing.response_chars(answers))
+            return self._resolve(answers)
+
+    async def aextract(self, doc_text: str) -> Dict:
+        """Async version of `extract`."""
+        with tracing.span(tracing.EXTRACTOR, self.name):
+            chunks = self.extractors[0]._chunk_text(doc_text)
+            kwargs = self._model_kwargs(chunks)
+            with calling_extractor(self.name), tracing.span(
+                tracing.MODEL, self.model.model, **tracing.request_sizes([kwargs])
+            ) as span:
+                answers = await self.model.abatch_complete(**kwargs)
+                if tracing.enabled():
+                    span.set(response_chars=tracing.response_chars(answers))
+            return self._resolve(answers)
+
+
+def fusion_key(extractor: BaseExtractor) -> Optional[Tuple]:
+    """Extractors with equal keys can be fused, None if the extractor can't be fused at all.
+    Only text models without scores can answer fused JSON prompts. Extractors with a retriever
+    select their own chunks, and extractors with early stopping send their chunks in waves, so
+    neither is ever fused."""
+    if extractor.retriever is not None or extractor.early_stopping:
+        return None
+    description = extractor.model.model_description()
+    if description["type"] != "text" or description["scores"]:
+        return None
+    return (id(extractor.model), extractor.chunker.config_key())
@@ -1,9 +1,7 @@
-from ..utils import most_common
-
 from .base import BaseExtractor
 
 import re
-import numpy as np
+from typing import Optional
 
 TASK_DESCRIPTION = "Use the information given below."
 SYSTEM_PROMPT = 'Your job is to extract a numerical value from a document. Respond with a single number. Do not explain your answer. Do not provide context. If there is no relevant information in the text provided, respond with "NA". Do not make things up.'
@@ -17,6 +15,20 @@ class NumericExtractor(BaseExtractor):
         )
         return num
 
+    def _task_description(self) -> str:
+        return TASK_DESCRIPTION
+
+    def _system_prompt(self) -> str:
+        return SYSTEM_PROMPT
+
+    def _vote(self, answer: str) -> Optional[str]:
+        if answer == "NA":
+            return None
+        num = self._numerize(answer)
+        if num == "":
+            return None
+        return num
+
     def extract(self, doc_text: str) -> float:
         """Extracts a number from a document.
 
@@ -26,42 +38,4 @@ class NumericExtractor(BaseExtractor):
         Returns:
             float: The extracted number.
         """
-
-        merged_chunks = self._chunk_text(doc_text)
-
-        if self.model.model_description()["scores"]:
-            results_with_scores = self.model.batch_complete_with_scores(
-                query=self.query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION,
-                system_prompt=SYSTEM_PROMPT,
-            )
-            filtered = [
-                r for r in results_with_scores if (self._numerize(r["answer"]) != "")
-            ]
-            all_scores = [r["score"] for r in filtered]
-            idx = np.argmax(all_scores)
-            consensus = self._numerize(results_with_scores[idx]["answer"])
-            return consensus
-        else:
-            results = self.model.batch_complete(
-                query=self.query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION,
-                system_prompt=SYSTEM_PROMPT,
-            )
-            valid_answers = [m for m in results if m != "NA"]
-
-            numerized = []
-            for answer in valid_answers:
-
-                num = self._numerize(answer)
-                if num != "":
-                    numerized.append(num)
-
-            if len(numerized) > 0:
-                consensus = most_common(numerized)
-            else:
-                consensus = "NA"
-
-            return consensus
+        return super().extract(doc_text)
@@ -1,6 +1,5 @@
-from ..utils import most_common
 from .base import BaseExtractor
-import numpy as np
+from typing import Optional
 
 TASK_DESCRIPTION = "Use the information given below."
 
@@ -9,6 +8,17 @@ SYSTEM_PROMPT = 'Answer only with the relevant text snippet you have found below
 
 class TextExtractor(BaseExtractor):
 
+    def _task_description(self) -> str:
+        return TASK_DESCRIPTION
+
+    def _system_prompt(self) -> str:
+        return SYSTEM_PROMPT
+
+    def _vote(self, answer: str) -> Optional[str]:
+        if answer == "NA":
+            return None
+        return answer
+
     def extract(self, doc_text: str) -> str:
         """Extracts a text snippet.
 
@@ -18,35 +28,4 @@ class TextExtractor(BaseExtractor):
         Returns:
             str: The extracted snippet.
         """
-        merged_chunks = self._chunk_text(doc_text)
-
-        if self.model.model_description()["scores"]:
-            results_with_scores = self.model.batch_complete_with_scores(
-                query=self.query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION,
-                system_prompt=SYSTEM_PROMPT,
-            )
-            all_scores = [r["score"] for r in results_with_scores]
-            idx = np.argmax(all_scores)
-            consensus = results_with_scores[idx]["answer"]
-            return consensus
-        else:
-            results = self.model.batch_complete(
-                query=self.query,
-                context=merged_chunks,
-                task_description=TASK_DESCRIPTION,
-                system_prompt=SYSTEM_PROMPT,
-            )
-            valid_answers = []
-            valid_indices = []
-            for idx, answer in enumerate(results):
-                if answer != "NA":
-                    valid_answers.append(answer)
-                    valid_indices.append(idx)
-
-            if len(valid_answers) > 0:
-                consensus = most_common(valid_answers)
-            else:
-                consensus = "NA"
-            return consensus
+        return super().extract(doc_text)
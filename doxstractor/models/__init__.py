@@ -1,6 +1,44 @@
-from .anthropic import AnthropicAPIModel
 from .mock import MockModel, MockModelWithScores
 from .base import BaseModel
-from .transformers_qa import TransformersQAModel
-from .transformers_classify import TransformerClassifierModel
-from .huggingface_endpoints import HFEndPointQAModel
+from .anthropic_batch import AnthropicBatchModel, PendingResults
+from .cache import CachedModel, MemoryCache, SQLiteCache
+from .cascade import CascadeModel
+from .rate_limit import RateLimiter, get_default_rate_limiter, set_default_rate_limiter
+from typing import TYPE_CHECKING
+import importlib
+
+if TYPE_CHECKING:
+    from .anthropic import AnthropicAPIModel
+    from .transformers_qa import TransformersQAModel
+    from .transformers_classify import TransformerClassifierModel
+    from .huggingface_endpoints import HFEndPointQAModel
+
+
+# Backends with heavy dependencies are only imported on first access.
+# name -> (module, extra providing its dependencies)
+_LAZY_MODELS = {
+    "AnthropicAPIModel": (".anthropic", "anthropic"),
+    "TransformersQAModel": (".transformers_qa", "transformers"),
+    "TransformerClassifierModel": (".transformers_classify", "transformers"),
+    "HFEndPointQAModel": (".huggingface_endpoints", "hf-endpoints"),
+}
+
+
+def __getattr__(name: str):
+    if name not in _LAZY_MODELS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    module_name, extra = _LAZY_MODELS[name]
+    try:
+        module = importlib.import_module(module_name, __name__)
+    except ImportError as e:
+        raise ImportError(
+            f"{name} requires optional dependencies, install them with pip install 'doxstractor[{extra}]'"
+        ) from e
+    model_class = getattr(module, name)
+    globals()[name] = model_class
+    return model_class
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_MODELS))
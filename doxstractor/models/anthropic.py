@@ -1,7 +1,29 @@
 import anthropic
 from .base import BaseModel
-from typing import Optional, List
-import time
+from .rate_limit import (
+    RateLimiter,
+    acall_with_retries,
+    call_with_retries,
+    get_default_rate_limiter,
+    is_retryable_status,
+)
+from ..utils import thread_map
+from .. import tracing
+from typing import Dict, Optional, List
+import asyncio
+import collections
+import threading
+
+
+PROMPT_CACHING_BETA = "prompt-caching-2024-07-31"
+CACHED_SYSTEM_PROMPT = "You answer questions about the document provided by the user. Follow the instructions given after the document."
+CACHED_CONTEXT_TEMPLATE = "<document>\n{context}\n</document>"
+USAGE_KEYS = [
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens",
+]
 
 
 class AnthropicAPIModel(BaseModel):
@@ -10,6 +32,11 @@ class AnthropicAPIModel(BaseModel):
         model: Optional[str] = "claude-3-haiku-20240307",
         temperature: float = 0.0,
         max_tokens: int = 1_000,
+        max_concurrency: int = 1,
+        max_async_concurrency: Optional[int] = None,
+        rate_limiter: Optional[RateLimiter] = None,
+        max_retries: int = 10,
+        prompt_caching: bool = False,
     ) -> None:
         """Model using the Anthropic python API
 
@@ -17,16 +44,82 @@ class AnthropicAPIModel(BaseModel):
             model (Optional[str], optional): Model name. Defaults to "claude-3-haiku-20240307".
             temperature (float, optional): Defaults to 0.0.
             max_tokens (int, optional):Defaults to 1_000.
+            max_concurrency (int, optional): Maximum number of requests in flight during `batch_complete`.
+                Defaults to 1 (chunks are sent one after another).
+            max_async_concurrency (Optional[int], optional): Maximum number of requests in flight for the async
+                API, shared by all calls on the same event loop. Defaults to None (only the rate limiter
+                bounds them).
+            rate_limiter (Optional[RateLimiter], optional): Request and token budget. Defaults to the rate
+                limiter shared by all models of the process, see `set_default_rate_limiter`.
+            max_retries (int, optional): Retries per request on rate limits, connection errors and server
+                errors, with jittered exponential backoff. Defaults to 10.
+            prompt_caching (bool, optional): Send the chunk first as a cached prompt block, followed by the
+                extractor's instructions and query, so all extractors reading the same chunk reuse the cached
+                context. Chunks below the model's minimum cacheable length (1024 tokens, 2048 for Haiku) are
+                not cached. Defaults to False.
         """
         super().__init__(model=model, temperature=temperature, max_tokens=max_tokens)
+        self.max_concurrency = max_concurrency
+        self.max_async_concurrency = max_async_concurrency
+        self._rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.prompt_caching = prompt_caching
+        self._usage = collections.Counter()
+        self._usage_lock = threading.Lock()
 
-        self.client = anthropic.Anthropic()
+        # Retries are handled here, so all requests pass through the rate limiter.
+        self.client = anthropic.Anthropic(max_retries=0)
+        self.async_client = None
+        self._async_client_loop = None
+        self._semaphore = None
+        self._semaphore_loop = None
 
     def model_description(self):
         return {"type": "text", "scores": False}
 
-    def _query_anthropic(self, system_prompt, user_prompt):
-        message = self.client.messages.create(
+    def __getstate__(self):
+        # API clients hold connections and locks, they are recreated after unpickling.
+        state = self.__dict__.copy()
+        for key in [
+            "client",
+            "async_client",
+            "_async_client_loop",
+            "_semaphore",
+            "_semaphore_loop",
+        ]:
+            state[key] = None
+        del state["_usage_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._usage_lock = threading.Lock()
+        self.client = anthropic.Anthropic(max_retries=0)
+
+    async def _aclient(self) -> anthropic.AsyncAnthropic:
+        # Clients are bound to the event loop they are first used on, the client of an earlier loop is closed.
+        loop = asyncio.get_running_loop()
+        if self.async_client is not None and self._async_client_loop is not loop:
+            await self.aclose()
+        if self.async_client is None:
+            self.async_client = anthropic.AsyncAnthropic(max_retries=0)
+            self._async_client_loop = loop
+        return self.async_client
+
+    async def aclose(self):
+        """Closes the connections of the async client. Call it before the event loop ends."""
+        client, self.async_client = self.async_client, None
+        if client is not None:
+            try:
+                await client.close()
+            except RuntimeError:
+                # The client's event loop is already closed, and its connections with it.
+                pass
+
+    def _request_kwargs(self, system_prompt, user_prompt):
+        if isinstance(user_prompt, str):
+            user_prompt = [{"type": "text", "text": user_prompt}]
+        return dict(
             model=self.model,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
@@ -34,18 +127,108 @@ class AnthropicAPIModel(BaseModel):
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": user_prompt,
-                        }
-                    ],
+                    "content": user_prompt,
                 }
             ],
         )
 
+    def _extra_headers(self):
+        if self.prompt_caching:
+            return {"anthropic-beta": PROMPT_CACHING_BETA}
+        return None
+
+    def _query_anthropic(self, system_prompt, user_prompt):
+        message = self.client.messages.create(
+            **self._request_kwargs(system_prompt, user_prompt),
+            extra_headers=self._extra_headers(),
+        )
+
         return message
 
+    async def _aquery_anthropic(self, system_prompt, user_prompt):
+        client = await self._aclient()
+        message = await client.messages.create(
+            **self._request_kwargs(system_prompt, user_prompt),
+            extra_headers=self._extra_headers(),
+        )
+
+        return message
+
+    def _user_prompt(self, query, context, task_description):
+        if task_description:
+            return query + "\n" + task_description + "\n" + context
+        return query + "\n" + context
+
+    def _prompts(self, query, context, task_description, system_prompt):
+        """(system_prompt, user_prompt) of a request. With prompt caching, the user prompt is a list of
+        content blocks starting with the cached chunk, and the extractor's system prompt moves behind it
+        so the cached prefix is the same for every extractor."""
+        if not self.prompt_caching:
+            return system_prompt, self._user_prompt(query, context, task_description)
+
+        instructions = "\n".join(
+            part for part in [system_prompt, query, task_description] if part
+        )
+        user_prompt = [
+            {
+                "type": "text",
+                "text": CACHED_CONTEXT_TEMPLATE.format(context=context),
+                "cache_control": {"type": "ephemeral"},
+            },
+            {"type": "text", "text": instructions},
+        ]
+        return CACHED_SYSTEM_PROMPT, user_prompt
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self._rate_limiter or get_default_rate_limiter()
+
+    def _estimate_tokens(self, system_prompt, user_prompt) -> float:
+        # Roughly four characters per token, good enough to pace requests before the real usage is known.
+        if not isinstance(user_prompt, str):
+            user_prompt = "".join(block["text"] for block in user_prompt)
+        return (len(system_prompt or "") + len(user_prompt)) / 4
+
+    def _record_usage(self, message, estimated_tokens: float):
+        usage = getattr(message, "usage", None)
+        if usage is None:
+            return
+        counts = {key: getattr(usage, key, None) or 0 for key in USAGE_KEYS}
+        with self._usage_lock:
+            self._usage.update(counts)
+        tracing.add(**counts)
+        # Cache reads don't count towards the input token rate limit.
+        self.rate_limiter.record_tokens(
+            counts["input_tokens"]
+            + counts["cache_creation_input_tokens"]
+            + counts["output_tokens"]
+            - estimated_tokens
+        )
+
+    def usage(self) -> Dict:
+        """Token counts of all responses since creation, including prompt cache writes
+        (cache_creation_input_tokens) and reads (cache_read_input_tokens)."""
+        with self._usage_lock:
+            return {key: self._usage[key] for key in USAGE_KEYS}
+
+    @staticmethod
+    def _retry_info(error: Exception):
+        if isinstance(error, anthropic.APIConnectionError):
+            return None, None
+        if isinstance(error, anthropic.APIStatusError) and is_retryable_status(error.status_code):
+            return error.status_code, error.response.headers
+        return None
+
+    def _get_semaphore(self) -> Optional[asyncio.Semaphore]:
+        if self.max_async_concurrency is None:
+            return None
+        # Semaphores are bound to the event loop they are first used on.
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_async_concurrency)
+            self._semaphore_loop = loop
+        return self._semaphore
+
     def complete(
         self,
         query: str,
@@ -64,32 +247,53 @@ class AnthropicAPIModel(BaseModel):
         Returns:
             str: Model response text.
         """
-        if task_description:
-            user_prompt = query + "\n" + task_description + "\n" + context
-        else:
-            user_prompt = query + "\n" + context
+        system_prompt, user_prompt = self._prompts(
+            query, context, task_description, system_prompt
+        )
+        estimated_tokens = self._estimate_tokens(system_prompt, user_prompt)
 
-        for attempt in range(10):
-            try:
-                message = self._query_anthropic(system_prompt, user_prompt)
-                return message.content[0].text
-            except anthropic.APIConnectionError as e:
-                print("The anthropic API could not be reached")
-                print(e.__cause__)
-
-            except anthropic.RateLimitError as e:
-                print(
-                    "A 429 status code was received; sleeping 60s to reset rate limit"
-                )
-                time.sleep(60)
-
-            except anthropic.APIStatusError as e:
-                print("Another non-200-range status code was received")
-                print(e.status_code)
-                print(e.response)
-            else:
-                break
+        message = call_with_retries(
+            lambda: self._query_anthropic(system_prompt, user_prompt),
+            self.rate_limiter,
+            self._retry_info,
+            self.max_retries,
+            tokens=estimated_tokens,
+        )
+        self._record_usage(message, estimated_tokens)
+        return message.content[0].text
 
+    async def acomplete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> str:
+        """Async version of `complete` using `anthropic.AsyncAnthropic`.
+
+        Args:
+            query (str): The query specifying what we want to extract.
+            context (str): The text from which to extract.
+            task_description (Optional[str], optional): Inserted between the query and the context. Defaults to None.
+            system_prompt (Optional[str], optional): System prompt for model. Defaults to None.
+
+        Returns:
+            str: Model response text.
+        """
+        system_prompt, user_prompt = self._prompts(
+            query, context, task_description, system_prompt
+        )
+        estimated_tokens = self._estimate_tokens(system_prompt, user_prompt)
+
+        message = await acall_with_retries(
+            lambda: self._aquery_anthropic(system_prompt, user_prompt),
+            self.rate_limiter,
+            self._retry_info,
+            self.max_retries,
+            tokens=estimated_tokens,
+            semaphore=self._get_semaphore(),
+        )
+        self._record_usage(message, estimated_tokens)
         return message.content[0].text
 
     def batch_complete(
@@ -100,6 +304,7 @@ class AnthropicAPIModel(BaseModel):
         system_prompt: Optional[str] = None,
     ) -> List[str]:
         """Sends batch of requests to Anthropic and returns the result. Deals with API issues such as overload, timout, etc.
+        Up to `max_concurrency` requests are sent in parallel, each chunk is retried independently.
 
         Args:
             query (str): The query specifying what we want to extract.
@@ -110,13 +315,46 @@ class AnthropicAPIModel(BaseModel):
         Returns:
             List[str]: Model response text for each context.
         """
-        all_results = []
-        for c in context:
-            result = self.complete(
+        return thread_map(
+            lambda c: self.complete(
                 query=query,
                 context=c,
                 task_description=task_description,
                 system_prompt=system_prompt,
+            ),
+            context,
+            max_workers=self.max_concurrency,
+        )
+
+    async def abatch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        """Async version of `batch_complete`. All chunks are scheduled at once, the number of requests
+        in flight is bounded by the rate limiter and `max_async_concurrency`.
+
+        Args:
+            query (str): The query specifying what we want to extract.
+            context (List[str]): The text from which to extract. Model will answer query for each element of list.
+            task_description (Optional[str], optional): Inserted between the query and the context. Defaults to None.
+            system_prompt (Optional[str], optional): System prompt for model. Defaults to None.
+
+        Returns:
+            List[str]: Model response text for each context.
+        """
+        return list(
+            await asyncio.gather(
+                *[
+                    self.acomplete(
+                        query=query,
+                        context=c,
+                        task_description=task_description,
+                        system_prompt=system_prompt,
+                    )
+                    for c in context
+                ]
             )
-            all_results.append(result)
-        return all_results
+        )
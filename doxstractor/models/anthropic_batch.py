@@ -0,0 +1,269 @@
+from .base import BaseModel
+from typing import Dict, List, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class PendingResults(Exception):
+    """Raised when model answers are not available yet because they are waiting for a batch submission."""
+
+
+class BatchState:
+    def __init__(self, path: str) -> None:
+        """Persists bulk requests, submitted batches and results in a SQLite database, so a crashed run
+        can resume without re-submitting work.
+
+        Args:
+            path (str): Path of the database file. Created if it does not exist.
+        """
+        self.path = os.fspath(path)
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS requests (custom_id TEXT PRIMARY KEY, params TEXT, "
+                "batch_id TEXT, result TEXT, error TEXT, attempts INTEGER DEFAULT 0)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS batches (batch_id TEXT PRIMARY KEY, ended INTEGER DEFAULT 0)"
+            )
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def lookup(self, custom_ids: List[str]) -> Dict[str, tuple]:
+        """Known requests as {custom_id: (result, error)}. Both are None while the request is pending."""
+        found = {}
+        with self._connection() as conn:
+            for custom_id in set(custom_ids):
+                row = conn.execute(
+                    "SELECT result, error FROM requests WHERE custom_id = ?",
+                    (custom_id,),
+                ).fetchone()
+                if row is not None:
+                    found[custom_id] = row
+        return found
+
+    def add(self, requests: Dict[str, Dict]):
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO requests (custom_id, params) VALUES (?, ?)",
+                [(custom_id, json.dumps(params)) for custom_id, params in requests.items()],
+            )
+
+    def unsubmitted(self, limit: int) -> Dict[str, Dict]:
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT custom_id, params FROM requests "
+                "WHERE batch_id IS NULL AND result IS NULL AND error IS NULL LIMIT ?",
+                (limit,),
+            ).fetchall()
+        return {custom_id: json.loads(params) for custom_id, params in rows}
+
+    def mark_submitted(self, batch_id: str, custom_ids: List[str]):
+        with self._connection() as conn:
+            conn.execute("INSERT INTO batches (batch_id) VALUES (?)", (batch_id,))
+            conn.executemany(
+                "UPDATE requests SET batch_id = ?, attempts = attempts + 1 WHERE custom_id = ?",
+                [(batch_id, custom_id) for custom_id in custom_ids],
+            )
+
+    def open_batches(self) -> List[str]:
+        with self._connection() as conn:
+            rows = conn.execute("SELECT batch_id FROM batches WHERE ended = 0").fetchall()
+        return [row[0] for row in rows]
+
+    def finish_batch(self, batch_id: str, results: Dict[str, str], max_attempts: int):
+        """Stores the answers of a batch. Requests without an answer are submitted again until they
+        reach max_attempts."""
+        with self._connection() as conn:
+            conn.executemany(
+                "UPDATE requests SET result = ? WHERE custom_id = ?",
+                [(json.dumps(text), custom_id) for custom_id, text in results.items()],
+            )
+            conn.execute(
+                "UPDATE requests SET error = 'Request failed in all batch attempts' "
+                "WHERE batch_id = ? AND result IS NULL AND attempts >= ?",
+                (batch_id, max_attempts),
+            )
+            conn.execute(
+                "UPDATE requests SET batch_id = NULL "
+                "WHERE batch_id = ? AND result IS NULL AND error IS NULL",
+                (batch_id,),
+            )
+            conn.execute("UPDATE batches SET ended = 1 WHERE batch_id = ?", (batch_id,))
+
+
+class AnthropicBatchModel(BaseModel):
+    def __init__(
+        self,
+        model: BaseModel,
+        state_path: str,
+        api_key: Optional[str] = None,
+        base_url: str = "https://api.anthropic.com",
+        max_batch_size: int = 10_000,
+        max_attempts: int = 3,
+    ) -> None:
+        """Offline bulk mode for an `AnthropicAPIModel` using the Message Batches API, which is cheaper
+        but not interactive.
+
+        Instead of calling the API, the model answers from results of earlier batches. Chunks without a
+        result are recorded and `PendingResults` is raised, `extract_bulk` then submits everything recorded
+        as batches, polls until they end and runs the corpus again. All state lives in a SQLite file, so a
+        crashed run resumes where it stopped.
+
+        Args:
+            model (BaseModel): The `AnthropicAPIModel` whose model name, parameters and prompts are used.
+            state_path (str): SQLite file for requests, batches and results.
+            api_key (Optional[str], optional): Defaults to the key of the wrapped model's client or the
+                ANTHROPIC_API_KEY environment variable.
+            base_url (str, optional): API base URL. Defaults to "https://api.anthropic.com".
+            max_batch_size (int, optional): Maximum requests per submitted batch. Defaults to 10_000.
+            max_attempts (int, optional): Submissions per request before it is given up. Defaults to 3.
+        """
+        super().__init__(
+            model=model.model, temperature=model.temperature, max_tokens=model.max_tokens
+        )
+        self.wrapped_model = model
+        self.state = BatchState(state_path)
+        client = getattr(model, "client", None)
+        self.api_key = (
+            api_key
+            or getattr(client, "api_key", None)
+            or os.environ.get("ANTHROPIC_API_KEY")
+        )
+        self.base_url = base_url.rstrip("/")
+        self.max_batch_size = max_batch_size
+        self.max_attempts = max_attempts
+
+    def model_description(self):
+        return self.wrapped_model.model_description()
+
+    def default_chunker(self):
+        return self.wrapped_model.default_chunker()
+
+    def _http(self):
+        import httpx
+
+        return httpx.Client(
+            base_url=self.base_url,
+            headers={
+                "x-api-key": self.api_key or "",
+                "anthropic-version": "2023-06-01",
+            },
+            timeout=120,
+        )
+
+    def _params(self, query, context, task_description, system_prompt) -> Dict:
+        system_prompt, user_prompt = self.wrapped_model._prompts(
+            query, context, task_description, system_prompt
+        )
+        params = self.wrapped_model._request_kwargs(system_prompt, user_prompt)
+        return {key: value for key, value in params.items() if value is not None}
+
+    def batch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        """Answers from stored batch results.
+
+        Raises:
+            PendingResults: If some chunks have no result yet. They are recorded for the next submission.
+            RuntimeError: If a request failed in all batch attempts.
+        """
+        requests = {}
+        for c in context:
+            params = self._params(query, c, task_description, system_prompt)
+            custom_id = hashlib.sha256(
+                json.dumps(params, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+            requests[custom_id] = params
+
+        known = self.state.lookup(list(requests))
+        missing = {i: p for i, p in requests.items() if i not in known}
+        if missing:
+            self.state.add(missing)
+        if any(error is not None for _, error in known.values()):
+            raise RuntimeError("A batch request failed in all attempts")
+        if missing or any(result is None for result, _ in known.values()):
+            raise PendingResults(f"{len(requests)} requests are waiting for a batch")
+        return [json.loads(known[custom_id][0]) for custom_id in requests]
+
+    def complete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> str:
+        return self.batch_complete(query, [context], task_description, system_prompt)[0]
+
+    def submit_pending(self) -> List[str]:
+        """Submits all recorded requests without a batch.
+
+        Returns:
+            List[str]: Ids of the submitted batches.
+        """
+        batch_ids = []
+        with self._http() as http:
+            while True:
+                requests = self.state.unsubmitted(self.max_batch_size)
+                if not requests:
+                    return batch_ids
+                response = http.post(
+                    "/v1/messages/batches",
+                    json={
+                        "requests": [
+                            {"custom_id": custom_id, "params": params}
+                            for custom_id, params in requests.items()
+                        ]
+                    },
+                )
+                response.raise_for_status()
+                batch_id = response.json()["id"]
+                self.state.mark_submitted(batch_id, list(requests))
+                batch_ids.append(batch_id)
+
+    def wait_for_batches(self, poll_interval: float = 60.0):
+        """Polls all open batches until they end and stores their results."""
+        with self._http() as http:
+            for batch_id in self.state.open_batches():
+                while True:
+                    response = http.get(f"/v1/messages/batches/{batch_id}")
+                    response.raise_for_status()
+                    batch = response.json()
+                    if batch["processing_status"] == "ended":
+                        break
+                    time.sleep(poll_interval)
+
+                results = {}
+                with http.stream("GET", batch["results_url"]) as stream:
+                    stream.raise_for_status()
+                    for line in stream.iter_lines():
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        if entry["result"]["type"] == "succeeded":
+                            message = entry["result"]["message"]
+                            results[entry["custom_id"]] = message["content"][0]["text"]
+                self.state.finish_batch(batch_id, results, self.max_attempts)
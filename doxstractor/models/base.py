@@ -1,4 +1,37 @@
 from typing import Optional, List, Dict
+import asyncio
+import contextlib
+import contextvars
+import functools
+
+
+_calling_extractor = contextvars.ContextVar("doxstractor_calling_extractor", default=None)
+
+
+@contextlib.contextmanager
+def calling_extractor(name: str):
+    """Marks the model calls made in the with block as calls of the named extractor, for per-extractor
+    model statistics such as `CascadeModel.stats`."""
+    token = _calling_extractor.set(name)
+    try:
+        yield
+    finally:
+        _calling_extractor.reset(token)
+
+
+def current_extractor() -> Optional[str]:
+    """Name of the extractor whose model call is running, None for calls made outside an extractor."""
+    return _calling_extractor.get()
+
+
+async def run_in_executor(fn, *args, **kwargs):
+    """Runs a blocking function in the default executor of the running event loop, in a copy of the
+    caller's context."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None,
+        functools.partial(contextvars.copy_context().run, fn, *args, **kwargs),
+    )
 
 
 class BaseModel:
@@ -24,6 +57,12 @@ class BaseModel:
     def model_description(self):
         raise NotImplementedError
 
+    def default_chunker(self):
+        """The chunker extractors use with this model unless they are given one. Models with a fixed
+        context window in tokens return a `TokenChunker` matching it. Defaults to None (character based
+        chunking)."""
+        return None
+
     def batch_complete(
         self,
         query: str,
@@ -41,3 +80,71 @@ class BaseModel:
         system_prompt: Optional[str] = None,
     ) -> List[Dict]:
         raise NotImplementedError
+
+    def batch_complete_many(self, requests: List[Dict]) -> List[List]:
+        """Answers several batch requests at once, e.g. the requests of all sibling extractors sharing
+        the model. Models which can batch across requests override this, by default every request is
+        sent on its own.
+
+        Args:
+            requests (List[Dict]): Keyword arguments for `batch_complete` (or `batch_complete_with_scores`
+                for models with scores), i.e. query, context, task_description and system_prompt.
+
+        Returns:
+            List[List]: The results of each request.
+        """
+        if self.model_description()["scores"]:
+            return [self.batch_complete_with_scores(**r) for r in requests]
+        return [self.batch_complete(**r) for r in requests]
+
+    async def acomplete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        """Async version of `complete`. By default the synchronous implementation runs in an executor."""
+        return await run_in_executor(
+            self.complete,
+            query=query,
+            context=context,
+            task_description=task_description,
+            system_prompt=system_prompt,
+        )
+
+    async def abatch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        """Async version of `batch_complete`. By default the synchronous implementation runs in an executor."""
+        return await run_in_executor(
+            self.batch_complete,
+            query=query,
+            context=context,
+            task_description=task_description,
+            system_prompt=system_prompt,
+        )
+
+    async def abatch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        """Async version of `batch_complete_with_scores`. By default the synchronous implementation runs in an executor."""
+        return await run_in_executor(
+            self.batch_complete_with_scores,
+            query=query,
+            context=context,
+            task_description=task_description,
+            system_prompt=system_prompt,
+        )
+
+    async def abatch_complete_many(self, requests: List[Dict]) -> List[List]:
+        """Async version of `batch_complete_many`. By default the synchronous implementation runs in an executor."""
+        return await run_in_executor(self.batch_complete_many, requests)
@@ -0,0 +1,483 @@
+from .base import BaseModel
+from .. import tracing
+from ..utils import to_builtin
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+_MISSING = object()
+# Result handed to waiters when the call answering a chunk was cancelled.
+_ABANDONED = object()
+
+
+class MemoryCache:
+    def __init__(self, maxsize: Optional[int] = 100_000) -> None:
+        """Thread safe in-memory LRU cache.
+
+        Args:
+            maxsize (Optional[int], optional): Maximum number of entries, None for unbounded. Defaults to 100_000.
+        """
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.maxsize is not None:
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    def __init__(
+        self,
+        path: str,
+        max_entries: Optional[int] = None,
+        max_age: Optional[float] = None,
+        evict_every: int = 1_000,
+    ) -> None:
+        """On-disk cache in a SQLite database. The database can be shared by threads and processes.
+
+        Args:
+            path (str): Path of the database file. Created if it does not exist.
+            max_entries (Optional[int], optional): Least recently used entries beyond this number are evicted.
+                Defaults to None (unbounded).
+            max_age (Optional[float], optional): Entries older than this many seconds are evicted. Expired
+                entries are never returned, even before they are evicted. Defaults to None (never expire).
+            evict_every (int, optional): Evict after this many inserts of this instance, so the cost of an
+                eviction is spread over many inserts. The cache can exceed max_entries by up to this many
+                entries per process. Defaults to 1_000.
+        """
+        self.path = os.fspath(path)
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.evict_every = max(evict_every, 1)
+        self._inserts = 0
+        self._inserts_lock = threading.Lock()
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_created ON cache (created)")
+
+    def __getstate__(self):
+        # Connections can't be shared across processes, every process opens its own.
+        state = self.__dict__.copy()
+        del state["_local"]
+        del state["_inserts_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+        self._inserts_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str, default=None):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, created FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return default
+            if self.max_age is not None and row[1] < now - self.max_age:
+                conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                return default
+            conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, default=to_builtin), now, now),
+            )
+            with self._inserts_lock:
+                self._inserts += 1
+                evict = self._inserts % self.evict_every == 0
+            if evict:
+                self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        if self.max_age is not None:
+            conn.execute("DELETE FROM cache WHERE created < ?", (now - self.max_age,))
+        if self.max_entries is not None:
+            conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM cache")
+
+    def __len__(self):
+        with self._connection() as conn:
+            return conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class CachedModel(BaseModel):
+    def __init__(self, model: BaseModel, cache=None) -> None:
+        """Wraps a model and caches its answers per chunk.
+
+        Answers are keyed by the model name, temperature, system prompt, task description, query and
+        a hash of the chunk, so changing any of them only re-sends the affected requests.
+
+        Identical (query, chunk) pairs are only sent once, also when they appear several times in one call
+        or in calls running at the same time, e.g. boilerplate clauses in documents of an `extract_many` run.
+        Later calls wait for the answer of the first one. With `MemoryCache(maxsize=None)` every pair reaches
+        the wrapped model at most once while the cached model is in use.
+
+        Args:
+            model (BaseModel): The model to wrap.
+            cache (optional): `MemoryCache`, `SQLiteCache` or any object with get(key, default) and
+                set(key, value). Defaults to a new `MemoryCache`.
+        """
+        super().__init__(
+            model=model.model, temperature=model.temperature, max_tokens=model.max_tokens
+        )
+        self.wrapped_model = model
+        self.cache = cache if cache is not None else MemoryCache()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._in_flight = {}  # cache key -> Future of the call answering it
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_in_flight"] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def model_description(self):
+        return self.wrapped_model.model_description()
+
+    def default_chunker(self):
+        return self.wrapped_model.default_chunker()
+
+    def stats(self) -> Dict:
+        """Hit and miss counters of this model since creation."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+    def cache_key(
+        self,
+        method: str,
+        query,
+        context: str,
+        task_description: Optional[str],
+        system_prompt: Optional[str],
+    ) -> str:
+        key = [
+            method,
+            type(self.wrapped_model).__name__,
+            self.wrapped_model.model,
+            self.wrapped_model.temperature,
+            system_prompt,
+            task_description,
+            query,
+            hashlib.sha256(context.encode("utf-8")).hexdigest(),
+        ]
+        return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+    def _lookup(self, method: str, query, context: List[str], task_description, system_prompt):
+        keys = [
+            self.cache_key(method, query, c, task_description, system_prompt)
+            for c in context
+        ]
+        results = [self.cache.get(key, _MISSING) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is _MISSING]
+        return keys, results, missing
+
+    def _count(self, chunks: int, sent: int):
+        """Counts the chunks this call sent to the model as misses, all others as hits."""
+        with self._lock:
+            self.hits += chunks - sent
+            self.misses += sent
+        tracing.add(cache_hits=chunks - sent, cache_misses=sent)
+
+    def _store(self, keys, results, missing, new_results):
+        for i, result in zip(missing, new_results):
+            self.cache.set(keys[i], result)
+            results[i] = result
+        return results
+
+    def _claim(self, keys, results, missing):
+        """Splits the missing chunks into the ones this call sends to the model and the ones another call,
+        or an earlier copy in this call, is already answering. Chunks stored by a call which finished since
+        the lookup are taken from the cache.
+
+        Returns:
+            Tuple[List[int], List[Tuple[int, Future]]]: Indices to send, and (index, future) pairs to wait for.
+        """
+        owned, waiting = [], []
+        with self._lock:
+            for i in missing:
+                future = self._in_flight.get(keys[i])
+                if future is not None:
+                    waiting.append((i, future))
+                    continue
+                # Answers are stored before their future leaves _in_flight, so this can't miss one.
+                result = self.cache.get(keys[i], _MISSING)
+                if result is not _MISSING:
+                    results[i] = result
+                else:
+                    self._in_flight[keys[i]] = Future()
+                    owned.append(i)
+        return owned, waiting
+
+    def _settle(self, keys, owned, new_results=None, error=None):
+        """Hands the answers (or the error) of the owned chunks to everyone waiting for them. If the call
+        was cancelled or interrupted, the waiters get `_ABANDONED` and claim the chunks again."""
+        with self._lock:
+            futures = [self._in_flight.pop(keys[i]) for i in owned]
+        for j, future in enumerate(futures):
+            if future.done():
+                continue
+            if isinstance(error, Exception):
+                future.set_exception(error)
+            elif error is not None:
+                future.set_result(_ABANDONED)
+            else:
+                future.set_result(new_results[j])
+
+    def _collect_waiting(self, results, waiting) -> List[int]:
+        """Fills in the answers of other calls. Returns the indices whose owner was cancelled."""
+        abandoned = []
+        for i, future in waiting:
+            result = future.result()
+            if result is _ABANDONED:
+                abandoned.append(i)
+            else:
+                results[i] = result
+        return abandoned
+
+    def _batch(self, method: str, query, context, task_description, system_prompt):
+        keys, results, missing = self._lookup(
+            method, query, context, task_description, system_prompt
+        )
+        sent = 0
+        while missing:
+            owned, waiting = self._claim(keys, results, missing)
+            if owned:
+                try:
+                    new_results = getattr(self.wrapped_model, method)(
+                        query=query,
+                        context=[context[i] for i in owned],
+                        task_description=task_description,
+                        system_prompt=system_prompt,
+                    )
+                except BaseException as e:
+                    self._settle(keys, owned, error=e)
+                    raise
+                self._store(keys, results, owned, new_results)
+                self._settle(keys, owned, new_results)
+                sent += len(owned)
+            missing = self._collect_waiting(results, waiting)
+        self._count(len(context), sent)
+        return results
+
+    async def _abatch(self, method: str, query, context, task_description, system_prompt):
+        keys, results, missing = self._lookup(
+            method, query, context, task_description, system_prompt
+        )
+        sent = 0
+        while missing:
+            owned, waiting = self._claim(keys, results, missing)
+            if owned:
+                try:
+                    new_results = await getattr(self.wrapped_model, "a" + method)(
+                        query=query,
+                        context=[context[i] for i in owned],
+                        task_description=task_description,
+                        system_prompt=system_prompt,
+                    )
+                except BaseException as e:
+                    self._settle(keys, owned, error=e)
+                    raise
+                self._store(keys, results, owned, new_results)
+                self._settle(keys, owned, new_results)
+                sent += len(owned)
+            missing = []
+            for i, future in waiting:
+                # Shielded, so a cancelled waiter doesn't cancel the answer shared with the owner.
+                result = await asyncio.shield(asyncio.wrap_future(future))
+                if result is _ABANDONED:
+                    missing.append(i)
+                else:
+                    results[i] = result
+        self._count(len(context), sent)
+        return results
+
+    def batch_complete_many(self, requests: List[Dict]) -> List[List]:
+        """Answers cached chunks from the cache and sends the remaining chunks of all requests to the
+        wrapped model in one `batch_complete_many` call."""
+        method = (
+            "batch_complete_with_scores"
+            if self.model_description()["scores"]
+            else "batch_complete"
+        )
+        lookups = [
+            self._lookup(
+                method,
+                r["query"],
+                r["context"],
+                r.get("task_description"),
+                r.get("system_prompt"),
+            )
+            for r in requests
+        ]
+        all_keys = [keys for keys, _, _ in lookups]
+        all_results = [results for _, results, _ in lookups]
+        all_missing = [missing for _, _, missing in lookups]
+        sent = 0
+        while any(all_missing):
+            claims = [
+                self._claim(keys, results, missing)
+                for keys, results, missing in zip(all_keys, all_results, all_missing)
+            ]
+            if any(owned for owned, _ in claims):
+                owned_requests = [
+                    dict(r, context=[r["context"][i] for i in owned])
+                    for r, (owned, _) in zip(requests, claims)
+                ]
+                try:
+                    new_results = self.wrapped_model.batch_complete_many(owned_requests)
+                except BaseException as e:
+                    for keys, (owned, _) in zip(all_keys, claims):
+                        self._settle(keys, owned, error=e)
+                    raise
+                for keys, results, (owned, _), new in zip(
+                    all_keys, all_results, claims, new_results
+                ):
+                    self._store(keys, results, owned, new)
+                    self._settle(keys, owned, new)
+                    sent += len(owned)
+            all_missing = [
+                self._collect_waiting(results, waiting)
+                for results, (_, waiting) in zip(all_results, claims)
+            ]
+        self._count(sum(len(r["context"]) for r in requests), sent)
+        return all_results
+
+    def complete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        key = self.cache_key("complete", query, context, task_description, system_prompt)
+        result = self.cache.get(key, _MISSING)
+        with self._lock:
+            if result is _MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        tracing.add(cache_hits=int(result is not _MISSING), cache_misses=int(result is _MISSING))
+        if result is _MISSING:
+            result = self.wrapped_model.complete(
+                query=query,
+                context=context,
+                task_description=task_description,
+                system_prompt=system_prompt,
+            )
+            self.cache.set(key, result)
+        return result
+
+    def batch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        """Answers cached chunks from the cache and sends only the remaining chunks to the model."""
+        return self._batch(
+            "batch_complete", query, context, task_description, system_prompt
+        )
+
+    def batch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        """Answers cached chunks from the cache and sends only the remaining chunks to the model."""
+        return self._batch(
+            "batch_complete_with_scores",
+            query,
+            context,
+            task_description,
+            system_prompt,
+        )
+
+    async def abatch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        return await self._abatch(
+            "batch_complete", query, context, task_description, system_prompt
+        )
+
+    async def abatch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        return await self._abatch(
+            "batch_complete_with_scores",
+            query,
+            context,
+            task_description,
+            system_prompt,
+        )
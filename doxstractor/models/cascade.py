@@ -0,0 +1,227 @@
+from .base import BaseModel, current_extractor
+from .. import tracing
+from typing import Dict, List, Optional, Union
+import collections
+import threading
+
+
+NA_ANSWERS = ("", "NA")
+
+
+class CascadeModel(BaseModel):
+    def __init__(
+        self,
+        models: List[BaseModel],
+        threshold: Union[float, List[float]] = 0.5,
+        escalate: str = "chunk",
+    ) -> None:
+        """Asks cheap models first and escalates to the next model only when unsure, e.g. a
+        `TransformersQAModel` before an `AnthropicAPIModel`.
+
+        An answer is unsure if it is "NA" or, for models with scores, if its score is below the threshold.
+        The last model's answers are always kept. All models get the same chunks, so the chunks need to fit
+        every model; `default_chunker` returns the first chunker any of the models asks for.
+
+        The cascade has scores if all its models have scores, otherwise scores are dropped and only answers
+        are returned. `stats` counts per extractor how many chunks each model answered, and every escalated
+        chunk is added to the active tracing span as "escalations", so `ProfileAggregator` shows them per node.
+
+        Args:
+            models (List[BaseModel]): Models from cheapest to most accurate, all of the same type.
+            threshold (Union[float, List[float]], optional): Minimum score to keep an answer, or one minimum
+                per model except the last. Defaults to 0.5.
+            escalate (str, optional): "chunk" escalates every unsure chunk on its own. "document" keeps a
+                model's answers if at least one chunk is sure, turning the unsure ones into "NA", and
+                escalates all chunks otherwise. Defaults to "chunk".
+
+        Raises:
+            ValueError: If the models have different types, the thresholds don't match the models or
+                escalate is unknown.
+        """
+        if len(models) < 2:
+            raise ValueError("A cascade needs at least two models")
+        if len(set(m.model_description()["type"] for m in models)) != 1:
+            raise ValueError("All models of a cascade need to be of the same type")
+        if escalate not in ("chunk", "document"):
+            raise ValueError(f"Unknown escalate mode {escalate}, use 'chunk' or 'document'")
+        thresholds = threshold if isinstance(threshold, list) else [threshold] * (len(models) - 1)
+        if len(thresholds) != len(models) - 1:
+            raise ValueError("Provide one threshold per model except the last")
+
+        super().__init__(
+            model=" -> ".join(str(m.model or type(m).__name__) for m in models),
+            temperature=models[-1].temperature,
+            max_tokens=models[-1].max_tokens,
+        )
+        self.models = models
+        self.thresholds = thresholds
+        self.escalate = escalate
+        self._scores = all(m.model_description()["scores"] for m in models)
+        self._answered_by = collections.defaultdict(lambda: [0] * len(models))
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_answered_by"] = dict(self._answered_by)
+        return state
+
+    def __setstate__(self, state):
+        answered_by = state.pop("_answered_by")
+        self.__dict__.update(state)
+        self._answered_by = collections.defaultdict(lambda: [0] * len(self.models))
+        self._answered_by.update(answered_by)
+        self._lock = threading.Lock()
+
+    def model_description(self):
+        return {"type": self.models[0].model_description()["type"], "scores": self._scores}
+
+    def default_chunker(self):
+        for model in self.models:
+            chunker = model.default_chunker()
+            if chunker is not None:
+                return chunker
+        return None
+
+    def stats(self) -> Dict[Optional[str], Dict]:
+        """{extractor_name: {"chunks", "answered_by", "escalation_rate"}}, where answered_by counts the chunks
+        each model answered and escalation_rate is the share of chunks the first model passed on. Calls made
+        outside an extractor are counted under None."""
+        with self._lock:
+            return {
+                extractor: {
+                    "chunks": sum(counts),
+                    "answered_by": list(counts),
+                    "escalation_rate": 1 - counts[0] / sum(counts) if sum(counts) else 0.0,
+                }
+                for extractor, counts in self._answered_by.items()
+            }
+
+    def _is_sure(self, stage: int, result) -> bool:
+        if isinstance(result, dict):
+            return (
+                str(result["answer"]).strip() not in NA_ANSWERS
+                and result["score"] >= self.thresholds[stage]
+            )
+        return str(result).strip() not in NA_ANSWERS
+
+    def _method(self, model: BaseModel) -> str:
+        if model.model_description()["scores"]:
+            return "batch_complete_with_scores"
+        return "batch_complete"
+
+    def _accept(self, stage: int, pending: List[int], stage_results: List, results: List) -> List[int]:
+        """Stores the answers a model is sure about and returns the chunk indices to escalate."""
+        last = stage == len(self.models) - 1
+        sure = [last or self._is_sure(stage, r) for r in stage_results]
+        if self.escalate == "document" and any(sure):
+            for i, result, is_sure in zip(pending, stage_results, sure):
+                if is_sure:
+                    results[i] = result
+                elif isinstance(result, dict):
+                    results[i] = dict(result, answer="NA")
+                else:
+                    results[i] = "NA"
+            return []
+        escalated = []
+        for i, result, is_sure in zip(pending, stage_results, sure):
+            if is_sure:
+                results[i] = result
+            else:
+                escalated.append(i)
+        return escalated
+
+    def _record(self, stage: int, answered: int, escalated: int):
+        with self._lock:
+            self._answered_by[current_extractor()][stage] += answered
+        if escalated:
+            tracing.add(escalations=escalated)
+
+    def _cascade(self, query, context: List[str], task_description, system_prompt) -> List:
+        results = [None] * len(context)
+        pending = list(range(len(context)))
+        for stage, model in enumerate(self.models):
+            if not pending:
+                break
+            stage_results = getattr(model, self._method(model))(
+                query=query,
+                context=[context[i] for i in pending],
+                task_description=task_description,
+                system_prompt=system_prompt,
+            )
+            escalated = self._accept(stage, pending, stage_results, results)
+            self._record(stage, len(pending) - len(escalated), len(escalated))
+            pending = escalated
+        return results
+
+    async def _acascade(self, query, context: List[str], task_description, system_prompt) -> List:
+        results = [None] * len(context)
+        pending = list(range(len(context)))
+        for stage, model in enumerate(self.models):
+            if not pending:
+                break
+            stage_results = await getattr(model, "a" + self._method(model))(
+                query=query,
+                context=[context[i] for i in pending],
+                task_description=task_description,
+                system_prompt=system_prompt,
+            )
+            escalated = self._accept(stage, pending, stage_results, results)
+            self._record(stage, len(pending) - len(escalated), len(escalated))
+            pending = escalated
+        return results
+
+    def complete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        return self.batch_complete(query, [context], task_description, system_prompt)[0]
+
+    def batch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        return [
+            r["answer"] if isinstance(r, dict) else r
+            for r in self._cascade(query, context, task_description, system_prompt)
+        ]
+
+    def batch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        if not self._scores:
+            raise NotImplementedError("Scores are only available if all models of the cascade have scores")
+        return self._cascade(query, context, task_description, system_prompt)
+
+    async def abatch_complete(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[str]:
+        return [
+            r["answer"] if isinstance(r, dict) else r
+            for r in await self._acascade(query, context, task_description, system_prompt)
+        ]
+
+    async def abatch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        if not self._scores:
+            raise NotImplementedError("Scores are only available if all models of the cascade have scores")
+        return await self._acascade(query, context, task_description, system_prompt)
@@ -1,6 +1,17 @@
 from .base import BaseModel
-from typing import Dict, List, Optional
+from .rate_limit import (
+    RateLimiter,
+    acall_with_retries,
+    call_with_retries,
+    is_retryable_status,
+)
+from ..utils import thread_map
+from .. import tracing
+from typing import Dict, List, Optional, Tuple, Union
+import asyncio
+import httpx
 import requests
+import requests.adapters
 import os
 
 
@@ -11,6 +22,11 @@ class HFEndPointQAModel(BaseModel):
         api_token: Optional[str] = None,
         temperature: float = 0,
         max_tokens: int = 1000,
+        max_concurrency: int = 4,
+        contexts_per_request: int = 1,
+        timeout: Union[float, Tuple[float, float]] = (10, 120),
+        max_retries: int = 10,
+        rate_limiter: Optional[RateLimiter] = None,
     ) -> None:
         """Huggingface model using hosted endpoints. Requires a valid token.
 
@@ -19,6 +35,15 @@ class HFEndPointQAModel(BaseModel):
             api_token (Optional[str], optional): Huggingface token. Defaults to HF_API_TOKEN environment variable.
             temperature (float, optional): For compatibility reasons only. Defaults to 0.
             max_tokens (int, optional): For compatibility reasons only. Defaults to 1000.
+            max_concurrency (int, optional): Maximum number of requests in flight. Defaults to 4.
+            contexts_per_request (int, optional): Number of chunks sent as a list in one request. Only use values
+                above 1 for endpoints which accept list inputs. Defaults to 1.
+            timeout (Union[float, Tuple[float, float]], optional): Timeout in seconds, or (connect, read) timeouts.
+                Defaults to (10, 120).
+            max_retries (int, optional): Retries per request on rate limits, connection errors and server
+                errors, with jittered exponential backoff. Defaults to 10.
+            rate_limiter (Optional[RateLimiter], optional): Request budget. Defaults to an unlimited limiter
+                for this model, which still honours retry-after.
 
         Raises:
             ValueError: If no token is provided.
@@ -36,9 +61,116 @@ class HFEndPointQAModel(BaseModel):
                     "The huggingface API requires a token. Either pass an API token or set the HF_API_TOKEN environment variable"
                 )
 
+        self.max_concurrency = max_concurrency
+        self.contexts_per_request = contexts_per_request
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.session = self._create_session()
+        self._async_client = None
+        self._async_client_loop = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ["session", "_async_client", "_async_client_loop"]:
+            state[key] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.session = self._create_session()
+
+    def _create_session(self) -> requests.Session:
+        """Keep-alive session with a connection pool sized for max_concurrency."""
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=max(self.max_concurrency, 1)
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(self._headers())
+        return session
+
+    async def _aclient(self) -> httpx.AsyncClient:
+        # Clients are bound to the event loop they are first used on, the client of an earlier loop is closed.
+        loop = asyncio.get_running_loop()
+        if self._async_client is not None and self._async_client_loop is not loop:
+            await self.aclose()
+        if self._async_client is None:
+            connect, read = (
+                self.timeout if isinstance(self.timeout, tuple) else (self.timeout,) * 2
+            )
+            self._async_client = httpx.AsyncClient(
+                headers=self._headers(),
+                timeout=httpx.Timeout(read, connect=connect),
+                limits=httpx.Limits(max_connections=max(self.max_concurrency, 1)),
+            )
+            self._async_client_loop = loop
+        return self._async_client
+
+    async def aclose(self):
+        """Closes the connections of the async client. Call it before the event loop ends."""
+        client, self._async_client = self._async_client, None
+        if client is not None:
+            try:
+                await client.aclose()
+            except RuntimeError:
+                # The client's event loop is already closed, and its connections with it.
+                pass
+
     def model_description(self):
         return {"type": "text", "scores": True}
 
+    def _headers(self) -> Dict:
+        return {"Authorization": f"Bearer {self.api_token}"}
+
+    def _payload(self, query: str, context: List[str]) -> Dict:
+        inputs = [{"question": query, "context": c} for c in context]
+        if self.contexts_per_request == 1 and len(inputs) == 1:
+            return {"inputs": inputs[0]}
+        return {"inputs": inputs}
+
+    @staticmethod
+    def _retry_info(error: Exception):
+        if isinstance(error, (requests.ConnectionError, requests.Timeout, httpx.TransportError)):
+            return None, None
+        if isinstance(error, (requests.HTTPError, httpx.HTTPStatusError)) and is_retryable_status(
+            error.response.status_code
+        ):
+            return error.response.status_code, error.response.headers
+        return None
+
+    def _request(self, payload: Dict):
+        response = self.session.post(self.model, json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def _arequest(self, payload: Dict):
+        client = await self._aclient()
+        response = await client.post(self.model, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def _post(self, payload: Dict):
+        return call_with_retries(
+            lambda: self._request(payload), self.rate_limiter, self._retry_info, self.max_retries
+        )
+
+    async def _apost(self, payload: Dict):
+        return await acall_with_retries(
+            lambda: self._arequest(payload), self.rate_limiter, self._retry_info, self.max_retries
+        )
+
+    def _groups(self, context: List[str]) -> List[List[str]]:
+        size = max(self.contexts_per_request, 1)
+        return [context[i : i + size] for i in range(0, len(context), size)]
+
+    def _unpack(self, result) -> List[Dict]:
+        # Single inputs are answered with a single dictionary.
+        if isinstance(result, dict):
+            return [result]
+        return result
+
     def complete(
         self,
         query: str,
@@ -46,12 +178,16 @@ class HFEndPointQAModel(BaseModel):
         task_description: Optional[str] = None,
         system_prompt: Optional[str] = None,
     ):
-        input = {"question": query, "context": context}
-        payload = {"inputs": input}
+        return self._unpack(self._post(self._payload(query, [context])))[0]
 
-        headers = {"Authorization": f"Bearer {self.api_token}"}
-        response = requests.post(self.model, headers=headers, json=payload)
-        return response.json()
+    async def acomplete(
+        self,
+        query: str,
+        context: str,
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ):
+        return self._unpack(await self._apost(self._payload(query, [context])))[0]
 
     def batch_complete_with_scores(
         self,
@@ -60,13 +196,31 @@ class HFEndPointQAModel(BaseModel):
         task_description: Optional[str] = None,
         system_prompt: Optional[str] = None,
     ) -> List[Dict]:
-        all_results = []
-        for c in context:
-            result = self.complete(
-                query=query,
-                context=c,
-                task_description=task_description,
-                system_prompt=system_prompt,
-            )
-            all_results.append(result)
-        return all_results
+        """Sends chunks in requests of contexts_per_request, with up to max_concurrency requests in flight.
+
+        Returns:
+            List[Dict]: A list of dictionaries like {'score':confidence_score, 'answer':answer_text}
+        """
+        group_results = thread_map(
+            lambda group: self._unpack(self._post(self._payload(query, group))),
+            self._groups(context),
+            max_workers=self.max_concurrency,
+        )
+        return [result for group in group_results for result in group]
+
+    async def abatch_complete_with_scores(
+        self,
+        query: str,
+        context: List[str],
+        task_description: Optional[str] = None,
+        system_prompt: Optional[str] = None,
+    ) -> List[Dict]:
+        """Async version of `batch_complete_with_scores`. All chunks are sent concurrently over one pooled
+        client, bounded by max_concurrency connections."""
+        group_results = await asyncio.gather(
+            *[
+                self._apost(self._payload(query, group))
+                for group in self._groups(context)
+            ]
+        )
+        return [result for group in group_results for result in self._unpack(group)]
@@ -1,9 +1,57 @@
 from .base import BaseModel
 from typing import Dict, List, Optional
+import random
+import threading
+import time
+
 import numpy as np
 
 
-class MockModel(BaseModel):
+class _SimulatedModel(BaseModel):
+    def __init__(
+        self,
+        model: Optional[str] = None,
+        temperature: float = 0.0,
+        max_tokens: int = 1_000,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        failure_rate: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        """Mock model answering with the chunk itself, with simulated API behaviour for tests and benchmarks.
+
+        Args:
+            latency (float, optional): Seconds every call takes. Defaults to 0.0.
+            jitter (float, optional): Uniformly random extra seconds per call, up to this value. Defaults to 0.0.
+            failure_rate (float, optional): Probability that a call raises a RuntimeError. Defaults to 0.0.
+            seed (Optional[int], optional): Seed for jitter and failures. Defaults to None.
+        """
+        super().__init__(model=model, temperature=temperature, max_tokens=max_tokens)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.call_count = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _simulate_call(self):
+        with self._lock:
+            self.call_count += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.failure_rate
+        if delay > 0:
+            time.sleep(delay)
+        if failed:
+            raise RuntimeError("Simulated model failure")
 
     def complete(
         self,
@@ -12,8 +60,12 @@ class MockModel(BaseModel):
         task_description: Optional[str] = None,
         system_prompt: Optional[str] = None,
     ):
+        self._simulate_call()
         return context.replace("\n", "")
 
+
+class MockModel(_SimulatedModel):
+
     def model_description(self):
         return {"type": "text", "scores": False}
 
@@ -30,16 +82,7 @@ class MockModel(BaseModel):
         return results
 
 
-class MockModelWithScores(BaseModel):
-
-    def complete(
-        self,
-        query: str,
-        context: str,
-        task_description: Optional[str] = None,
-        system_prompt: Optional[str] = None,
-    ):
-        return context.replace("\n", "")
+class MockModelWithScores(_SimulatedModel):
 
     def model_description(self):
         return {"type": "text", "scores": True}
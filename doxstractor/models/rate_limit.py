@@ -0,0 +1,295 @@
+from .. import tracing
+from typing import Any, Awaitable, Callable, Optional, Tuple
+import asyncio
+import random
+import threading
+import time
+
+
+# Status codes worth retrying besides rate limits: timeouts, conflicts and server errors / overload.
+RETRY_STATUS_CODES = {408, 409}
+
+
+def is_retryable_status(status_code: int) -> bool:
+    return (
+        status_code == 429 or status_code in RETRY_STATUS_CODES or status_code >= 500
+    )
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """Exponential backoff with full jitter.
+
+    Args:
+        attempt (int): Number of the failed attempt, starting at 0.
+        base (float, optional): Delay scale in seconds. Defaults to 1.0.
+        cap (float, optional): Maximum delay in seconds. Defaults to 60.0.
+
+    Returns:
+        float: Seconds to wait before the next attempt.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Reads the retry-after header (in seconds) of a response, None if it is missing or invalid."""
+    if headers is None:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        return None
+
+
+# Returns (status code, response headers) for a failed request which may be retried, with a None status
+# code for connection errors and timeouts, or None if the error can't be retried.
+RetryInfo = Callable[[Exception], Optional[Tuple[Optional[int], Any]]]
+
+
+def _retry_delay(
+    rate_limiter: "RateLimiter", status_code: Optional[int], headers, attempt: int
+) -> float:
+    retry_after = parse_retry_after(headers)
+    delay = retry_after if retry_after is not None else backoff_delay(attempt)
+    if status_code == 429:
+        # Pause everyone sharing the rate limiter, not just this request.
+        rate_limiter.pause(delay)
+        return 0.0
+    return delay
+
+
+def call_with_retries(
+    request: Callable[[], Any],
+    rate_limiter: "RateLimiter",
+    retry_info: RetryInfo,
+    max_retries: int,
+    tokens: float = 0,
+):
+    """Sends a request through the rate limiter and retries failures with jittered exponential backoff.
+
+    A rate limited request (status 429) pauses everyone sharing the limiter for the retry-after time, other
+    retryable errors wait for retry-after or the backoff delay. Every retry is added to the active tracing
+    span.
+
+    Args:
+        request (Callable[[], Any]): Sends the request once and returns the answer, or raises.
+        rate_limiter (RateLimiter): Limiter to acquire a slot from for every attempt.
+        retry_info (RetryInfo): Tells retryable errors apart, see `RetryInfo`.
+        max_retries (int): Retries after the first attempt.
+        tokens (float, optional): Estimated tokens of the request. Defaults to 0.
+
+    Returns:
+        The result of request.
+    """
+    for attempt in range(max_retries + 1):
+        info = None
+        rate_limiter.acquire(tokens)
+        try:
+            return request()
+        except Exception as e:
+            info = retry_info(e)
+            if info is None or attempt >= max_retries:
+                raise
+        finally:
+            # Always free the slot, also for unexpected errors, or the limiter runs out of slots.
+            rate_limiter.release(throttled=info is not None and info[0] == 429)
+        time.sleep(_retry_delay(rate_limiter, info[0], info[1], attempt))
+        tracing.add(retries=1)
+
+
+class _Retry:
+    def __init__(self, status_code: Optional[int], headers) -> None:
+        self.status_code = status_code
+        self.headers = headers
+
+
+async def acall_with_retries(
+    request: Callable[[], Awaitable],
+    rate_limiter: "RateLimiter",
+    retry_info: RetryInfo,
+    max_retries: int,
+    tokens: float = 0,
+    semaphore: Optional[asyncio.Semaphore] = None,
+):
+    """Async version of `call_with_retries`.
+
+    Args:
+        semaphore (Optional[asyncio.Semaphore], optional): Held for each attempt, not while waiting to
+            retry. Defaults to None.
+    """
+    for attempt in range(max_retries + 1):
+        if semaphore is None:
+            info = await _aattempt(request, rate_limiter, retry_info, max_retries, tokens, attempt)
+        else:
+            async with semaphore:
+                info = await _aattempt(request, rate_limiter, retry_info, max_retries, tokens, attempt)
+        if not isinstance(info, _Retry):
+            return info
+        await asyncio.sleep(_retry_delay(rate_limiter, info.status_code, info.headers, attempt))
+        tracing.add(retries=1)
+
+
+async def _aattempt(request, rate_limiter, retry_info, max_retries: int, tokens: float, attempt: int):
+    """One attempt of `acall_with_retries`. Returns the result, or a `_Retry` if it should be retried."""
+    info = None
+    await rate_limiter.aacquire(tokens)
+    try:
+        return await request()
+    except Exception as e:
+        info = retry_info(e)
+        if info is None or attempt >= max_retries:
+            raise
+        return _Retry(*info)
+    finally:
+        # Also runs when the request is cancelled.
+        rate_limiter.release(throttled=info is not None and info[0] == 429)
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        max_concurrency: Optional[int] = None,
+        initial_concurrency: Optional[int] = None,
+    ) -> None:
+        """Token bucket rate limiter with adaptive concurrency, meant to be shared by all models calling
+        the same API in a process.
+
+        Requests and tokens refill continuously at the configured per-minute rates. When the API throttles
+        a request, the allowed concurrency is halved and everyone sharing the limiter pauses for the
+        retry-after time. Every successful request raises the allowed concurrency again, up to max_concurrency.
+
+        Args:
+            requests_per_minute (Optional[float], optional): Request budget. Defaults to None (unlimited).
+            tokens_per_minute (Optional[float], optional): Token budget. Defaults to None (unlimited).
+            max_concurrency (Optional[int], optional): Maximum requests in flight. Defaults to None (unlimited).
+            initial_concurrency (Optional[int], optional): Requests in flight allowed at the start, ramped up
+                adaptively. Defaults to max_concurrency.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrency = max_concurrency
+        self.concurrency_limit = float(initial_concurrency or max_concurrency or 0)
+        self._requests = requests_per_minute or 0.0
+        self._tokens = tokens_per_minute or 0.0
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.requests_per_minute:
+            self._requests = min(
+                self.requests_per_minute,
+                self._requests + elapsed * self.requests_per_minute / 60,
+            )
+        if self.tokens_per_minute:
+            self._tokens = min(
+                self.tokens_per_minute,
+                self._tokens + elapsed * self.tokens_per_minute / 60,
+            )
+
+    def _try_acquire(self, tokens: float) -> float:
+        """Takes a request slot if possible. Returns 0 on success, otherwise the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.max_concurrency and self._in_flight >= max(
+                int(self.concurrency_limit), 1
+            ):
+                return 0.05
+
+            self._refill(now)
+            wait = 0.0
+            if self.requests_per_minute and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60 / self.requests_per_minute)
+            if self.tokens_per_minute:
+                # Requests larger than the whole budget only wait for a full bucket.
+                tokens = min(tokens, self.tokens_per_minute)
+                if self._tokens < tokens:
+                    wait = max(
+                        wait, (tokens - self._tokens) * 60 / self.tokens_per_minute
+                    )
+            if wait > 0:
+                return wait
+
+            if self.requests_per_minute:
+                self._requests -= 1
+            if self.tokens_per_minute:
+                self._tokens -= tokens
+            self._in_flight += 1
+            return 0.0
+
+    def acquire(self, tokens: float = 0):
+        """Blocks until a request using about `tokens` tokens may be sent. Pair with `release`."""
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def aacquire(self, tokens: float = 0):
+        """Async version of `acquire`."""
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
+
+    def release(self, throttled: bool = False):
+        """Frees the request slot and adapts the allowed concurrency.
+
+        Args:
+            throttled (bool, optional): The API rejected the request because of rate limits. Defaults to False.
+        """
+        with self._lock:
+            self._in_flight -= 1
+            if not self.max_concurrency:
+                return
+            if throttled:
+                self.concurrency_limit = max(1.0, self.concurrency_limit / 2)
+            else:
+                self.concurrency_limit = min(
+                    float(self.max_concurrency),
+                    self.concurrency_limit + 1 / max(self.concurrency_limit, 1.0),
+                )
+
+    def record_tokens(self, tokens: float):
+        """Charges tokens which were not known at `acquire` time, e.g. after reading the usage of a response."""
+        if self.tokens_per_minute:
+            with self._lock:
+                self._tokens -= tokens
+
+    def pause(self, seconds: float):
+        """Stops everyone sharing the limiter from sending requests for the given time."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+_default_rate_limiter = RateLimiter()
+
+
+def get_default_rate_limiter() -> RateLimiter:
+    """The rate limiter shared by all models which were not given their own."""
+    return _default_rate_limiter
+
+
+def set_default_rate_limiter(rate_limiter: RateLimiter):
+    """Replaces the rate limiter shared by all models which were not given their own."""
+    global _default_rate_limiter
+    _default_rate_limiter = rate_limiter
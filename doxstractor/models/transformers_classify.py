@@ -1,20 +1,122 @@
 from .base import BaseModel
+from ..chunking import TokenChunker
 from transformers import pipeline
 from typing import Dict, Optional, List
-import numpy as np
+import threading
+
+import torch
 
 
 class TransformerClassifierModel(BaseModel):
     def __init__(
-        self, model: str, temperature: float = 0, max_tokens: int = 1000
+        self,
+        model: str,
+        temperature: float = 0,
+        max_tokens: int = 1000,
+        hypothesis_template: str = "This example is {}.",
+        batch_size: int = 16,
+        max_hypothesis_len: int = 32,
     ) -> None:
+        """Zero shot classification with a huggingface NLI model.
+
+        Args:
+            model (str): Huggingface model name.
+            temperature (float, optional): For compatibility reasons only. Defaults to 0.
+            max_tokens (int, optional): For compatibility reasons only. Defaults to 1000.
+            hypothesis_template (str, optional): Turns a category into an NLI hypothesis. Defaults to "This example is {}.".
+            batch_size (int, optional): Number of (chunk, hypothesis) pairs per forward pass. Defaults to 16.
+            max_hypothesis_len (int, optional): Tokens reserved for a category hypothesis by the default
+                chunker. Defaults to 32.
+        """
         super().__init__(model, temperature, max_tokens)
 
         self.classifier = pipeline("zero-shot-classification", model=model)
+        self.hypothesis_template = hypothesis_template
+        self.batch_size = batch_size
+        self.max_hypothesis_len = max_hypothesis_len
+        # Tokenized hypotheses per (template, categories), reused across documents.
+        self._hypothesis_ids = {}
+        self._hypothesis_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_hypothesis_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._hypothesis_lock = threading.Lock()
+
+    def default_chunker(self) -> TokenChunker:
+        """Chunks with the model's tokenizer so that a chunk and a category hypothesis fit into one forward
+        pass, and no text is truncated."""
+        tokenizer = self.classifier.tokenizer
+        # Keep a small margin since a chunk may tokenize slightly differently once paired with the hypothesis.
+        premise_tokens = (
+            self._max_length()
+            - self.max_hypothesis_len
+            - tokenizer.num_special_tokens_to_add(pair=True)
+            - 2
+        )
+        return TokenChunker(tokenizer, max_tokens=premise_tokens)
 
     def model_description(self):
         return {"type": "classifier", "scores": True}
 
+    def _hypotheses(self, categories: List[str]) -> List[List[int]]:
+        key = (self.hypothesis_template, tuple(categories))
+        with self._hypothesis_lock:
+            if key not in self._hypothesis_ids:
+                self._hypothesis_ids[key] = self.classifier.tokenizer(
+                    [self.hypothesis_template.format(c) for c in categories],
+                    add_special_tokens=False,
+                )["input_ids"]
+            return self._hypothesis_ids[key]
+
+    def _max_length(self) -> int:
+        max_length = self.classifier.tokenizer.model_max_length
+        # Tokenizers without a configured limit report a huge sentinel value.
+        return max_length if max_length < 100_000 else 512
+
+    def _pair_input(self, premise_ids: List[int], hypothesis_ids: List[int]) -> Dict:
+        tokenizer = self.classifier.tokenizer
+        max_premise = (
+            self._max_length()
+            - len(hypothesis_ids)
+            - tokenizer.num_special_tokens_to_add(pair=True)
+        )
+        premise_ids = premise_ids[:max_premise]
+        pair = {
+            "input_ids": tokenizer.build_inputs_with_special_tokens(
+                premise_ids, hypothesis_ids
+            )
+        }
+        if "token_type_ids" in tokenizer.model_input_names:
+            pair["token_type_ids"] = tokenizer.create_token_type_ids_from_sequences(
+                premise_ids, hypothesis_ids
+            )
+        return pair
+
+    def _nli_logits(self, pairs: List[Dict]) -> torch.Tensor:
+        """Runs all pairs through the model in length sorted batches, returns the (contradiction, entailment)
+        logits of each pair."""
+        model = self.classifier.model
+        entailment_id = self.classifier.entailment_id
+        # Like the zero shot pipeline: contradiction is the first label, unless that is entailment.
+        contradiction_id = -1 if entailment_id == 0 else 0
+        order = sorted(range(len(pairs)), key=lambda i: len(pairs[i]["input_ids"]))
+        logits = torch.empty(len(pairs), 2)
+        for start in range(0, len(order), self.batch_size):
+            batch_idx = order[start : start + self.batch_size]
+            batch = self.classifier.tokenizer.pad(
+                [pairs[i] for i in batch_idx], return_tensors="pt"
+            )
+            batch = {k: v.to(model.device) for k, v in batch.items()}
+            with torch.no_grad():
+                output = model(**batch).logits[:, [contradiction_id, entailment_id]]
+            logits[batch_idx] = output.float().cpu()
+        return logits
+
     def complete(
         self,
         query: List[str],
@@ -22,18 +124,44 @@ class TransformerClassifierModel(BaseModel):
         task_description: Optional[str] = None,
         system_prompt: Optional[str] = None,
     ):
-        res = self.classifier(context, query)
-        best_answer_idx = np.argmax(res["scores"])
-        return res["labels"][best_answer_idx]
+        return self.batch_complete_with_scores(query, [context])[0]["answer"]
 
     def batch_complete_with_scores(
         self,
-        query: str,
+        query: List[str],
         context: List[str],
         task_description: Optional[str] = None,
         system_prompt: Optional[str] = None,
     ) -> List[Dict]:
-        # TODO: Implement this
-        return super().batch_complete_with_scores(
-            query, context, task_description, system_prompt
-        )
+        """Scores every (chunk, category hypothesis) pair with the NLI model. Each chunk is tokenized once
+        and the hypotheses once per category list, all pairs of a document run in batched forward passes.
+
+        Args:
+            query (List[str]): The categories.
+            context (List[str]): The texts to classify.
+            task_description (Optional[str], optional): Not used, only for compatibility. Defaults to None.
+            system_prompt (Optional[str], optional): Not used, only for compatibility. Defaults to None.
+
+        Returns:
+            List[Dict]: For each chunk {'score': probability, 'answer': category} of the most likely category.
+        """
+        if len(context) == 0:
+            return []
+        hypotheses = self._hypotheses(query)
+        premises = self.classifier.tokenizer(context, add_special_tokens=False)[
+            "input_ids"
+        ]
+        pairs = [self._pair_input(p, h) for p in premises for h in hypotheses]
+
+        logits = self._nli_logits(pairs)
+        if len(query) == 1:
+            # A softmax over one category is always 1, score entailment against contradiction instead.
+            probs = logits.softmax(dim=-1)[:, 1].reshape(len(context), 1)
+        else:
+            # Like the zero shot pipeline: softmax of the entailment logits over the categories.
+            probs = logits[:, 1].reshape(len(context), len(query)).softmax(dim=-1)
+        best = probs.argmax(dim=-1)
+        return [
+            {"score": float(probs[i, best[i]]), "answer": query[int(best[i])]}
+            for i in range(len(context))
+        ]
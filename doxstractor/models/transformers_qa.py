@@ -1,4 +1,5 @@
 from .base import BaseModel
+from ..chunking import TokenChunker
 from transformers import pipeline
 from typing import Optional, List, Dict
 import torch
@@ -13,16 +14,57 @@ class TransformersQAModel(BaseModel):
         na_threshold: float = 0.5,
         temperature: float = 0,
         max_tokens: int = 1000,
+        max_seq_len: int = 384,
+        max_question_len: int = 64,
+        stride: int = 0,
+        batch_size: int = 8,
     ) -> None:
+        """Extractive question answering with a huggingface pipeline.
+
+        Args:
+            model (str): Huggingface model name.
+            device (int, optional): Not used, the GPU is used when available.
+            na_threshold (float, optional): Answers scoring below this become "NA". Defaults to 0.5.
+            temperature (float, optional): For compatibility reasons only. Defaults to 0.
+            max_tokens (int, optional): For compatibility reasons only. Defaults to 1000.
+            max_seq_len (int, optional): Tokens per forward pass, capped by what the model supports. Defaults to 384.
+            max_question_len (int, optional): Tokens reserved for the question. Defaults to 64.
+            stride (int, optional): Tokens shared by consecutive chunks of the default chunker. Defaults to 0.
+            batch_size (int, optional): Number of (question, chunk) pairs per forward pass. Defaults to 8.
+        """
         super().__init__(model, temperature, max_tokens)
         device = 0 if torch.cuda.is_available() else -1
         self.pipeline = pipeline(
             "question-answering", model=model, tokenizer=model, device=device
         )
         self.na_threshold = na_threshold
+        self.max_seq_len = min(max_seq_len, self.pipeline.tokenizer.model_max_length)
+        self.max_question_len = max_question_len
+        self.stride = stride
+        self.batch_size = batch_size
+
+    def _pipeline_kwargs(self) -> Dict:
+        return dict(
+            max_seq_len=self.max_seq_len,
+            max_question_len=self.max_question_len,
+            doc_stride=self.stride,
+        )
+
+    def default_chunker(self) -> TokenChunker:
+        """Chunks with the model's tokenizer so that question and chunk fit into exactly one forward pass.
+        The pipeline never has to re-window a chunk."""
+        tokenizer = self.pipeline.tokenizer
+        # Keep a small margin since a chunk may tokenize slightly differently once paired with the question.
+        context_tokens = (
+            self.max_seq_len
+            - self.max_question_len
+            - tokenizer.num_special_tokens_to_add(pair=True)
+            - 2
+        )
+        return TokenChunker(tokenizer, max_tokens=context_tokens, stride=self.stride)
 
     def model_description(self):
-        return {"type": "text", "scores": True}
+        return {"type": "text", "scores": True, "cross_batching": True}
 
     def complete(
         self,
@@ -43,7 +85,7 @@ class TransformersQAModel(BaseModel):
             str: The extracted response.
         """
         input = {"question": query, "context": context}
-        res = self.pipeline(input)
+        res = self.pipeline(input, **self._pipeline_kwargs())
 
         if res["score"] >= self.na_threshold:
             return res["answer"]
@@ -69,9 +111,36 @@ class TransformersQAModel(BaseModel):
         Returns:
             List[Dict]: A list of dictionaries like {'score':confidence_score, 'answer':answer_text}
         """
-        all_inputs = []
-        for c in context:
-            all_inputs.append({"question": query, "context": c})
+        return self.batch_complete_many([{"query": query, "context": context}])[0]
+
+    def batch_complete_many(self, requests: List[Dict]) -> List[List[Dict]]:
+        """Answers the (query, chunk) pairs of several requests together. Pairs are sorted by length and
+        run in batches of `batch_size`, so similar lengths share a forward pass and little compute is spent
+        on padding. Results are scattered back to their requests.
 
-        all_results = self.pipeline(all_inputs)
+        Args:
+            requests (List[Dict]): Each with a query and a list of contexts.
+
+        Returns:
+            List[List[Dict]]: For each request a list of dictionaries like {'score':confidence_score, 'answer':answer_text}
+        """
+        pairs = [
+            (request_idx, chunk_idx, {"question": r["query"], "context": c})
+            for request_idx, r in enumerate(requests)
+            for chunk_idx, c in enumerate(r["context"])
+        ]
+        pairs.sort(key=lambda p: len(p[2]["question"]) + len(p[2]["context"]))
+
+        all_results = [[None] * len(r["context"]) for r in requests]
+        if len(pairs) == 0:
+            return all_results
+
+        outputs = self.pipeline(
+            [p[2] for p in pairs], batch_size=self.batch_size, **self._pipeline_kwargs()
+        )
+        # The pipeline unwraps single inputs.
+        if isinstance(outputs, dict):
+            outputs = [outputs]
+        for (request_idx, chunk_idx, _), output in zip(pairs, outputs):
+            all_results[request_idx][chunk_idx] = output
         return all_results
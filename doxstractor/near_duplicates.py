@@ -0,0 +1,255 @@
+from .chunking import Chunk, Chunker
+from typing import Any, List, Optional, Tuple
+import collections
+import hashlib
+import re
+import threading
+
+import numpy as np
+
+
+_PRIME = (1 << 31) - 1
+_WORD = re.compile(r"\w+")
+_SIGNATURE_BLOCK = 1_024  # Shingles hashed at once, bounds the memory of a signature
+_ALIGN_SLACK = 10_000  # Characters a reference chunk may move in a near duplicate and still be found
+
+
+class MinHashIndex:
+    def __init__(
+        self,
+        num_perm: int = 128,
+        bands: int = 32,
+        shingle_size: int = 5,
+        threshold: float = 0.8,
+        seed: int = 0,
+        max_references: Optional[int] = 10_000,
+    ) -> None:
+        """MinHash signatures of word shingles with an LSH index, to find documents which are near
+        duplicates of documents seen before.
+
+        Only documents without a near duplicate are stored as references, so for a templated corpus the
+        index holds one document per template. A reference keeps its signature and a payload chosen by the
+        caller, not the document text. Beyond max_references, the least recently matched references are
+        dropped, so memory stays bounded on corpora without templates.
+
+        Args:
+            num_perm (int, optional): Number of hash functions per signature. Defaults to 128.
+            bands (int, optional): Number of LSH bands, num_perm needs to be divisible by it. More bands find
+                less similar candidates. Defaults to 32.
+            shingle_size (int, optional): Words per shingle. Defaults to 5.
+            threshold (float, optional): Minimum estimated Jaccard similarity of a match. Defaults to 0.8.
+            seed (int, optional): Seed of the hash functions. Defaults to 0.
+            max_references (Optional[int], optional): Maximum number of references kept. Defaults to 10_000.
+
+        Raises:
+            ValueError: If num_perm is not divisible by bands.
+        """
+        if num_perm % bands != 0:
+            raise ValueError("num_perm needs to be divisible by bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        rng = np.random.RandomState(seed)
+        self._a = rng.randint(1, _PRIME, size=num_perm).astype(np.int64)
+        self._b = rng.randint(0, _PRIME, size=num_perm).astype(np.int64)
+        self.max_references = max_references
+        self._buckets = [{} for _ in range(bands)]  # band -> {band hash: [reference ids]}
+        # reference id -> (signature, payload), least recently matched first
+        self._references = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def signature(self, text: str) -> np.ndarray:
+        words = _WORD.findall(text.lower())
+        size = min(self.shingle_size, max(len(words), 1))
+        shingles = {" ".join(words[i : i + size]) for i in range(max(len(words) - size + 1, 1))}
+        hashes = np.array(
+            [
+                int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+                for s in shingles
+            ],
+            dtype=np.int64,
+        )
+        # One universal hash (a * x + b) mod p per permutation, minimum over all shingles. Shingles are
+        # hashed in blocks, so memory doesn't grow with the document.
+        signature = np.full(self.num_perm, _PRIME, dtype=np.int64)
+        for start in range(0, len(hashes), _SIGNATURE_BLOCK):
+            block = hashes[start : start + _SIGNATURE_BLOCK]
+            np.minimum(
+                signature, ((np.outer(self._a, block) + self._b[:, None]) % _PRIME).min(axis=1), out=signature
+            )
+        return signature
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in np.split(signature, self.bands)]
+
+    def _best(self, signature: np.ndarray) -> Optional[Tuple[str, float]]:
+        """The most similar reference above the threshold. Needs the lock."""
+        candidates = set()
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(buckets.get(key, []))
+        best = None
+        for ref_id in candidates:
+            similarity = float(np.mean(self._references[ref_id][0] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (ref_id, similarity)
+        return best
+
+    def query(self, text: str) -> Optional[Tuple[str, float]]:
+        """The most similar reference above the threshold.
+
+        Returns:
+            Optional[Tuple[str, float]]: (reference id, estimated Jaccard similarity), None without a match.
+        """
+        signature = self.signature(text)
+        with self._lock:
+            return self._best(signature)
+
+    def _match(self, signature: np.ndarray, touch: bool = True) -> Optional[Tuple[str, Any]]:
+        with self._lock:
+            match = self._best(signature)
+            if match is None:
+                return None
+            if touch:
+                self._references.move_to_end(match[0])
+            return match[0], self._references[match[0]][1]
+
+    def _insert(self, ref_id: str, signature: np.ndarray, payload: Any):
+        with self._lock:
+            if ref_id in self._references:
+                self._remove(ref_id)
+            self._references[ref_id] = (signature, payload)
+            for buckets, key in zip(self._buckets, self._band_keys(signature)):
+                buckets.setdefault(key, []).append(ref_id)
+            if self.max_references is not None:
+                while len(self._references) > self.max_references:
+                    self._remove(next(iter(self._references)))
+
+    def _remove(self, ref_id: str):
+        signature, _ = self._references.pop(ref_id)
+        for buckets, key in zip(self._buckets, self._band_keys(signature)):
+            buckets[key].remove(ref_id)
+            if not buckets[key]:
+                del buckets[key]
+
+    def add(self, ref_id: str, text: str, payload: Any = None):
+        """Stores a document as a reference. Only its signature and the payload are kept, not the text."""
+        self._insert(ref_id, self.signature(text), payload)
+
+    def reference(self, ref_id: str) -> Any:
+        """The payload stored with a reference."""
+        with self._lock:
+            return self._references[ref_id][1]
+
+    def match_or_add(self, text: str, payload: Any = None) -> Optional[Tuple[str, Any]]:
+        """(reference id, payload) of the closest near duplicate seen before. Documents without one are
+        added as a new reference with the given payload and None is returned."""
+        signature = self.signature(text)
+        match = self._match(signature)
+        if match is None:
+            self._insert(_document_id(text), signature, payload)
+        return match
+
+    def __len__(self):
+        return len(self._references)
+
+
+def _document_id(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class TemplateChunker(Chunker):
+    def __init__(self, chunker: Optional[Chunker] = None, index: Optional[MinHashIndex] = None) -> None:
+        """Chunks near duplicate documents like the reference document they match, so that unchanged text
+        becomes exactly the same chunks.
+
+        Chunks of the reference which appear unchanged, in order, are reused as they are. Only the text in
+        between, where the document differs, is chunked by the wrapped chunker. Combined with a
+        `CachedModel`, only the changed chunks of a templated document reach the model, the answers for
+        all other chunks come from the cache and take part in the consensus as usual.
+
+        Use one instance for all extractors of a tree, so every document is matched once and all extractors
+        get the same chunks.
+
+        Args:
+            chunker (Optional[Chunker], optional): Chunks references and changed text. Defaults to `Chunker()`.
+            index (Optional[MinHashIndex], optional): Near duplicate index. Defaults to `MinHashIndex()`.
+        """
+        self.chunker = chunker or Chunker()
+        self.index = index if index is not None else MinHashIndex()
+        # The wrapped chunker decides the size of every chunk.
+        self.max_chunk_size = getattr(self.chunker, "max_chunk_size", None)
+        self.overlap = getattr(self.chunker, "overlap", 0)
+        self.boundary = getattr(self.chunker, "boundary", None)
+
+    def config_key(self) -> Tuple:
+        # Chunks depend on the documents seen so far, so they are only shared within this instance.
+        return (type(self).__name__, id(self), self.chunker.config_key())
+
+    def split(self, doc_text: str) -> List[Chunk]:
+        signature = self.index.signature(doc_text)
+        match = self.index._match(signature)
+        if match is None:
+            chunks = self.chunker.split(doc_text)
+            # References only keep their chunk texts and offsets, which is all the alignment needs.
+            self.index._insert(_document_id(doc_text), signature, [(c.text, c.start) for c in chunks])
+            return chunks
+        return self._align(doc_text, match[1])
+
+    def preview(self, doc_text: str) -> List[Chunk]:
+        # Neither adds the document as a reference nor marks its match as recently used.
+        match = self.index._match(self.index.signature(doc_text), touch=False)
+        if match is None:
+            return self.chunker.split(doc_text)
+        return self._align(doc_text, match[1])
+
+    def _align(self, doc_text: str, ref_chunks: List[Tuple[str, int]]) -> List[Chunk]:
+        """Reuses the reference chunks found unchanged in the document and chunks the text in between.
+
+        A reference chunk is only looked for near its offset in the reference, shifted like the last chunk
+        found, so edited documents are aligned in linear time.
+        """
+        chunks = []
+        pos = 0  # End of the text covered so far
+        search_from = 0  # Reference chunks may overlap, so the next one can start before pos
+        shift = 0  # Offset in the document minus offset in the reference, of the last chunk found
+        for ref_text, ref_start in ref_chunks:
+            if not ref_text.strip():
+                continue
+            expected = ref_start + shift
+            found = doc_text.find(
+                ref_text,
+                max(search_from, expected - _ALIGN_SLACK),
+                max(expected + len(ref_text) + _ALIGN_SLACK, 0),
+            )
+            if found < 0:
+                continue
+            shift = found - ref_start
+            chunks.extend(self._split_gap(doc_text, pos, found))
+            chunks.append(Chunk(ref_text, found, found + len(ref_text)))
+            search_from = found + 1
+            pos = max(pos, found + len(ref_text))
+        chunks.extend(self._split_gap(doc_text, pos, len(doc_text)))
+        if len(chunks) == 0:
+            chunks.append(Chunk(doc_text, 0, len(doc_text)))
+        return chunks
+
+    def _split_gap(self, doc_text: str, start: int, end: int) -> List[Chunk]:
+        """Chunks the changed text between two reused chunks."""
+        gap = doc_text[start:end]
+        if not gap.strip():
+            return []
+        return [
+            Chunk(chunk.text, start + chunk.start, start + chunk.end)
+            for chunk in self.chunker.split(gap)
+            if chunk.text.strip()
+        ]
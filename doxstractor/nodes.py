@@ -1,12 +1,85 @@
 from __future__ import annotations
-from .extractors import BaseExtractor, CategoryExtractor
-from typing import Dict, Optional, List
+from .extractors import (
+    BaseExtractor,
+    BatchedExtractor,
+    CategoryExtractor,
+    FusedExtractor,
+)
+from .extractors.batched import batching_key
+from .extractors.fused import fusion_key
+from .models.anthropic_batch import PendingResults
+from .plan import ExecutionPlan
+from . import tracing
+from .utils import thread_map
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from typing import Callable, Dict, Iterable, Iterator, NamedTuple, Optional, List, Sequence, Union
+import asyncio
 import collections
+import collections.abc
+import contextvars
+import threading
+
+
+class DocumentResult(NamedTuple):
+    """Result of one document in `Node.extract_many`."""
+
+    index: int  # Position of the document in the input iterable
+    result: Optional[Dict]  # {node_name: node_result}, None if extraction failed
+    error: Optional[BaseException]  # The exception raised for this document, if any
+
+
+class _BranchCancelled(Exception):
+    """Raised in a losing speculative branch to stop it before its next extractor call."""
+
+
+class _Branch:
+    def __init__(self, parent: Optional[_Branch]) -> None:
+        """A speculatively started branch, shared by every node below it through `_current_branch`.
+
+        Args:
+            parent (Optional[_Branch]): The branch this one was started in, if any. Cancelling it cancels
+                this branch too.
+        """
+        self.parent = parent
+        self.cancelled = threading.Event()
+        self.records = []  # (node, result, categories), recorded once the branch wins
+
+    def is_cancelled(self) -> bool:
+        return self.cancelled.is_set() or (self.parent is not None and self.parent.is_cancelled())
+
+    def commit(self):
+        """Records the speculation of the branch's nodes, in the context of the node which started it."""
+        for node, result, categories in self.records:
+            node._record_speculation(result, categories)
+
+
+_current_branch: contextvars.ContextVar[Optional[_Branch]] = contextvars.ContextVar(
+    "speculative_branch", default=None
+)
+
+
+def _raise_if_cancelled():
+    branch = _current_branch.get()
+    if branch is not None and branch.is_cancelled():
+        raise _BranchCancelled()
 
 
 class Node:
     def __init__(
-        self, extractor: BaseExtractor, children: Optional[Dict[str, List[Node]]] = None
+        self,
+        extractor: BaseExtractor,
+        children: Optional[Dict[str, List[Node]]] = None,
+        max_workers: int = 1,
+        fuse_queries: bool = False,
+        batch_queries: bool = False,
+        speculate: Optional[str] = None,
+        speculative_branches: int = 1,
     ) -> None:
         """A node is an element of a tree which has one or multiple children. Depending on the results of the extractor,
         it recursively calls all the child nodes corresponding to the result.
@@ -32,14 +105,55 @@ class Node:
             extractor (BaseExtractor): The extractor at the root of the node.
             children (Optional[Dict[str, List[Node]]], optional): Dictionary where key is a category of the
                 root node and value is a list of nodes. Defaults to None.
+            max_workers (int, optional): Maximum number of sibling child nodes extracted concurrently.
+                Results are always merged in the order of the child list. Defaults to 1 (sequential).
+            fuse_queries (bool, optional): Answer sibling extractors which share a text model and chunking
+                with one JSON prompt per chunk instead of one prompt per extractor. Extractors with early
+                stopping or a retriever and nodes which speculate are not fused. The fused model call is
+                traced in this node's span, each fused node gets its own span for its children.
+                Defaults to False.
+            batch_queries (bool, optional): Send the (query, chunk) pairs of all sibling extractors sharing a
+                model which supports cross batching (e.g. `TransformersQAModel`) in one call. Nodes which
+                speculate are not batched. Defaults to False.
+            speculate (Optional[str], optional): Start the children of the most probable categories while the
+                node's own extractor is still running. "frequency" ranks categories by how often this node
+                returned them before, "first_chunk" asks the model about the first chunk only and speculates
+                on that answer. Branches which lose are cancelled in `aextract`, in `extract` they stop
+                before their next extractor call, anywhere in the subtree. Stats of nodes in losing
+                branches are not recorded. Trades extra model calls for lower latency.
+                Defaults to None (children start once the category is known).
+            speculative_branches (int, optional): Maximum number of branches started speculatively with
+                "frequency". Defaults to 1.
         """
 
         self.extractor = extractor
         self.children = children
+        self.max_workers = max_workers
+        self.fuse_queries = fuse_queries
+        self.batch_queries = batch_queries
+        self.speculate = speculate
+        self.speculative_branches = speculative_branches
+        self.category_counts = collections.Counter()  # Results seen by a speculating node
+        self.speculation_stats = collections.Counter()  # started, hits, discarded
+        self._speculation_lock = threading.Lock()
         self.validate()
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_speculation_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._speculation_lock = threading.Lock()
+
     def validate(self):
         """Ensures the node is valid."""
+        if self.speculate not in (None, "frequency", "first_chunk"):
+            raise ValueError(
+                f"Unknown speculate mode {self.speculate}, use 'frequency' or 'first_chunk'"
+            )
+
         if self.children:
             # Ensure only a category extractor gets children
             if not (isinstance(self.extractor, CategoryExtractor)):
@@ -61,6 +175,11 @@ class Node:
                     f"Duplicate node name. All node names need to be unique. Duplicates are {duplicates}"
                 )
 
+    def compile(self) -> ExecutionPlan:
+        """Compiles the tree into an `ExecutionPlan`, which merges identical chunking and model work across
+        branches and shows what a document costs before running it."""
+        return ExecutionPlan(self)
+
     def extract(self, doc_text: str) -> Dict:
         """Recursively runs all extractors
 
@@ -71,8 +190,92 @@ class Node:
             Dict: {node_name: node_result}
         """
 
-        # Run Extraction on own extractor
-        result = self.extractor.extract(doc_text)
+        with tracing.span(tracing.NODE, self.extractor.name):
+            _raise_if_cancelled()
+            if self.speculate and self.children:
+                return self._extract_speculative(doc_text)
+            # Run Extraction on own extractor
+            result = self.extractor.extract(doc_text)
+            return self._extract_children(result, doc_text)
+
+    def _speculated_categories(self, doc_text: str) -> List[str]:
+        """The categories whose children are started before the node's own result is known."""
+        if self.speculate == "first_chunk":
+            chunks = self.extractor._select_chunks(doc_text)
+            if len(chunks) <= 1:
+                # The full extraction costs the same as a guess on the first chunk.
+                return []
+            guess = self.extractor._resolve(self.extractor._run_model(chunks[:1]))
+            return [guess] if guess in self.children else []
+
+        with self._speculation_lock:
+            counts = self.category_counts.copy()
+        ranked = sorted(
+            [category for category in self.children if counts[category] > 0],
+            key=lambda category: -counts[category],
+        )
+        return ranked[: self.speculative_branches]
+
+    def _record_speculation(self, result, categories: List[str]):
+        branch = _current_branch.get()
+        if branch is not None:
+            # Only the winning branch gets recorded, by the node which started it.
+            branch.records.append((self, result, categories))
+            return
+        with self._speculation_lock:
+            self.category_counts[result] += 1
+            self.speculation_stats["started"] += len(categories)
+            self.speculation_stats["hits"] += int(result in categories)
+            self.speculation_stats["discarded"] += len(categories) - int(result in categories)
+
+    def _extract_speculative(self, doc_text: str) -> Dict:
+        categories = self._speculated_categories(doc_text)
+        _raise_if_cancelled()
+        if not categories:
+            result = self.extractor.extract(doc_text)
+            self._record_speculation(result, categories)
+            return self._extract_children(result, doc_text)
+
+        branches = {category: _Branch(_current_branch.get()) for category in categories}
+        # Leaving the executor waits for the losing branches, which stop before their next extractor call.
+        with ThreadPoolExecutor(max_workers=len(categories)) as executor:
+            futures = {
+                category: executor.submit(
+                    contextvars.copy_context().run, self._run_branch, branch, category, doc_text
+                )
+                for category, branch in branches.items()
+            }
+            try:
+                result = self.extractor.extract(doc_text)
+            except BaseException:
+                for branch in branches.values():
+                    branch.cancelled.set()
+                raise
+            for category, branch in branches.items():
+                if category != result:
+                    branch.cancelled.set()
+
+        self._record_speculation(result, categories)
+        if result not in branches:
+            return self._extract_children(result, doc_text)
+        result_dict = futures[result].result()
+        branches[result].commit()
+        return result_dict
+
+    def _run_branch(self, branch: _Branch, category: str, doc_text: str) -> Dict:
+        _current_branch.set(branch)
+        return self._extract_children(category, doc_text)
+
+    def _extract_children(self, result, doc_text: str) -> Dict:
+        """Runs the children selected by the result of the node's own extractor.
+
+        Args:
+            result: Result of `self.extractor`.
+            doc_text (str): Document text from which to extract.
+
+        Returns:
+            Dict: {node_name: node_result}
+        """
         result_dict = {self.extractor.name: result}
 
         if self.children and (result in self.children.keys()):
@@ -80,10 +283,313 @@ class Node:
             # We will assume there is a category since we validated that earlier
             # We also assume that categorical extractors only return valid categories.
             child_list = self.children[result]
-            for child_node in child_list:
-                result_dict.update(child_node.extract(doc_text))
+            # Siblings have unique names and only read doc_text, so they can run independently.
+            child_results = thread_map(
+                lambda child: child.extract(doc_text),
+                self._child_groups(child_list),
+                max_workers=self.max_workers,
+            )
+            for child_result in child_results:
+                result_dict.update(child_result)
+        return result_dict
+
+    async def _aextract_children(self, result, doc_text: str) -> Dict:
+        """Async version of `_extract_children`."""
+        result_dict = {self.extractor.name: result}
+
+        if self.children and (result in self.children.keys()):
+            child_results = await asyncio.gather(
+                *[
+                    child.aextract(doc_text)
+                    for child in self._child_groups(self.children[result])
+                ]
+            )
+            for child_result in child_results:
+                result_dict.update(child_result)
+        return result_dict
+
+    def _child_groups(self, child_list: List[Node]) -> List:
+        """Replaces siblings which can share model calls by a `_GroupedNodes` group, if `fuse_queries` or
+        `batch_queries` is set. Groups take the place of their first member."""
+        if not (self.fuse_queries or self.batch_queries):
+            return child_list
+
+        groups = collections.OrderedDict()
+        for i, child_node in enumerate(child_list):
+            key = ("single", i)
+            # A speculating node starts its children while its own extractor runs, so it runs alone.
+            groupable = not (child_node.speculate and child_node.children)
+            if groupable and self.fuse_queries and fusion_key(child_node.extractor) is not None:
+                key = ("fused", fusion_key(child_node.extractor))
+            elif groupable and self.batch_queries and batching_key(child_node.extractor) is not None:
+                key = ("batched", batching_key(child_node.extractor))
+            groups.setdefault(key, []).append(child_node)
+
+        child_groups = []
+        for key, nodes in groups.items():
+            extractors = [node.extractor for node in nodes]
+            if len(nodes) == 1:
+                child_groups.append(nodes[0])
+            elif key[0] == "fused":
+                child_groups.append(_GroupedNodes(nodes, FusedExtractor(extractors)))
+            else:
+                child_groups.append(_GroupedNodes(nodes, BatchedExtractor(extractors)))
+        return child_groups
+
+    async def aextract(self, doc_text: str) -> Dict:
+        """Async version of `extract`. Child nodes of the selected category run concurrently.
+
+        Args:
+            doc_text (str): Document text from which to extract.
+
+        Returns:
+            Dict: {node_name: node_result}
+        """
+        with tracing.span(tracing.NODE, self.extractor.name):
+            if self.speculate and self.children:
+                return await self._aextract_speculative(doc_text)
+            result = await self.extractor.aextract(doc_text)
+            return await self._aextract_children(result, doc_text)
+
+    async def _aspeculated_categories(self, doc_text: str) -> List[str]:
+        """Async version of `_speculated_categories`."""
+        if self.speculate == "first_chunk":
+            chunks = self.extractor._select_chunks(doc_text)
+            if len(chunks) <= 1:
+                return []
+            guess = self.extractor._resolve(await self.extractor._arun_model(chunks[:1]))
+            return [guess] if guess in self.children else []
+        return self._speculated_categories(doc_text)
+
+    async def _aextract_speculative(self, doc_text: str) -> Dict:
+        """Async version of `_extract_speculative`. Losing branches are cancelled."""
+        categories = await self._aspeculated_categories(doc_text)
+        branches = {category: _Branch(_current_branch.get()) for category in categories}
+        tasks = {
+            category: asyncio.ensure_future(self._arun_branch(branch, category, doc_text))
+            for category, branch in branches.items()
+        }
+        for task in tasks.values():
+            # Errors of losing branches are never awaited, retrieve them so asyncio doesn't warn.
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+        try:
+            result = await self.extractor.aextract(doc_text)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        self._record_speculation(result, categories)
+        for category, task in tasks.items():
+            if category != result:
+                task.cancel()
+        if result not in tasks:
+            return await self._aextract_children(result, doc_text)
+        result_dict = await tasks[result]
+        branches[result].commit()
+        return result_dict
+
+    async def _arun_branch(self, branch: _Branch, category: str, doc_text: str) -> Dict:
+        # Tasks run in a copy of the context, so the branch is only set for this task.
+        _current_branch.set(branch)
+        return await self._aextract_children(category, doc_text)
+
+    def extract_many(
+        self,
+        docs: Iterable[str],
+        max_workers: int = 4,
+        backend: str = "thread",
+        ordered: bool = True,
+        max_pending: Optional[int] = None,
+    ) -> Iterator[DocumentResult]:
+        """Runs the tree over a corpus and yields a result per document as soon as it is available.
+
+        Documents are pulled lazily from `docs`. At most `max_pending` documents are in flight or waiting
+        to be yielded at any time, so memory does not grow with the size of the corpus. A failing document
+        is reported through `DocumentResult.error` and does not abort the run.
+
+        Args:
+            docs (Iterable[str]): Document texts, may be a lazy iterator.
+            max_workers (int, optional): Number of worker threads or processes. Defaults to 4.
+            backend (str, optional): "thread" or "process". The process backend pickles the node once
+                per worker, so all models in the tree need to be picklable. Defaults to "thread".
+            ordered (bool, optional): Yield results in input order. Otherwise results are yielded in
+                completion order. Defaults to True.
+            max_pending (Optional[int], optional): Maximum number of documents held at once.
+                Defaults to 2 * max_workers.
+
+        Yields:
+            DocumentResult: (index, result, error) for every document.
+        """
+        if backend == "thread":
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+            extract_fn = self.extract
+        elif backend == "process":
+            executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_init_worker, initargs=(self,)
+            )
+            extract_fn = _extract_in_worker
+        else:
+            raise ValueError(f"Unknown backend {backend}, use 'thread' or 'process'")
+
+        max_pending = max_pending or 2 * max_workers
+        doc_iter = iter(docs)
+        pending = {}  # future -> document index
+        finished = {}  # document index -> DocumentResult, waiting to be yielded in order
+        next_index = 0
+        next_to_yield = 0
+        exhausted = False
+
+        try:
+            while True:
+                while not exhausted and len(pending) + len(finished) < max_pending:
+                    try:
+                        doc_text = next(doc_iter)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    pending[executor.submit(extract_fn, doc_text)] = next_index
+                    next_index += 1
+
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    document_result = _document_result(pending.pop(future), future)
+                    if ordered:
+                        finished[document_result.index] = document_result
+                    else:
+                        yield document_result
+
+                while next_to_yield in finished:
+                    yield finished.pop(next_to_yield)
+                    next_to_yield += 1
+        finally:
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def extract_bulk(
+        self,
+        docs: Union[Sequence[str], Callable[[], Iterable[str]]],
+        max_workers: int = 4,
+        poll_interval: float = 60.0,
+    ) -> Iterator[DocumentResult]:
+        """Runs the tree over a corpus in rounds against the Message Batches API, for trees using
+        `AnthropicBatchModel`.
+
+        Every round runs `extract_many` over the documents which are not finished yet. Chunks without a
+        stored answer are recorded by the batch models, which are then submitted as batches and polled until
+        they end. A tree of depth n finishes in about n rounds, since children only run once their parent's
+        answers are in. Open batches of a crashed run are polled before anything new is submitted.
+
+        Args:
+            docs (Union[Sequence[str], Callable[[], Iterable[str]]]): Document texts. Read once per round,
+                so pass a sequence or a function returning a fresh iterator, e.g. one reading the files.
+            max_workers (int, optional): Number of worker threads per round. Defaults to 4.
+            poll_interval (float, optional): Seconds between batch status checks. Defaults to 60.0.
+
+        Raises:
+            TypeError: If docs is an iterator or another iterable which can't be read again.
+
+        Yields:
+            DocumentResult: (index, result, error) for every document, in completion order of the rounds.
+        """
+        if not (callable(docs) or isinstance(docs, collections.abc.Sequence)):
+            raise TypeError(
+                "extract_bulk reads the documents once per round, pass a sequence or a function "
+                "returning a fresh iterator"
+            )
+        return self._extract_bulk(docs, max_workers, poll_interval)
+
+    def _extract_bulk(self, docs, max_workers: int, poll_interval: float) -> Iterator[DocumentResult]:
+        batch_models = [
+            model
+            for model in node_models(self)
+            if hasattr(model, "submit_pending")
+        ]
+        finished = set()  # Indices of documents with a result
+
+        while True:
+            for model in batch_models:
+                model.wait_for_batches(poll_interval)
+
+            indices = {}  # Position in this round -> document index, for documents in flight
+
+            def unfinished():
+                documents = enumerate(docs() if callable(docs) else docs)
+                todo = ((i, doc_text) for i, doc_text in documents if i not in finished)
+                for position, (i, doc_text) in enumerate(todo):
+                    indices[position] = i
+                    yield doc_text
+
+            waiting = 0
+            for document_result in self.extract_many(unfinished(), max_workers=max_workers):
+                index = indices.pop(document_result.index)
+                if isinstance(document_result.error, PendingResults):
+                    waiting += 1
+                    continue
+                finished.add(index)
+                yield document_result._replace(index=index)
+
+            if waiting == 0:
+                return
+            for model in batch_models:
+                model.submit_pending()
+
+
+class _GroupedNodes:
+    """Sibling nodes whose extractors are answered together by a `FusedExtractor` or `BatchedExtractor`."""
+
+    def __init__(self, nodes: List[Node], group_extractor) -> None:
+        self.nodes = nodes
+        self.group_extractor = group_extractor
+
+    def extract(self, doc_text: str) -> Dict:
+        _raise_if_cancelled()
+        results = self.group_extractor.extract(doc_text)
+        result_dict = {}
+        for node in self.nodes:
+            # The shared model call is traced once, in the parent's span. Every node still gets its own
+            # span around its children.
+            with tracing.span(tracing.NODE, node.extractor.name):
+                result_dict.update(node._extract_children(results[node.extractor.name], doc_text))
+        return result_dict
+
+    async def aextract(self, doc_text: str) -> Dict:
+        results = await self.group_extractor.aextract(doc_text)
+        child_results = await asyncio.gather(
+            *[self._anode_children(node, results[node.extractor.name], doc_text) for node in self.nodes]
+        )
+        result_dict = {}
+        for child_result in child_results:
+            result_dict.update(child_result)
         return result_dict
 
+    async def _anode_children(self, node: Node, result, doc_text: str) -> Dict:
+        with tracing.span(tracing.NODE, node.extractor.name):
+            return await node._aextract_children(result, doc_text)
+
+
+def _document_result(index: int, future: Future) -> DocumentResult:
+    try:
+        return DocumentResult(index=index, result=future.result(), error=None)
+    except Exception as e:
+        return DocumentResult(index=index, result=None, error=e)
+
+
+_worker_node = None
+
+
+def _init_worker(node: Node):
+    global _worker_node
+    _worker_node = node
+
+
+def _extract_in_worker(doc_text: str) -> Dict:
+    return _worker_node.extract(doc_text)
+
 
 def node_names(node: Node):
     names = [node.extractor.name]
@@ -93,3 +599,26 @@ def node_names(node: Node):
             for child_node in child_list:
                 names.extend(node_names(child_node))
     return names
+
+
+def node_models(node: Node) -> List:
+    """All distinct models in the tree, including models wrapped by e.g. `CachedModel` or `CascadeModel`."""
+    models = []
+    stack = [node.extractor.model]
+    while stack:
+        model = stack.pop(0)
+        models.append(model)
+        if getattr(model, "wrapped_model", None) is not None:
+            stack.append(model.wrapped_model)
+        stack.extend(getattr(model, "models", []))
+
+    if node.children:
+        for child_list in node.children.values():
+            for child_node in child_list:
+                models.extend(node_models(child_node))
+
+    unique = []
+    for model in models:
+        if not any(model is known for known in unique):
+            unique.append(model)
+    return unique
@@ -0,0 +1,259 @@
+from __future__ import annotations
+from .chunking import Chunk
+from .extractors import BaseExtractor
+from . import tracing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Dict, FrozenSet, List, Optional, Set, Tuple
+import contextvars
+import itertools
+
+if TYPE_CHECKING:
+    from .nodes import Node
+
+
+class PlanTask:
+    def __init__(self, task_id: str, kind: str, extractor: BaseExtractor, deps: List[str]) -> None:
+        """One unit of work of an `ExecutionPlan`, shared by every extractor which needs it.
+
+        Args:
+            task_id (str): Identifies the task within the plan, e.g. "model:2".
+            kind (str): `tracing.CHUNKING` to chunk the document, `tracing.MODEL` to ask the model about
+                the selected chunks.
+            extractor (BaseExtractor): The first extractor needing the task, it runs the task for all.
+            deps (List[str]): Ids of the tasks which need to finish first.
+        """
+        self.id = task_id
+        self.kind = kind
+        self.extractor = extractor
+        self.deps = deps
+        self.users = [extractor.name]  # Names of all extractors sharing the task
+
+    def run(self, doc_text: str, chunks: Optional[List[Chunk]] = None):
+        """Chunks the document, or asks the model about the chunks of the chunking task this depends on."""
+        if self.kind == tracing.CHUNKING:
+            return self.extractor._chunks(doc_text)
+        with tracing.span(tracing.EXTRACTOR, "+".join(self.users)):
+            return self.extractor._collect(doc_text, chunks)
+
+
+class PlanStep:
+    def __init__(
+        self,
+        extractor: BaseExtractor,
+        task: str,
+        parent: Optional[str],
+        category: Optional[str],
+    ) -> None:
+        """One node of the compiled tree: the extractor which resolves the answers of a model task, and
+        the branch it is on.
+
+        Args:
+            extractor (BaseExtractor): The node's extractor, it applies its own consensus.
+            task (str): Id of the model task answering the extractor.
+            parent (Optional[str]): Name of the parent extractor, None for the root.
+            category (Optional[str]): Result of the parent which selects this step.
+        """
+        self.name = extractor.name
+        self.extractor = extractor
+        self.task = task
+        self.parent = parent
+        self.category = category
+        self.children: List[PlanStep] = []
+
+    def condition(self) -> str:
+        return "always" if self.parent is None else f"{self.parent}={self.category}"
+
+
+class ExecutionPlan:
+    def __init__(self, node: Node) -> None:
+        """A tree compiled into a DAG of chunking and model tasks, with identical work merged.
+
+        Extractors with the same `task_key` (model, query, prompts, chunking, retrieval) share one model
+        task, even in different branches or at different depths, and extractors with the same chunking
+        configuration share one chunking task. Every extractor still applies its own consensus to the
+        shared answers, so results are the same as `Node.extract`. `fuse_queries` and `batch_queries` of
+        the nodes are not applied, each model task makes its own model calls.
+
+        ```python
+        plan = node.compile()
+        print(plan.describe())
+        plan.cost(doc_text)  # {"model_calls": (1, 2), "chunks": (3, 6)}
+        result = plan.execute(doc_text, max_workers=8)
+        ```
+
+        Args:
+            node (Node): The validated root node.
+        """
+        self.tasks: Dict[str, PlanTask] = {}
+        self.steps: List[PlanStep] = []  # In the order of `Node.extract` results
+        self._task_ids: Dict[Tuple, str] = {}
+        self.root = self._compile(node, None, None)
+
+    def _task(self, key: Tuple, kind: str, extractor: BaseExtractor, deps: List[str]) -> str:
+        task_id = self._task_ids.get(key)
+        if task_id is None:
+            task_id = f"{kind}:{len(self._task_ids)}"
+            self._task_ids[key] = task_id
+            self.tasks[task_id] = PlanTask(task_id, kind, extractor, deps)
+        elif extractor.name not in self.tasks[task_id].users:
+            self.tasks[task_id].users.append(extractor.name)
+        return task_id
+
+    def _compile(self, node: Node, parent: Optional[str], category: Optional[str]) -> PlanStep:
+        extractor = node.extractor
+        chunking = self._task(
+            (tracing.CHUNKING, extractor.chunker.config_key()), tracing.CHUNKING, extractor, []
+        )
+        model = self._task((tracing.MODEL,) + extractor.task_key(), tracing.MODEL, extractor, [chunking])
+        step = PlanStep(extractor, model, parent, category)
+        self.steps.append(step)
+        for child_category, child_list in (node.children or {}).items():
+            for child_node in child_list:
+                step.children.append(self._compile(child_node, step.name, child_category))
+        return step
+
+    def model_tasks(self) -> List[PlanTask]:
+        return [task for task in self.tasks.values() if task.kind == tracing.MODEL]
+
+    def _outcomes(self, step: PlanStep) -> Set[FrozenSet[str]]:
+        """The distinct sets of model tasks run for a step's subtree, one per combination of branches."""
+        if not step.children:
+            return {frozenset([step.task])}
+        by_category = {}
+        for child in step.children:
+            by_category.setdefault(child.category, []).append(child)
+        # "NA", a category without children or any other result which is no category runs no children.
+        branches = [frozenset()]
+        for children in by_category.values():
+            for combination in itertools.product(*[self._outcomes(child) for child in children]):
+                branches.append(frozenset().union(*combination))
+        return {frozenset([step.task]) | branch for branch in branches}
+
+    def cost(self, doc_text: Optional[str] = None) -> Dict[str, Tuple[int, int]]:
+        """What one document costs, as (fewest, most) over all branches the tree can take.
+
+        Args:
+            doc_text (Optional[str], optional): If given, the document is chunked (the model isn't called)
+                to also count the chunks sent to the model. With early stopping this is an upper bound.
+                Chunking uses `Chunker.preview`, so the estimate doesn't change how a `TemplateChunker`
+                chunks later documents.
+
+        Returns:
+            Dict[str, Tuple[int, int]]: "model_calls", the number of model tasks run, and "chunks", the
+                number of prompts sent, if doc_text is given.
+        """
+        outcomes = self._outcomes(self.root)
+        costs = {"model_calls": (min(map(len, outcomes)), max(map(len, outcomes)))}
+        if doc_text is not None:
+            chunkings = {
+                task.id: task.extractor.chunker.preview(doc_text)
+                for task in self.tasks.values()
+                if task.kind == tracing.CHUNKING
+            }
+            chunks = {
+                task.id: len(task.extractor._select_chunks(doc_text, chunkings[task.deps[0]]))
+                for task in self.model_tasks()
+            }
+            totals = [sum(chunks[task_id] for task_id in outcome) for outcome in outcomes]
+            costs["chunks"] = (min(totals), max(totals))
+        return costs
+
+    def describe(self) -> str:
+        """The tasks as a plain text table, with the extractors sharing them and when they run."""
+        conditions = {}
+        for step in self.steps:
+            for task_id in [step.task] + self.tasks[step.task].deps:
+                if step.condition() not in conditions.setdefault(task_id, []):
+                    conditions[task_id].append(step.condition())
+        headers = ["task", "after", "model", "query", "used_by", "runs_if"]
+        lines = []
+        for task in self.tasks.values():
+            extractor = task.extractor
+            is_model = task.kind == tracing.MODEL
+            runs_if = conditions.get(task.id, [])
+            lines.append(
+                [
+                    task.id,
+                    ",".join(task.deps) or "-",
+                    str(extractor.model.model or type(extractor.model).__name__) if is_model else "-",
+                    str(extractor._model_query()) if is_model else str(extractor.chunker.config_key()),
+                    ",".join(task.users),
+                    "always" if "always" in runs_if else " | ".join(runs_if) or "-",
+                ]
+            )
+        widths = [max(len(line[i]) for line in [headers] + lines) for i in range(len(headers))]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip()
+            for line in [headers] + lines
+        )
+
+    def execute(self, doc_text: str, max_workers: int = 4) -> Dict:
+        """Runs the plan on a document. Tasks start as soon as their dependencies are done and their
+        branch is selected, up to max_workers at a time.
+
+        Args:
+            doc_text (str): Document text from which to extract.
+            max_workers (int, optional): Maximum number of concurrent tasks. Defaults to 4.
+
+        Returns:
+            Dict: {node_name: node_result}, as returned by `Node.extract`.
+        """
+        results = {}
+        done = {}  # task id -> chunks of a chunking task, answers of a model task
+        started = set()
+        waiting_tasks = []  # Started tasks whose dependencies are still running
+        waiting_steps = {}  # task id -> steps waiting for its answers
+        futures = {}
+
+        with ThreadPoolExecutor(max_workers=max(max_workers, 1)) as executor:
+
+            def submit_ready():
+                for task_id in list(waiting_tasks):
+                    task = self.tasks[task_id]
+                    if all(dep in done for dep in task.deps):
+                        waiting_tasks.remove(task_id)
+                        context = contextvars.copy_context()
+                        chunks = done[task.deps[0]] if task.deps else None
+                        futures[executor.submit(context.run, task.run, doc_text, chunks)] = task_id
+
+            def start(task_id: str):
+                if task_id in started:
+                    return
+                started.add(task_id)
+                for dep in self.tasks[task_id].deps:
+                    start(dep)
+                waiting_tasks.append(task_id)
+
+            def enable(step: PlanStep):
+                if step.task in done:
+                    resolve(step)
+                else:
+                    waiting_steps.setdefault(step.task, []).append(step)
+                    start(step.task)
+
+            def resolve(step: PlanStep):
+                result = step.extractor._resolve(done[step.task])
+                results[step.name] = result
+                for child in step.children:
+                    if child.category == result:
+                        enable(child)
+
+            with tracing.span(tracing.NODE, self.root.name):
+                enable(self.root)
+                submit_ready()
+                try:
+                    while futures:
+                        finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            task_id = futures.pop(future)
+                            done[task_id] = future.result()
+                            for step in waiting_steps.pop(task_id, []):
+                                resolve(step)
+                        submit_ready()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+
+        return {step.name: results[step.name] for step in self.steps if step.name in results}
+
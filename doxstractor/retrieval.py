@@ -0,0 +1,120 @@
+from .chunking import Chunk, Chunker
+from .models.cache import MemoryCache
+from typing import Dict, List, Optional
+import collections
+import math
+import re
+
+STOP_WORDS = set(
+    "a an and are as at be by does do for from has have how in is it of on or that the this to was "
+    "were what when where which who whom why will with".split()
+)
+
+_index_cache = MemoryCache(maxsize=32)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"\w+", text.lower()) if t not in STOP_WORDS]
+
+
+class BM25Index:
+    def __init__(self, chunks: List[Chunk], k1: float = 1.5, b: float = 0.75) -> None:
+        """Okapi BM25 index over the chunks of one document.
+
+        Args:
+            chunks (List[Chunk]): The chunks to index.
+            k1 (float, optional): Term frequency saturation. Defaults to 1.5.
+            b (float, optional): Length normalization. Defaults to 0.75.
+        """
+        self.k1 = k1
+        self.b = b
+        self.num_chunks = len(chunks)
+        self.lengths = []
+        self.postings = collections.defaultdict(list)  # term -> [(chunk index, term frequency)]
+        for i, chunk in enumerate(chunks):
+            tokens = tokenize(chunk.text)
+            self.lengths.append(len(tokens))
+            for term, tf in collections.Counter(tokens).items():
+                self.postings[term].append((i, tf))
+        self.avg_length = (sum(self.lengths) / self.num_chunks) if chunks else 0
+
+    def scores(self, query: str) -> Dict[int, float]:
+        """BM25 scores of all chunks sharing at least one term with the query.
+
+        Returns:
+            Dict[int, float]: {chunk_index: score}
+        """
+        scores = collections.defaultdict(float)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, [])
+            df = len(postings)
+            if df == 0:
+                continue
+            idf = math.log((self.num_chunks - df + 0.5) / (df + 0.5) + 1)
+            for i, tf in postings:
+                norm = 1 - self.b + self.b * self.lengths[i] / (self.avg_length or 1)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+        return scores
+
+
+class BM25Retriever:
+    def __init__(
+        self,
+        top_k: Optional[int] = 5,
+        min_score: Optional[float] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ) -> None:
+        """Selects the chunks of a document which are lexically relevant to a query, so only those are
+        sent to the model. The index is built once per document and chunking configuration and is shared
+        by all extractors. If no chunk matches any query term, all chunks are used.
+
+        Args:
+            top_k (Optional[int], optional): Maximum number of chunks to keep. Defaults to 5.
+            min_score (Optional[float], optional): Only keep chunks scoring at least this. Defaults to None.
+            k1 (float, optional): BM25 term frequency saturation. Defaults to 1.5.
+            b (float, optional): BM25 length normalization. Defaults to 0.75.
+        """
+        self.top_k = top_k
+        self.min_score = min_score
+        self.k1 = k1
+        self.b = b
+
+    def index(self, doc_text: str, chunker: Chunker, chunks: Optional[List[Chunk]] = None) -> BM25Index:
+        """Returns the index for a document, building it on first use from the given chunks or by
+        chunking the document."""
+        key = (chunker.config_key(), self.k1, self.b, doc_text)
+        index = _index_cache.get(key)
+        if index is None:
+            if chunks is None:
+                chunks = chunker.chunk(doc_text)
+            index = BM25Index(chunks, k1=self.k1, b=self.b)
+            _index_cache.set(key, index)
+        return index
+
+    def select(
+        self, query: str, doc_text: str, chunker: Chunker, chunks: Optional[List[Chunk]] = None
+    ) -> List[int]:
+        """Indices of the chunks to send to the model, in document order.
+
+        Args:
+            query (str): The extractor query.
+            doc_text (str): The full document.
+            chunker (Chunker): The chunker of the extractor.
+            chunks (Optional[List[Chunk]], optional): The document chunked by the chunker, if already
+                known. Defaults to None.
+
+        Returns:
+            List[int]: Selected chunk indices.
+        """
+        index = self.index(doc_text, chunker, chunks)
+        scores = index.scores(query)
+        ranked = sorted(scores, key=lambda i: scores[i], reverse=True)
+        if self.min_score is not None:
+            ranked = [i for i in ranked if scores[i] >= self.min_score]
+        if self.top_k is not None:
+            ranked = ranked[: self.top_k]
+        if len(ranked) == 0:
+            # Nothing scores, fall back to a full scan.
+            return list(range(index.num_chunks))
+        return sorted(ranked)
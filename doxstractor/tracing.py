@@ -0,0 +1,240 @@
+from typing import Dict, List, Optional
+import collections
+import contextlib
+import contextvars
+import threading
+import time
+
+
+# Span kinds, from outermost to innermost.
+NODE = "node"
+EXTRACTOR = "extractor"
+CHUNKING = "chunking"
+MODEL = "model"
+
+
+class Span:
+    def __init__(self, kind: str, name: str, parent: Optional["Span"], attributes: Dict) -> None:
+        """One timed step of an extraction.
+
+        Args:
+            kind (str): "node", "extractor", "chunking" or "model".
+            name (str): Extractor name, or model name for model calls.
+            parent (Optional[Span]): The enclosing span, None for the outermost span.
+            attributes (Dict): Measurements such as chunks, prompt_chars, input_tokens, retries, cache_hits or
+                escalations.
+        """
+        self.kind = kind
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        # The extractor this span belongs to, used to attribute model calls and chunking.
+        self.node = name if kind in (NODE, EXTRACTOR) or parent is None else parent.node
+        self.start = time.perf_counter()
+        self.end = None
+        self._lock = threading.Lock()
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, **counts):
+        """Adds to counters, e.g. from concurrent requests of one batch call."""
+        with self._lock:
+            for key, value in counts.items():
+                self.attributes[key] = self.attributes.get(key, 0) + value
+
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Receives a callback when a span starts and when it ends. Subclass it and install it with
+    `set_tracer` or `use_tracer`."""
+
+    def on_start(self, span: Span):
+        pass
+
+    def on_end(self, span: Span):
+        pass
+
+
+_tracer: Optional[Tracer] = None
+_current_span = contextvars.ContextVar("doxstractor_span", default=None)
+
+
+def get_tracer() -> Optional[Tracer]:
+    return _tracer
+
+
+def enabled() -> bool:
+    """Whether a tracer is installed. Guards measurements which cost time to compute."""
+    return _tracer is not None
+
+
+def set_tracer(tracer: Optional[Tracer]):
+    """Installs a tracer for the whole process. None (the default) disables tracing."""
+    global _tracer
+    _tracer = tracer
+
+
+@contextlib.contextmanager
+def use_tracer(tracer: Optional[Tracer]):
+    """Installs a tracer for the duration of a with block."""
+    previous = _tracer
+    set_tracer(tracer)
+    try:
+        yield tracer
+    finally:
+        set_tracer(previous)
+
+
+@contextlib.contextmanager
+def _traced(tracer: Tracer, kind: str, name: str, attributes: Dict):
+    span = Span(kind, name, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    tracer.on_start(span)
+    try:
+        yield span
+    finally:
+        span.end = time.perf_counter()
+        _current_span.reset(token)
+        tracer.on_end(span)
+
+
+def span(kind: str, name: str, **attributes):
+    """Context manager timing a step. Without a tracer it returns a shared no-op span.
+
+    ```python
+    with tracing.span(tracing.MODEL, model.model, chunks=len(chunks)) as s:
+        answers = model.batch_complete(...)
+        s.set(response_chars=sum(map(len, answers)))
+    ```
+    """
+    tracer = _tracer
+    if tracer is None:
+        return contextlib.nullcontext(_NULL_SPAN)
+    return _traced(tracer, kind, name, attributes)
+
+
+def add(**counts):
+    """Adds counters (tokens, retries, cache hits, ...) to the innermost active span, if tracing."""
+    if _tracer is None:
+        return
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counts)
+
+
+def prompt_chars(model_kwargs: Dict) -> int:
+    """Characters sent to the model by one batch call, counting the prompts once per chunk."""
+    chunks = model_kwargs["context"]
+    prompt = sum(
+        len(str(model_kwargs.get(key) or ""))
+        for key in ["query", "task_description", "system_prompt"]
+    )
+    return sum(len(c) for c in chunks) + prompt * len(chunks)
+
+
+def response_chars(results) -> int:
+    """Characters of the answers of one batch call, for plain answers and answers with scores."""
+    return sum(len(str(r["answer"] if isinstance(r, dict) else r)) for r in results)
+
+
+def request_sizes(requests: List[Dict]) -> Dict:
+    """Span attributes of model calls given by their keyword arguments: chunks and prompt_chars. Empty
+    without a tracer, so nothing is counted when tracing is off."""
+    if _tracer is None:
+        return {}
+    return dict(
+        chunks=sum(len(r["context"]) for r in requests),
+        prompt_chars=sum(map(prompt_chars, requests)),
+    )
+
+
+# Columns of the profile table: (header, span kind, attribute or "time")
+PROFILE_COLUMNS = [
+    ("runs", EXTRACTOR, "count"),
+    ("extract_s", EXTRACTOR, "time"),
+    ("chunking_s", CHUNKING, "time"),
+    ("model_s", MODEL, "time"),
+    ("model_calls", MODEL, "count"),
+    ("chunks", MODEL, "chunks"),
+    ("prompt_chars", MODEL, "prompt_chars"),
+    ("response_chars", MODEL, "response_chars"),
+    ("input_tokens", MODEL, "input_tokens"),
+    ("output_tokens", MODEL, "output_tokens"),
+    ("cache_read_tokens", MODEL, "cache_read_input_tokens"),
+    ("retries", MODEL, "retries"),
+    ("cache_hits", MODEL, "cache_hits"),
+    ("escalations", MODEL, "escalations"),
+]
+
+
+class ProfileAggregator(Tracer):
+    def __init__(self) -> None:
+        """Tracer summing up time, calls, chunks, tokens, retries and cache hits per node.
+
+        ```python
+        profiler = dxc.ProfileAggregator()
+        with dxc.tracing.use_tracer(profiler):
+            node.extract(doc_text)
+        print(profiler.table())
+        ```
+        """
+        self.totals = collections.defaultdict(collections.Counter)
+        self._lock = threading.Lock()
+
+    def on_end(self, span: Span):
+        with self._lock:
+            totals = self.totals[span.node]
+            totals[(span.kind, "count")] += 1
+            totals[(span.kind, "time")] += span.duration
+            for key, value in span.attributes.items():
+                if isinstance(value, (int, float)):
+                    totals[(span.kind, key)] += value
+
+    def rows(self) -> Dict[str, Dict]:
+        """{node_name: {column: value}} for all nodes seen so far."""
+        with self._lock:
+            return {
+                node: {
+                    header: totals[(kind, attribute)]
+                    for header, kind, attribute in PROFILE_COLUMNS
+                }
+                for node, totals in self.totals.items()
+            }
+
+    def table(self) -> str:
+        """The profile as a plain text table, one row per node, slowest first."""
+        rows = sorted(self.rows().items(), key=lambda item: -item[1]["extract_s"])
+        headers = ["node"] + [header for header, _, _ in PROFILE_COLUMNS]
+        lines = [
+            [node]
+            + [
+                f"{value:.3f}" if isinstance(value, float) else str(value)
+                for value in row.values()
+            ]
+            for node, row in rows
+        ]
+        widths = [max(len(line[i]) for line in [headers] + lines) for i in range(len(headers))]
+        return "\n".join(
+            "  ".join(cell.ljust(width) for cell, width in zip(line, widths))
+            for line in [headers] + lines
+        )
+
+    def reset(self):
+        with self._lock:
+            self.totals.clear()
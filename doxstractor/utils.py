@@ -1,5 +1,8 @@
 
+import contextvars
 import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List
 
 def parseNumber(text):
     """
@@ -125,4 +128,44 @@ def parseNumber(text):
     return None
 
 def most_common(lst):
-    return max(set(lst), key=lst.count)
\ No newline at end of file
+    return max(set(lst), key=lst.count)
+
+def to_builtin(value):
+    """`default` for json.dumps: converts numpy scalars, e.g. the float scores of models, to python numbers."""
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def thread_map(fn: Callable, items: Iterable, max_workers: int = 1) -> List:
+    """Applies fn to every item, using up to max_workers threads. Results are returned in input order.
+
+    Every item runs to completion even if another item fails, the first exception (in input order)
+    is re-raised once all items are done.
+
+    Args:
+        fn (Callable): Function applied to each item.
+        items (Iterable): Items to process.
+        max_workers (int, optional): Maximum number of concurrent calls. Defaults to 1 (sequential).
+
+    Returns:
+        List: fn(item) for each item, in input order.
+    """
+    items = list(items)
+    if max_workers <= 1 or len(items) <= 1:
+        results, errors = [], []
+        for item in items:
+            try:
+                results.append(fn(item))
+            except Exception as e:
+                results.append(None)
+                errors.append(e)
+        if errors:
+            raise errors[0]
+        return results
+
+    # Every item runs in a copy of the caller's context, so e.g. tracing spans nest correctly.
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, fn, item) for item in items
+        ]
+    return [future.result() for future in futures]
@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+
+import doxstractor as dxc
+
+
+class CountingModel(dxc.MockModel):
+    """Mock model which records every call, and the largest number of calls running at the same time."""
+
+    def __init__(self, delay=0.0):
+        super().__init__(model="counting")
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.peak = 0
+
+    @property
+    def queries(self):
+        return [query for query, _ in self.calls]
+
+    @property
+    def contexts(self):
+        return [context for _, context in self.calls]
+
+    @property
+    def num_chunks(self):
+        return sum(len(context) for context in self.contexts)
+
+    def _start(self, query, context):
+        with self._lock:
+            self.calls.append((query, list(context)))
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _finish(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def batch_complete(self, query, context, task_description=None, system_prompt=None):
+        self._start(query, context)
+        try:
+            time.sleep(self.delay)
+            return super().batch_complete(query, context, task_description, system_prompt)
+        finally:
+            self._finish()
+
+    async def abatch_complete(self, query, context, task_description=None, system_prompt=None):
+        self._start(query, context)
+        try:
+            await asyncio.sleep(self.delay)
+            return super().batch_complete(query, context, task_description, system_prompt)
+        finally:
+            self._finish()
+
+
+def _create_graph(model, **extractor_kwargs):
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type",
+        query="What type of document is this?",
+        categories=["lease", "employment"],
+        model=model,
+        **extractor_kwargs,
+    )
+
+    lease_extractor = dxc.TextExtractor(
+        name="text_lease", query="What is the content?", model=model, **extractor_kwargs
+    )
+    employment_extractor = dxc.TextExtractor(
+        name="text_employment", query="What is the content?", model=model, **extractor_kwargs
+    )
+
+    children = {
+        "lease": [dxc.Node(lease_extractor)],
+        "employment": [dxc.Node(employment_extractor)],
+    }
+
+    root_node = dxc.Node(root_extractor, children=children)
+    return root_node
+
+
+@pytest.fixture
+def counting_model():
+    return CountingModel()
+
+
+@pytest.fixture
+def create_graph():
+    """Builds a lease/employment tree with one text extractor per category, extractor_kwargs go to every
+    extractor."""
+    return _create_graph
@@ -0,0 +1,134 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import doxstractor as dxc
+
+
+class BatchHandler(BaseHTTPRequestHandler):
+    """Stand-in for the Message Batches API. Answers every request with the last line of its prompt,
+    batches end on the second status check."""
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            batch_id = f"msgbatch_{len(server.batches)}"
+            server.batches[batch_id] = {"requests": body["requests"], "polls": 0}
+        self._send_json({"id": batch_id, "processing_status": "in_progress"})
+
+    def do_GET(self):
+        server = self.server
+        parts = self.path.strip("/").split("/")
+        batch = server.batches[parts[3]]
+
+        if parts[-1] == "results":
+            lines = []
+            for request in batch["requests"]:
+                prompt = request["params"]["messages"][0]["content"][0]["text"]
+                message = {"content": [{"type": "text", "text": prompt.split("\n")[-1]}]}
+                lines.append(
+                    json.dumps(
+                        {
+                            "custom_id": request["custom_id"],
+                            "result": {"type": "succeeded", "message": message},
+                        }
+                    )
+                )
+            body = "\n".join(lines).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        batch["polls"] += 1
+        status = "ended" if batch["polls"] > 1 else "in_progress"
+        self._send_json(
+            {
+                "id": parts[3],
+                "processing_status": status,
+                "results_url": f"{server.url}/v1/messages/batches/{parts[3]}/results",
+            }
+        )
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def batch_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), BatchHandler)
+    server.lock = threading.Lock()
+    server.batches = {}
+    server.url = f"http://127.0.0.1:{server.server_port}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def batch_model(batch_api, state_path):
+    return dxc.AnthropicBatchModel(
+        dxc.AnthropicAPIModel(model="claude-3-haiku-20240307"),
+        state_path=state_path,
+        api_key="key",
+        base_url=batch_api.url,
+    )
+
+
+def test_extract_bulk_submits_one_batch_per_tree_level(batch_api, tmp_path, create_graph):
+    docs = ["lease", "employment", "lease"]
+    node = create_graph(batch_model(batch_api, tmp_path / "state.db"))
+
+    results = sorted(node.extract_bulk(docs, poll_interval=0))
+
+    assert [r.error for r in results] == [None] * 3
+    assert [r.result for r in results] == [
+        {"doc_type": "lease", "text_lease": "lease"},
+        {"doc_type": "employment", "text_employment": "employment"},
+        {"doc_type": "lease", "text_lease": "lease"},
+    ]
+    assert len(batch_api.batches) == 2
+    # Identical prompts of the duplicate document are only submitted once.
+    assert [len(b["requests"]) for b in batch_api.batches.values()] == [2, 2]
+
+    # A new run on the same state answers everything from stored results.
+    node = create_graph(batch_model(batch_api, tmp_path / "state.db"))
+    assert sorted(node.extract_bulk(docs, poll_interval=0)) == results
+    assert len(batch_api.batches) == 2
+
+
+def test_extract_bulk_rereads_docs_every_round(batch_api, tmp_path, create_graph):
+    node = create_graph(batch_model(batch_api, tmp_path / "state.db"))
+
+    with pytest.raises(TypeError):
+        node.extract_bulk(iter(["lease"]))
+
+    results = list(node.extract_bulk(lambda: (doc for doc in ["lease", "employment"]), poll_interval=0))
+    assert sorted(r.index for r in results) == [0, 1]
+    assert len(batch_api.batches) == 2
+
+
+def test_resume_polls_open_batches(batch_api, tmp_path):
+    model = batch_model(batch_api, tmp_path / "state.db")
+    with pytest.raises(dxc.PendingResults):
+        model.batch_complete(query="q", context=["a", "b"])
+    model.submit_pending()
+
+    # The run crashed after submitting, a new process picks up the open batch.
+    model = batch_model(batch_api, tmp_path / "state.db")
+    model.wait_for_batches(poll_interval=0)
+
+    assert model.batch_complete(query="q", context=["a", "b"]) == ["a", "b"]
+    assert len(batch_api.batches) == 1
@@ -0,0 +1,32 @@
+import json
+import time
+
+import pytest
+
+import doxstractor as dxc
+from benchmarks import run
+
+
+def test_mock_model_simulates_latency_and_failures():
+    model = dxc.MockModel(latency=0.01, jitter=0.01, seed=0)
+    start = time.monotonic()
+    assert model.batch_complete(query="q", context=["a", "b"]) == ["a", "b"]
+    assert time.monotonic() - start >= 0.02
+    assert model.call_count == 2
+
+    failing = dxc.MockModelWithScores(failure_rate=1.0)
+    with pytest.raises(RuntimeError):
+        failing.batch_complete_with_scores(query="q", context=["a"])
+
+
+def test_quick_benchmark_run_writes_report(tmp_path):
+    output = tmp_path / "results.json"
+    run.main(["--quick", "--docs", "2", "--output", str(output)])
+
+    report = json.loads(output.read_text())
+    trees = [r for r in report["results"] if r["benchmark"] == "tree_extract"]
+    assert {r["params"]["depth"] for r in trees} == {1, 2}
+    # Depth 2 with fanout 2: the root and both children are called once per document.
+    assert [r["calls_per_doc"] for r in trees if r["params"]["depth"] == 2] == [3, 3]
+    for result in report["results"]:
+        assert result["p50_ms"] <= result["p99_ms"]
@@ -0,0 +1,106 @@
+import re
+import time
+
+import doxstractor as dxc
+from doxstractor.chunking import clear_chunk_cache
+
+
+def assert_offsets(doc, chunks):
+    for chunk in chunks:
+        assert doc[chunk.start : chunk.end] == chunk.text
+
+
+def test_line_chunks_track_offsets_and_respect_size():
+    doc = "\n".join(f"line number {i}" for i in range(500))
+    chunks = dxc.Chunker(max_chunk_size=100).split(doc)
+
+    assert_offsets(doc, chunks)
+    assert all(len(c.text) <= 100 for c in chunks)
+    assert "\n".join(c.text for c in chunks) == doc
+    assert all(not c.text.startswith("\n") for c in chunks)
+
+
+def test_long_lines_fall_back_to_sentences_and_characters():
+    sentence = "This is a sentence. "
+    doc = sentence * 20 + "\n" + "x" * 250
+    chunks = dxc.Chunker(max_chunk_size=100).split(doc)
+
+    assert_offsets(doc, chunks)
+    assert all(len(c.text) <= 100 for c in chunks)
+    assert chunks[0].text.endswith(".")
+    assert [c.text for c in chunks[-3:]] == ["x" * 100, "x" * 100, "x" * 50]
+
+
+def test_overlap_repeats_trailing_segments():
+    doc = "\n".join(str(i) * 10 for i in range(10))
+    chunks = dxc.Chunker(max_chunk_size=32, overlap=10).split(doc)
+
+    assert_offsets(doc, chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert 0 < previous.end - chunk.start <= 10
+
+
+def test_paragraph_boundary():
+    doc = "First paragraph\nstill first.\n\nSecond paragraph."
+    chunks = dxc.Chunker(max_chunk_size=30, boundary="paragraph").split(doc)
+
+    assert [c.text for c in chunks] == [
+        "First paragraph\nstill first.",
+        "Second paragraph.",
+    ]
+
+
+def test_chunking_is_linear_for_line_heavy_documents():
+    doc = "a\n" * 500_000
+    start = time.perf_counter()
+    chunks = dxc.Chunker(max_chunk_size=10_000).split(doc)
+
+    assert time.perf_counter() - start < 10
+    assert len(chunks) == 100
+
+
+def test_extractors_share_memoized_chunks():
+    clear_chunk_cache()
+    model = dxc.MockModel()
+    doc = "\n".join(f"line {i}" for i in range(1000))
+    first = dxc.TextExtractor(name="first", query="q", model=model, max_chunk_size=50)
+    second = dxc.NumericExtractor(name="second", query="q", model=model, max_chunk_size=50)
+
+    assert first._chunks(doc) is second._chunks(doc)
+
+
+class WhitespaceTokenizer:
+    name_or_path = "whitespace"
+
+    def __call__(self, text, add_special_tokens=False, return_offsets_mapping=False):
+        return {"offset_mapping": [m.span() for m in re.finditer(r"\S+", text)]}
+
+
+def test_token_chunker_windows_with_stride():
+    doc = " ".join(f"w{i}" for i in range(10))
+    chunks = dxc.TokenChunker(WhitespaceTokenizer(), max_tokens=4, stride=1).split(doc)
+
+    assert_offsets(doc, chunks)
+    assert [c.text for c in chunks] == [
+        "w0 w1 w2 w3",
+        "w3 w4 w5 w6",
+        "w6 w7 w8 w9",
+    ]
+
+
+class TokenWindowModel(dxc.MockModel):
+    def default_chunker(self):
+        return dxc.TokenChunker(WhitespaceTokenizer(), max_tokens=2)
+
+
+def test_extractor_uses_model_chunker_unless_size_given():
+    model = TokenWindowModel()
+
+    default = dxc.TextExtractor(name="a", query="q", model=model)
+    explicit = dxc.TextExtractor(name="b", query="q", model=model, max_chunk_size=100)
+
+    assert default._chunk_text("one two three") == ["one two", "three"]
+    assert explicit._chunk_text("one two three") == ["one two three"]
+    assert default.max_chunk_size is None
+    assert explicit.max_chunk_size == 100
+    assert dxc.TextExtractor(name="c", query="q", model=dxc.MockModel()).max_chunk_size == 10_000
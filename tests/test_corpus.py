@@ -0,0 +1,63 @@
+import json
+
+import doxstractor as dxc
+
+
+class FailingOnceModel(dxc.MockModel):
+    """Fails on the document "broken" until `fixed` is set."""
+
+    def __init__(self):
+        super().__init__()
+        self.fixed = False
+
+    def complete(self, query, context, task_description=None, system_prompt=None):
+        if context == "broken" and not self.fixed:
+            raise RuntimeError("model down")
+        return super().complete(query, context, task_description, system_prompt)
+
+
+def create_node(model):
+    extractor = dxc.CategoryExtractor(
+        name="doc_type", query="Type?", categories=["lease", "employment"], model=model
+    )
+    return dxc.Node(extractor)
+
+
+def read_rows(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_corpus_runner_streams_rows_and_resumes(tmp_path):
+    docs = tmp_path / "docs.jsonl"
+    docs.write_text(
+        "\n".join(
+            json.dumps({"id": f"doc{i}", "text": text})
+            for i, text in enumerate(["lease", "broken", "employment"])
+        )
+    )
+    output = tmp_path / "out.jsonl"
+    model = FailingOnceModel()
+    runner = dxc.CorpusRunner(create_node(model), output, max_workers=2)
+
+    counts = runner.run(dxc.iter_jsonl(docs))
+    assert counts == {"processed": 2, "failed": 1, "skipped": 0}
+    rows = {row["id"]: row for row in read_rows(output)}
+    assert rows["doc0"]["result"] == {"doc_type": "lease"}
+    assert "model down" in rows["doc1"]["error"]
+
+    # The restart only runs the failed document.
+    model.fixed = True
+    counts = runner.run(dxc.iter_jsonl(docs))
+    assert counts == {"processed": 1, "failed": 0, "skipped": 2}
+    assert read_rows(output)[-1] == {"id": "doc1", "result": {"doc_type": "NA"}}
+
+
+def test_iter_directory_reads_files_in_order(tmp_path):
+    (tmp_path / "b").mkdir()
+    (tmp_path / "b" / "2.txt").write_text("two")
+    (tmp_path / "1.txt").write_text("one")
+
+    assert list(dxc.iter_directory(tmp_path, "*.txt")) == [
+        ("1.txt", "one"),
+        ("b/2.txt", "two"),
+    ]
@@ -0,0 +1,57 @@
+import doxstractor as dxc
+
+
+class CountingModelWithScores(dxc.MockModelWithScores):
+    def __init__(self):
+        super().__init__()
+        self.num_chunks = 0
+
+    def batch_complete_with_scores(
+        self, query, context, task_description=None, system_prompt=None
+    ):
+        self.num_chunks += len(context)
+        return super().batch_complete_with_scores(
+            query, context, task_description, system_prompt
+        )
+
+
+def test_early_stopping_stops_once_vote_is_decided(counting_model):
+    doc = "\n".join(["lease"] * 6 + ["employment"] * 14)
+    model = counting_model
+    extractor = dxc.CategoryExtractor(
+        name="doc_type",
+        query="Type?",
+        categories=["lease", "employment"],
+        model=model,
+        max_chunk_size=10,
+        early_stopping=True,
+        wave_size=2,
+    )
+
+    # After 18 chunks "employment" leads 12 to 6 with 2 chunks left.
+    assert extractor.extract(doc) == "employment"
+    assert model.num_chunks == 18
+
+    doc = "\n".join(["lease"] * 12 + ["employment"] * 8)
+    model.calls.clear()
+    assert extractor.extract(doc) == "lease"
+    assert model.num_chunks == 12
+
+
+def test_early_stopping_with_score_threshold():
+    doc = "\n".join(f"answer {i}" for i in range(20))
+    model = CountingModelWithScores()
+    extractor = dxc.TextExtractor(
+        name="text",
+        query="q",
+        model=model,
+        max_chunk_size=9,
+        early_stopping=True,
+        wave_size=3,
+        score_threshold=0.4,
+    )
+
+    # MockModelWithScores scores chunks log10(i + 1) within a call, so the third chunk
+    # of the first wave clears the threshold.
+    assert extractor.extract(doc) == "answer 2"
+    assert model.num_chunks == 3
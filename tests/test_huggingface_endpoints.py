@@ -0,0 +1,119 @@
+import asyncio
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import doxstractor as dxc
+
+
+class QAHandler(BaseHTTPRequestHandler):
+    """Stand-in for a hosted QA endpoint. Answers with the context, fails the first request with a 503."""
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append(body)
+            fail = len(server.requests) == 1
+
+        if fail:
+            self.send_response(503)
+            self.send_header("retry-after", "0")
+            self.end_headers()
+            return
+
+        inputs = body["inputs"]
+        answer = lambda i: {"score": 0.9, "answer": i["context"].upper()}
+        result = [answer(i) for i in inputs] if isinstance(inputs, list) else answer(inputs)
+        data = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def endpoint():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), QAHandler)
+    server.lock = threading.Lock()
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+def test_batch_complete_retries_and_keeps_order(endpoint):
+    url = f"http://127.0.0.1:{endpoint.server_port}"
+    model = dxc.HFEndPointQAModel(url, api_token="token", max_concurrency=3)
+
+    results = model.batch_complete_with_scores(query="q", context=["a", "b", "c", "d"])
+
+    assert [r["answer"] for r in results] == ["A", "B", "C", "D"]
+    # One failed request plus one per chunk
+    assert len(endpoint.requests) == 5
+
+
+def test_list_inputs_send_several_contexts_per_request(endpoint):
+    url = f"http://127.0.0.1:{endpoint.server_port}"
+    model = dxc.HFEndPointQAModel(url, api_token="token", contexts_per_request=2)
+
+    results = asyncio.run(
+        model.abatch_complete_with_scores(query="q", context=["a", "b", "c"])
+    )
+
+    assert [r["answer"] for r in results] == ["A", "B", "C"]
+    assert sorted(len(r["inputs"]) for r in endpoint.requests[1:]) == [1, 2]
+
+
+def test_unexpected_errors_and_cancellation_free_the_rate_limiter_slot():
+    limiter = dxc.RateLimiter(max_concurrency=1)
+    model = dxc.HFEndPointQAModel("http://127.0.0.1:1", api_token="token", rate_limiter=limiter)
+
+    def broken_post(*args, **kwargs):
+        raise ValueError("unexpected")
+
+    model.session.post = broken_post
+    with pytest.raises(ValueError):
+        model._post({"inputs": {}})
+    assert limiter._in_flight == 0
+
+    class HangingClient:
+        async def post(self, *args, **kwargs):
+            await asyncio.sleep(60)
+
+    async def hanging_client():
+        return HangingClient()
+
+    model._aclient = hanging_client
+
+    async def cancel_request():
+        task = asyncio.ensure_future(model._apost({"inputs": {}}))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_request())
+    assert limiter._in_flight == 0
+
+
+def test_async_client_of_an_earlier_loop_is_closed(endpoint):
+    url = f"http://127.0.0.1:{endpoint.server_port}"
+    model = dxc.HFEndPointQAModel(url, api_token="token")
+
+    asyncio.run(model.acomplete(query="q", context="a"))
+    first_client = model._async_client
+    asyncio.run(model.acomplete(query="q", context="b"))
+
+    assert first_client.is_closed
+    assert model._async_client is not first_client
+
+    asyncio.run(model.aclose())
+    assert model._async_client is None
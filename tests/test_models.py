@@ -0,0 +1,456 @@
+import asyncio
+import anthropic
+import httpx
+import json
+import pickle
+import pytest
+import threading
+import time
+import torch
+from types import SimpleNamespace
+
+import doxstractor as dxc
+
+
+def fake_message(text):
+    return SimpleNamespace(content=[SimpleNamespace(text=text)])
+
+
+def test_anthropic_batch_complete_concurrent_keeps_order():
+    model = dxc.AnthropicAPIModel(max_concurrency=4)
+    in_flight = []
+    lock = threading.Lock()
+    active = [0]
+
+    def query(system_prompt, user_prompt):
+        with lock:
+            active[0] += 1
+            in_flight.append(active[0])
+        # Make chunks finish out of order
+        time.sleep(0.01 * (8 - int(user_prompt[-1])))
+        with lock:
+            active[0] -= 1
+        return fake_message(user_prompt.split("\n")[-1])
+
+    model._query_anthropic = query
+    chunks = [f"chunk {i}" for i in range(8)]
+    results = model.batch_complete(query="q", context=chunks)
+
+    assert results == chunks
+    assert max(in_flight) > 1
+    assert max(in_flight) <= 4
+
+
+def test_anthropic_abatch_complete_bounds_in_flight_requests():
+    model = dxc.AnthropicAPIModel(max_async_concurrency=2)
+    active = [0]
+    peak = [0]
+
+    async def query(system_prompt, user_prompt):
+        active[0] += 1
+        peak[0] = max(peak[0], active[0])
+        await asyncio.sleep(0.01)
+        active[0] -= 1
+        return fake_message(user_prompt.split("\n")[-1])
+
+    model._aquery_anthropic = query
+    chunks = [f"chunk {i}" for i in range(6)]
+    results = asyncio.run(model.abatch_complete(query="q", context=chunks))
+
+    assert results == chunks
+    assert peak[0] == 2
+
+    # By default the async path is only bounded by the rate limiter, not by max_concurrency.
+    model = dxc.AnthropicAPIModel()
+    model._aquery_anthropic = query
+    peak[0] = 0
+    assert asyncio.run(model.abatch_complete(query="q", context=chunks)) == chunks
+    assert peak[0] == 6
+
+
+def test_cached_model_only_sends_misses(tmp_path, counting_model):
+    inner = counting_model
+    for cache in [dxc.MemoryCache(), dxc.SQLiteCache(tmp_path / "cache.db")]:
+        inner.calls.clear()
+        model = dxc.CachedModel(inner, cache=cache)
+
+        assert model.batch_complete(query="q", context=["a", "b"]) == ["a", "b"]
+        assert model.batch_complete(query="q", context=["b", "c"]) == ["b", "c"]
+        assert model.batch_complete(query="other", context=["a"]) == ["a"]
+
+        assert inner.contexts == [["a", "b"], ["c"], ["a"]]
+        assert model.stats() == {"hits": 1, "misses": 4}
+
+
+def test_cached_model_sends_duplicate_chunks_once_per_run(counting_model):
+    inner = counting_model
+    inner.delay = 0.05
+    model = dxc.CachedModel(inner, cache=dxc.MemoryCache(maxsize=None))
+    extractor = dxc.TextExtractor(name="text", query="q", model=model, max_chunk_size=20)
+    node = dxc.Node(extractor)
+    boilerplate = "indemnity clause"
+    docs = [f"{boilerplate}\nparty {i}\n{boilerplate}" for i in range(4)]
+
+    results = list(node.extract_many(docs, max_workers=4))
+
+    assert [r.error for r in results] == [None] * 4
+    sent = [chunk for call in inner.contexts for chunk in call]
+    assert sorted(sent) == sorted([boilerplate] + [f"party {i}" for i in range(4)])
+    assert model.stats() == {"hits": 7, "misses": 5}
+
+
+def test_cached_model_waiters_resend_chunks_of_a_cancelled_owner(counting_model):
+    inner = counting_model
+    inner.delay = 0.05
+    model = dxc.CachedModel(inner)
+
+    async def cancel_owner():
+        owner = asyncio.ensure_future(model.abatch_complete(query="q", context=["x"]))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(model.abatch_complete(query="q", context=["x"]))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(cancel_owner()) == ["x"]
+    assert inner.contexts == [["x"], ["x"]]
+    assert model._in_flight == {}
+
+
+def test_cached_model_cancelled_waiter_leaves_the_owner_running(counting_model):
+    inner = counting_model
+    inner.delay = 0.05
+    model = dxc.CachedModel(inner)
+
+    async def cancel_waiter():
+        owner = asyncio.ensure_future(model.abatch_complete(query="q", context=["x"]))
+        await asyncio.sleep(0)
+        cancelled = asyncio.ensure_future(model.abatch_complete(query="q", context=["x"]))
+        waiter = asyncio.ensure_future(model.abatch_complete(query="q", context=["x"]))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        return await owner, await waiter, cancelled.cancelled()
+
+    assert asyncio.run(cancel_waiter()) == (["x"], ["x"], True)
+    assert inner.contexts == [["x"]]
+    assert model._in_flight == {}
+
+
+def test_cached_model_claim_rechecks_the_cache(counting_model):
+    model = dxc.CachedModel(counting_model)
+    keys, results, missing = model._lookup("batch_complete", "q", ["x"], None, None)
+    # Another call stores the answer between the lookup and the claim.
+    model.cache.set(keys[0], "stored")
+
+    assert model._claim(keys, results, missing) == ([], [])
+    assert results == ["stored"]
+
+
+def test_sqlite_cache_eviction(tmp_path):
+    cache = dxc.SQLiteCache(tmp_path / "cache.db", max_entries=2, evict_every=1)
+    for key in ["a", "b", "c"]:
+        cache.set(key, {"answer": key, "score": 0.5})
+        time.sleep(0.01)
+
+    assert len(cache) == 2
+    assert cache.get("a") is None
+    assert cache.get("c") == {"answer": "c", "score": 0.5}
+
+    expiring = dxc.SQLiteCache(tmp_path / "expiring.db", max_age=-1)
+    expiring.set("a", "value")
+    assert expiring.get("a") is None
+
+    batched = dxc.SQLiteCache(tmp_path / "batched.db", max_entries=2, evict_every=3)
+    for key in ["a", "b"]:
+        batched.set(key, key)
+    batched.set("c", "c")
+    assert len(batched) == 2
+    batched.set("d", "d")
+    assert len(batched) == 3
+
+
+def rate_limit_error(retry_after):
+    request = httpx.Request("POST", "https://api.anthropic.com/v1/messages")
+    response = httpx.Response(
+        429, headers={"retry-after": str(retry_after)}, request=request
+    )
+    return anthropic.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_anthropic_honours_retry_after_and_raises_when_exhausted():
+    limiter = dxc.RateLimiter()
+    model = dxc.AnthropicAPIModel(rate_limiter=limiter, max_retries=2)
+    attempts = []
+
+    def throttled_once(system_prompt, user_prompt):
+        attempts.append(time.monotonic())
+        if len(attempts) == 1:
+            raise rate_limit_error(0.2)
+        return fake_message("ok")
+
+    model._query_anthropic = throttled_once
+    assert model.complete(query="q", context="c") == "ok"
+    assert attempts[1] - attempts[0] >= 0.2
+
+    def always_throttled(system_prompt, user_prompt):
+        raise rate_limit_error(0)
+
+    model._query_anthropic = always_throttled
+    with pytest.raises(anthropic.RateLimitError):
+        model.complete(query="q", context="c")
+
+
+def test_anthropic_frees_rate_limiter_slot_on_any_error_and_cancellation():
+    limiter = dxc.RateLimiter(max_concurrency=1)
+    model = dxc.AnthropicAPIModel(rate_limiter=limiter)
+
+    def broken_query(system_prompt, user_prompt):
+        raise ValueError("unexpected")
+
+    model._query_anthropic = broken_query
+    with pytest.raises(ValueError):
+        model.complete(query="q", context="c")
+    assert limiter._in_flight == 0
+
+    async def hanging_query(system_prompt, user_prompt):
+        await asyncio.sleep(60)
+
+    model._aquery_anthropic = hanging_query
+
+    async def cancel_request():
+        task = asyncio.ensure_future(model.acomplete(query="q", context="c"))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_request())
+    assert limiter._in_flight == 0
+
+
+def test_rate_limiter_paces_requests():
+    limiter = dxc.RateLimiter(requests_per_minute=600)
+    # The bucket starts full, then refills at 10 requests per second.
+    limiter._requests = 0
+    start = time.monotonic()
+    for _ in range(3):
+        limiter.acquire()
+        limiter.release()
+
+    assert time.monotonic() - start >= 0.25
+
+
+def test_rate_limiter_adapts_concurrency():
+    limiter = dxc.RateLimiter(max_concurrency=8)
+    limiter.acquire()
+    limiter.release(throttled=True)
+    assert limiter.concurrency_limit == 4
+
+    for _ in range(40):
+        limiter.acquire()
+        limiter.release()
+    assert limiter.concurrency_limit == 8
+
+
+class FakeQAPipeline:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, inputs, batch_size=None, **kwargs):
+        self.calls.append(([i["context"] for i in inputs], batch_size))
+        return [{"score": 0.9, "answer": i["question"] + i["context"]} for i in inputs]
+
+
+def test_transformers_qa_batches_across_requests_by_length():
+    model = dxc.TransformersQAModel.__new__(dxc.TransformersQAModel)
+    model.pipeline = FakeQAPipeline()
+    model.batch_size = 4
+    model.max_seq_len, model.max_question_len, model.stride = 384, 64, 0
+
+    results = model.batch_complete_many(
+        [
+            {"query": "a", "context": ["xxx", "x"]},
+            {"query": "b", "context": ["xx"]},
+        ]
+    )
+
+    assert model.pipeline.calls == [(["x", "xx", "xxx"], 4)]
+    assert [[r["answer"] for r in request] for request in results] == [
+        ["axxx", "ax"],
+        ["bxx"],
+    ]
+
+
+class FakeNLITokenizer:
+    model_max_length = 32
+    model_input_names = ["input_ids", "attention_mask"]
+
+    def __init__(self):
+        self.vocab = {}
+        self.calls = []
+
+    def __call__(self, texts, add_special_tokens=False):
+        self.calls.append(list(texts))
+        return {
+            "input_ids": [
+                [self.vocab.setdefault(w, len(self.vocab) + 10) for w in t.lower().split()]
+                for t in texts
+            ]
+        }
+
+    def num_special_tokens_to_add(self, pair=False):
+        return 3
+
+    def build_inputs_with_special_tokens(self, a, b):
+        return [0] + a + [2] + b + [2]
+
+    def pad(self, pairs, return_tensors="pt"):
+        length = max(len(p["input_ids"]) for p in pairs)
+        return {
+            "input_ids": torch.tensor(
+                [p["input_ids"] + [1] * (length - len(p["input_ids"])) for p in pairs]
+            ),
+            "attention_mask": torch.tensor(
+                [[1] * len(p["input_ids"]) + [0] * (length - len(p["input_ids"])) for p in pairs]
+            ),
+        }
+
+
+class FakeNLIModel:
+    device = "cpu"
+
+    def __call__(self, input_ids, attention_mask):
+        # Entailment logit: number of hypothesis tokens which also appear in the premise.
+        logits = []
+        for row in input_ids.tolist():
+            sep = row.index(2)
+            premise, hypothesis = set(row[1:sep]), row[sep + 1 :]
+            entail = sum(1.0 for t in hypothesis if t in premise and t > 2)
+            logits.append([0.0, 0.0, entail])
+        return SimpleNamespace(logits=torch.tensor(logits))
+
+
+def test_transformer_classifier_scores_all_pairs_and_caches_hypotheses():
+    model = dxc.TransformerClassifierModel.__new__(dxc.TransformerClassifierModel)
+    tokenizer = FakeNLITokenizer()
+    model.classifier = SimpleNamespace(
+        tokenizer=tokenizer, model=FakeNLIModel(), entailment_id=2
+    )
+    model.hypothesis_template = "{}"
+    model.batch_size = 3
+    model.max_hypothesis_len = 8
+    model._hypothesis_ids = {}
+    model._hypothesis_lock = threading.Lock()
+
+    # Chunks leave room for the hypothesis and special tokens, so premises are never truncated.
+    assert model.default_chunker().max_tokens == 32 - 8 - 3 - 2
+    assert pickle.loads(pickle.dumps(model)).batch_size == 3
+
+    categories = ["lease", "employment"]
+    results = model.batch_complete_with_scores(
+        categories, ["this lease agreement", "an employment contract", "lease"]
+    )
+    model.batch_complete_with_scores(categories, ["another lease"])
+
+    assert [r["answer"] for r in results] == ["lease", "employment", "lease"]
+    assert all(0.5 < r["score"] <= 1 for r in results)
+    # Hypotheses are tokenized once, chunks once per document.
+    assert tokenizer.calls.count(["lease", "employment"]) == 1
+
+    # A single category is scored by entailment against contradiction, not always 1.
+    single = model.batch_complete_with_scores(["lease"], ["this lease agreement", "a salary"])
+    assert [r["answer"] for r in single] == ["lease", "lease"]
+    assert single[0]["score"] == pytest.approx(torch.sigmoid(torch.tensor(1.0)).item())
+    assert single[1]["score"] == pytest.approx(0.5)
+
+
+def test_anthropic_prompt_caching_puts_chunk_first_and_counts_cache_tokens():
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(
+            200,
+            json={
+                "id": "msg_1",
+                "type": "message",
+                "role": "assistant",
+                "model": "claude-3-haiku-20240307",
+                "content": [{"type": "text", "text": "lease"}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {
+                    "input_tokens": 10,
+                    "output_tokens": 2,
+                    "cache_creation_input_tokens": 0,
+                    "cache_read_input_tokens": 3000,
+                },
+            },
+        )
+
+    model = dxc.AnthropicAPIModel(prompt_caching=True)
+    model.client = anthropic.Anthropic(
+        api_key="key", http_client=httpx.Client(transport=httpx.MockTransport(handler))
+    )
+    for query in ["What type?", "Who are the parties?"]:
+        assert model.complete(query, "chunk", "task", system_prompt="extractor") == "lease"
+
+    bodies = [json.loads(r.content) for r in requests]
+    assert bodies[0]["system"] == bodies[1]["system"]
+    assert bodies[0]["messages"][0]["content"][0] == bodies[1]["messages"][0]["content"][0]
+    assert bodies[0]["messages"][0]["content"][0]["cache_control"] == {"type": "ephemeral"}
+    assert bodies[1]["messages"][0]["content"][1]["text"] == "extractor\nWho are the parties?\ntask"
+    assert requests[0].headers["anthropic-beta"] == "prompt-caching-2024-07-31"
+    assert model.usage() == {
+        "input_tokens": 20,
+        "output_tokens": 4,
+        "cache_creation_input_tokens": 0,
+        "cache_read_input_tokens": 6000,
+    }
+
+
+class ConfidentModel(dxc.MockModelWithScores):
+    """Sure about chunks containing "sure", answers "NA" on chunks containing "none"."""
+
+    def batch_complete_with_scores(self, query, context, task_description=None, system_prompt=None):
+        return [
+            {"score": 0.9 if "sure" in c else 0.1, "answer": "NA" if "none" in c else c}
+            for c in context
+        ]
+
+
+def test_cascade_escalates_unsure_chunks(counting_model):
+    expensive = counting_model
+    model = dxc.CascadeModel([ConfidentModel(), expensive], threshold=0.5)
+    extractor = dxc.TextExtractor(name="party", query="q", model=model, max_chunk_size=10)
+
+    assert model.model_description() == {"type": "text", "scores": False}
+    assert model.batch_complete("q", ["sure a", "maybe b", "sure none"]) == ["sure a", "maybe b", "sure none"]
+    assert expensive.contexts == [["maybe b", "sure none"]]
+
+    profiler = dxc.ProfileAggregator()
+    with dxc.tracing.use_tracer(profiler):
+        extractor.extract("sure a\nmaybe b")
+    assert profiler.rows()["party"]["escalations"] == 1
+    assert asyncio.run(model.abatch_complete("q", ["maybe c"])) == ["maybe c"]
+
+    # Extractors sharing a query are counted apart, direct calls under None.
+    dxc.TextExtractor(name="same_query", query="q", model=model).extract("sure b")
+    stats = model.stats()
+    assert stats["party"] == {"chunks": 2, "answered_by": [1, 1], "escalation_rate": 0.5}
+    assert stats["same_query"] == {"chunks": 1, "answered_by": [1, 0], "escalation_rate": 0.0}
+    assert stats[None]["answered_by"] == [1, 3]
+    assert stats[None]["escalation_rate"] == pytest.approx(3 / 4)
+
+
+def test_cascade_escalates_whole_documents(counting_model):
+    expensive = counting_model
+    model = dxc.CascadeModel([ConfidentModel(), expensive], escalate="document")
+
+    assert model.batch_complete("q", ["sure a", "maybe b"]) == ["sure a", "NA"]
+    assert expensive.contexts == []
+    assert model.batch_complete("q", ["maybe a", "maybe b"]) == ["maybe a", "maybe b"]
+    assert expensive.contexts == [["maybe a", "maybe b"]]
+
+    with pytest.raises(ValueError):
+        dxc.CascadeModel([ConfidentModel(), expensive], threshold=[0.5, 0.5])
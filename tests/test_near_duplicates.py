@@ -0,0 +1,107 @@
+import hashlib
+import random
+import re
+
+import numpy as np
+
+import doxstractor as dxc
+
+
+WORDS = "the tenant shall pay landlord rent premises term agreement clause notice party".split()
+
+
+def templated_docs(n):
+    rng = random.Random(0)
+    template = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 60))) for _ in range(100)]
+    for i in range(n):
+        parts = list(template)
+        parts[3] = f"this lease is made between alice {i} and bob {i}"
+        # Insertions of varying length shift all fixed size chunks after them.
+        parts.insert(10, "additional clause " * i)
+        yield " ".join(parts)
+
+
+def test_minhash_index_finds_near_duplicates_only():
+    index = dxc.MinHashIndex()
+    first, second = templated_docs(2)
+    assert index.match_or_add(first, payload="first") is None
+    ref_id, payload = index.match_or_add(second)
+    assert payload == "first" and index.reference(ref_id) == "first"
+    assert index.query(" ".join(reversed(WORDS * 20))) is None
+    assert len(index) == 1
+
+
+def test_template_chunker_only_sends_changed_chunks():
+    sent = {}
+    for name, chunker in [
+        ("template", dxc.TemplateChunker(dxc.Chunker(max_chunk_size=500))),
+        ("plain", dxc.Chunker(max_chunk_size=500)),
+    ]:
+        model = dxc.CachedModel(dxc.MockModel(), cache=dxc.MemoryCache(maxsize=None))
+        extractor = dxc.TextExtractor(name="text", query="q", model=model, chunker=chunker)
+        for doc in templated_docs(10):
+            chunks = chunker.chunk(doc)
+            assert all(doc[c.start : c.end] == c.text for c in chunks)
+            extractor.extract(doc)
+        sent[name] = model.stats()["misses"]
+
+    assert sent["template"] * 3 < sent["plain"]
+
+
+def test_minhash_signature_matches_unblocked_minimum():
+    index = dxc.MinHashIndex()
+    rng = random.Random(0)
+    doc = " ".join(rng.choice(WORDS) for _ in range(3_000))
+    words = re.findall(r"\w+", doc.lower())
+    hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+            for s in {" ".join(words[i : i + 5]) for i in range(len(words) - 4)}
+        ],
+        dtype=np.int64,
+    )
+    expected = ((np.outer(index._a, hashes) + index._b[:, None]) % ((1 << 31) - 1)).min(axis=1)
+
+    assert len(hashes) > 1_024
+    assert (index.signature(doc) == expected).all()
+
+
+def test_template_chunker_aligns_shifted_chunks():
+    chunker = dxc.TemplateChunker(dxc.Chunker(max_chunk_size=500))
+    first, second = templated_docs(2)
+    chunker.chunk(first)
+    edited = "new preamble " * 50 + second
+    chunks = chunker.chunk(edited)
+
+    assert all(edited[c.start : c.end] == c.text for c in chunks)
+    reused = {c.text for c in chunks} & {c.text for c in dxc.Chunker(max_chunk_size=500).split(first)}
+    assert len(reused) > len(chunks) // 2
+
+
+def test_minhash_index_drops_least_recently_matched_references():
+    index = dxc.MinHashIndex(max_references=2)
+    rngs = [random.Random(i) for i in range(3)]
+    docs = [" ".join(rng.choice(WORDS) for _ in range(200)) for rng in rngs]
+    index.add("a", docs[0], payload="a")
+    index.add("b", docs[1], payload="b")
+    assert index.match_or_add(docs[0])[1] == "a"
+    index.add("c", docs[2], payload="c")
+
+    assert len(index) == 2
+    assert index.query(docs[1]) is None
+    assert index.query(docs[0])[0] == "a"
+    bucketed = {ref_id for buckets in index._buckets for ids in buckets.values() for ref_id in ids}
+    assert bucketed == {"a", "c"}
+
+
+def test_template_chunker_wraps_token_chunker():
+    class WordTokenizer:
+        def __call__(self, text, return_offsets_mapping=False, add_special_tokens=False):
+            return {"offset_mapping": [m.span() for m in re.finditer(r"\S+", text)]}
+
+    chunker = dxc.TemplateChunker(dxc.TokenChunker(WordTokenizer(), max_tokens=50))
+    assert chunker.max_chunk_size is None
+    for doc in templated_docs(3):
+        chunks = chunker.chunk(doc)
+        assert all(doc[c.start : c.end] == c.text for c in chunks)
+    assert len(chunker.index) == 1
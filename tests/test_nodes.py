@@ -1,31 +1,13 @@
+import asyncio
+import json
+import time
+import pytest
 import doxstractor as dxc
+from doxstractor.extractors.fused import FusedExtractor, fusion_key
+from doxstractor.utils import thread_map
 
 
-def create_graph(model):
-    root_extractor = dxc.CategoryExtractor(
-        name="doc_type",
-        query="What type of document is this?",
-        categories=["lease", "employment"],
-        model=model,
-    )
-
-    lease_extractor = dxc.TextExtractor(
-        name="text_lease", query="What is the content?", model=model
-    )
-    employment_extractor = dxc.TextExtractor(
-        name="text_employment", query="What is the content?", model=model
-    )
-
-    children = {
-        "lease": [dxc.Node(lease_extractor)],
-        "employment": [dxc.Node(employment_extractor)],
-    }
-
-    root_node = dxc.Node(root_extractor, children=children)
-    return root_node
-
-
-def test_graph_creation():
+def test_graph_creation(create_graph):
     lease_doc = "lease"
     employment_doc = "employment"
     model = dxc.MockModel()
@@ -45,7 +27,7 @@ def test_graph_creation():
     assert employment_result == expected_employment_result
 
 
-def test_graph_creation_with_scores():
+def test_graph_creation_with_scores(create_graph):
     lease_doc = "lease"
     employment_doc = "employment"
     model = dxc.MockModelWithScores()
@@ -63,3 +45,348 @@ def test_graph_creation_with_scores():
 
     assert lease_result == expected_lease_result
     assert employment_result == expected_employment_result
+
+
+def test_graph_aextract(create_graph):
+    root_node = create_graph(dxc.MockModel())
+
+    async def extract_all():
+        return await asyncio.gather(
+            root_node.aextract("lease"), root_node.aextract("employment")
+        )
+
+    results = asyncio.run(extract_all())
+
+    assert results == [
+        {"doc_type": "lease", "text_lease": "lease"},
+        {"doc_type": "employment", "text_employment": "employment"},
+    ]
+
+
+def test_parallel_children_merge_in_order():
+    model = dxc.MockModel()
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type",
+        query="What type of document is this?",
+        categories=["lease", "employment"],
+        model=model,
+    )
+    children = {
+        "lease": [
+            dxc.Node(dxc.TextExtractor(name=f"text_{i}", query="q", model=model))
+            for i in range(6)
+        ]
+    }
+    root_node = dxc.Node(root_extractor, children=children, max_workers=3)
+
+    result = root_node.extract("lease")
+
+    assert list(result.keys()) == ["doc_type"] + [f"text_{i}" for i in range(6)]
+    assert all(value == "lease" for value in result.values())
+
+
+def test_thread_map_runs_every_item_before_raising():
+    for max_workers in [1, 3]:
+        seen = []
+
+        def fn(item):
+            seen.append(item)
+            if item in (1, 2):
+                raise ValueError(item)
+            return item
+
+        with pytest.raises(ValueError, match="1"):
+            thread_map(fn, range(4), max_workers=max_workers)
+        assert sorted(seen) == [0, 1, 2, 3]
+
+
+class FailingModel(dxc.MockModel):
+    def complete(self, query, context, task_description=None, system_prompt=None):
+        if "broken" in context:
+            raise RuntimeError("model failure")
+        return super().complete(query, context, task_description, system_prompt)
+
+
+def test_extract_many_reports_failures_and_keeps_order(create_graph):
+    root_node = create_graph(FailingModel())
+    docs = iter(["lease", "broken", "employment"] * 5)
+
+    results = list(root_node.extract_many(docs, max_workers=3, max_pending=4))
+
+    assert [r.index for r in results] == list(range(15))
+    assert results[0].result == {"doc_type": "lease", "text_lease": "lease"}
+    assert isinstance(results[1].error, RuntimeError)
+    assert results[1].result is None
+    assert results[2].result == {
+        "doc_type": "employment",
+        "text_employment": "employment",
+    }
+
+
+def test_extract_many_process_backend(create_graph):
+    root_node = create_graph(dxc.MockModel())
+
+    results = root_node.extract_many(
+        ["lease", "employment"], max_workers=2, backend="process", ordered=False
+    )
+
+    assert sorted(r.result["doc_type"] for r in results) == ["employment", "lease"]
+
+
+class JSONModel(dxc.MockModel):
+    """Answers fused prompts with a JSON object, everything else like `MockModel`."""
+
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    def complete(self, query, context, task_description=None, system_prompt=None):
+        self.queries.append(query)
+        if query.startswith("Answer the questions below"):
+            return json.dumps(
+                {"salary": "Salary is 100,000", "title": "CEO", "kind": "employment"}
+            )
+        return super().complete(query, context, task_description, system_prompt)
+
+
+def test_fused_siblings_share_one_call_per_chunk():
+    model = JSONModel()
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type", query="Type?", categories=["employment"], model=model
+    )
+    kind_extractor = dxc.CategoryExtractor(
+        name="kind", query="Kind?", categories=["employment", "other"], model=model
+    )
+    children = {
+        "employment": [
+            dxc.Node(dxc.NumericExtractor(name="salary", query="Salary?", model=model)),
+            dxc.Node(dxc.TextExtractor(name="title", query="Title?", model=model)),
+            dxc.Node(
+                kind_extractor,
+                children={
+                    "employment": [
+                        dxc.Node(dxc.TextExtractor(name="nested", query="?", model=model))
+                    ]
+                },
+            ),
+        ]
+    }
+    root_node = dxc.Node(root_extractor, children=children, fuse_queries=True)
+
+    result = root_node.extract("employment")
+
+    assert result == {
+        "doc_type": "employment",
+        "salary": "100,000",
+        "title": "CEO",
+        "kind": "employment",
+        "nested": "employment",
+    }
+    # Root, fused siblings and nested child
+    assert len(model.queries) == 3
+
+
+def test_fusion_skips_early_stopping_speculation_and_maps_null_to_na():
+    model = JSONModel()
+    assert fusion_key(dxc.TextExtractor(name="waves", query="?", model=model, early_stopping=True)) is None
+
+    fused = FusedExtractor(
+        [
+            dxc.TextExtractor(name="salary", query="Salary?", model=model),
+            dxc.TextExtractor(name="title", query="Title?", model=model),
+        ]
+    )
+    assert fused._split_answer('{"salary": null, "title": "CEO"}') == {"salary": "NA", "title": "CEO"}
+
+    kind_extractor = dxc.CategoryExtractor(
+        name="kind", query="Kind?", categories=["employment", "other"], model=model
+    )
+    nested = dxc.Node(dxc.TextExtractor(name="nested", query="?", model=model))
+    speculating = dxc.Node(kind_extractor, children={"employment": [nested]}, speculate="frequency")
+    root_node = dxc.Node(
+        dxc.CategoryExtractor(name="doc_type", query="Type?", categories=["employment"], model=model),
+        children={
+            "employment": [
+                dxc.Node(dxc.TextExtractor(name="title", query="Title?", model=model)),
+                speculating,
+            ]
+        },
+        fuse_queries=True,
+    )
+    groups = root_node._child_groups(root_node.children["employment"])
+    assert groups[1] is speculating
+
+
+class CrossBatchingModel(dxc.MockModelWithScores):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def model_description(self):
+        return {"type": "text", "scores": True, "cross_batching": True}
+
+    def batch_complete_many(self, requests):
+        self.calls.append([r["query"] for r in requests])
+        return super().batch_complete_many(requests)
+
+
+def test_batched_siblings_share_one_model_call():
+    model = CrossBatchingModel()
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type", query="Type?", categories=["lease"], model=model
+    )
+    children = {
+        "lease": [
+            dxc.Node(dxc.TextExtractor(name=f"text_{i}", query=f"q{i}", model=model))
+            for i in range(3)
+        ]
+    }
+    root_node = dxc.Node(root_extractor, children=children, batch_queries=True)
+
+    result = root_node.extract("lease")
+
+    assert result == {"doc_type": "lease", "text_0": "lease", "text_1": "lease", "text_2": "lease"}
+    assert model.calls == [["q0", "q1", "q2"]]
+
+
+def create_speculative_graph(model, speculate, **kwargs):
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type",
+        query="What type of document is this?",
+        categories=["lease", "employment"],
+        model=model,
+        max_chunk_size=10,
+    )
+    children = {
+        "lease": [dxc.Node(dxc.TextExtractor(name="text_lease", query="q", model=model))],
+        "employment": [
+            dxc.Node(dxc.TextExtractor(name="text_employment", query="q", model=model))
+        ],
+    }
+    return dxc.Node(root_extractor, children=children, speculate=speculate, **kwargs)
+
+
+class DelayModel(dxc.MockModel):
+    """Logs the start and end of every call and sleeps delays[query] seconds in between."""
+
+    def __init__(self, delays=None):
+        super().__init__()
+        self.delays = delays or {}
+        self.log = []
+        self.cancelled = []
+
+    def batch_complete(self, query, context, task_description=None, system_prompt=None):
+        self.log.append(("start", query))
+        time.sleep(self.delays.get(query, 0))
+        self.log.append(("end", query))
+        return [c.replace("\n", "") for c in context]
+
+    async def abatch_complete(self, query, context, task_description=None, system_prompt=None):
+        self.log.append(("start", query))
+        try:
+            await asyncio.sleep(self.delays.get(query, 0))
+        except asyncio.CancelledError:
+            self.cancelled.append(query)
+            raise
+        self.log.append(("end", query))
+        return [c.replace("\n", "") for c in context]
+
+
+def test_speculation_by_frequency_overlaps_parent_and_children():
+    model = DelayModel({"What type of document is this?": 0.2})
+    root_node = create_speculative_graph(model, "frequency")
+
+    assert root_node.extract("lease") == {"doc_type": "lease", "text_lease": "lease"}
+    assert root_node.speculation_stats["started"] == 0
+
+    model.log.clear()
+    assert root_node.extract("lease") == {"doc_type": "lease", "text_lease": "lease"}
+    # The child started while the classifier was still running.
+    assert model.log.index(("start", "q")) < model.log.index(("end", "What type of document is this?"))
+    assert root_node.speculation_stats == {"started": 1, "hits": 1, "discarded": 0}
+
+    assert root_node.extract("employment") == {
+        "doc_type": "employment",
+        "text_employment": "employment",
+    }
+    assert root_node.speculation_stats == {"started": 2, "hits": 1, "discarded": 1}
+    assert root_node.category_counts == {"lease": 2, "employment": 1}
+
+
+def test_speculation_on_first_chunk():
+    root_node = create_speculative_graph(dxc.MockModel(), "first_chunk")
+
+    assert root_node.extract("lease\nlease\nemployment") == {
+        "doc_type": "lease",
+        "text_lease": "leaseleaseemployment",
+    }
+    assert root_node.speculation_stats == {"started": 1, "hits": 1, "discarded": 0}
+
+    assert asyncio.run(root_node.aextract("employment\nlease\nlease")) == {
+        "doc_type": "lease",
+        "text_lease": "employmentleaselease",
+    }
+    assert root_node.speculation_stats == {"started": 2, "hits": 1, "discarded": 1}
+
+
+def create_nested_speculative_graph(model, speculate_sub=None):
+    deep = dxc.Node(dxc.TextExtractor(name="deep", query="deep", model=model))
+    sub_extractor = dxc.CategoryExtractor(
+        name="sub_type", query="sub", categories=["lease", "employment"], model=model
+    )
+    sub = dxc.Node(sub_extractor, children={"employment": [deep]}, speculate=speculate_sub)
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type", query="root", categories=["lease", "employment"], model=model
+    )
+    children = {
+        "lease": [sub],
+        "employment": [dxc.Node(dxc.TextExtractor(name="text_employment", query="q", model=model))],
+    }
+    return dxc.Node(root_extractor, children=children, speculate="frequency"), sub
+
+
+def test_losing_branch_stops_before_next_extractor():
+    model = DelayModel({"root": 0.1, "sub": 0.3})
+    root_node, _ = create_nested_speculative_graph(model)
+    root_node.extract("lease")
+
+    model.log.clear()
+    assert root_node.extract("employment") == {
+        "doc_type": "employment",
+        "text_employment": "employment",
+    }
+    # The speculated sub_type call was already running, its employment child never starts.
+    assert ("start", "sub") in model.log
+    assert ("start", "deep") not in model.log
+
+
+def test_losing_async_branch_is_cancelled():
+    model = DelayModel({"root": 0.1, "sub": 0.3})
+    root_node, _ = create_nested_speculative_graph(model)
+    asyncio.run(root_node.aextract("lease"))
+
+    model.log.clear()
+    assert asyncio.run(root_node.aextract("employment")) == {
+        "doc_type": "employment",
+        "text_employment": "employment",
+    }
+    assert model.cancelled == ["sub"]
+    assert ("start", "deep") not in model.log
+
+
+def test_losing_branch_records_no_stats():
+    root_node, sub = create_nested_speculative_graph(dxc.MockModel(), speculate_sub="frequency")
+    root_node.extract("lease")
+    assert sub.category_counts == {"lease": 1}
+
+    root_node.extract("employment")
+    assert sub.category_counts == {"lease": 1}
+    assert sub.speculation_stats["started"] == 0
+
+    root_node.extract("lease")
+    assert sub.category_counts == {"lease": 2}
+
+
+def test_speculate_validation():
+    with pytest.raises(ValueError):
+        create_speculative_graph(dxc.MockModel(), "always")
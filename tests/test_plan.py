@@ -0,0 +1,128 @@
+import pytest
+import doxstractor as dxc
+
+
+class CountingChunker(dxc.Chunker):
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def chunk(self, doc_text):
+        self.calls += 1
+        return super().chunk(doc_text)
+
+
+def test_plan_merges_identical_tasks(create_graph):
+    plan = create_graph(dxc.MockModel()).compile()
+
+    assert len(plan.model_tasks()) == 2
+    assert [task.kind for task in plan.tasks.values()].count(dxc.tracing.CHUNKING) == 1
+    shared = [task for task in plan.model_tasks() if len(task.users) > 1]
+    assert [task.users for task in shared] == [["text_lease", "text_employment"]]
+    assert "doc_type=lease | doc_type=employment" in plan.describe()
+
+
+def test_plan_cost(create_graph):
+    plan = create_graph(dxc.MockModel()).compile()
+
+    assert plan.cost() == {"model_calls": (1, 2)}
+    assert plan.cost("lease\nrent\nparties") == {"model_calls": (1, 2), "chunks": (1, 2)}
+
+
+def test_plan_cost_counts_na_answers(counting_model):
+    model = counting_model
+    root_extractor = dxc.CategoryExtractor(name="t", query="What type?", categories=["lease"], model=model)
+    rent = dxc.TextExtractor(name="rent", query="What is the rent?", model=model)
+    node = dxc.Node(root_extractor, children={"lease": [dxc.Node(rent)]})
+
+    assert node.compile().cost() == {"model_calls": (1, 2)}
+    assert node.extract("unknown") == {"t": "NA"}
+    assert len(model.calls) == 1
+
+
+def test_plan_cost_leaves_template_chunker_unchanged(create_graph):
+    chunker = dxc.TemplateChunker(dxc.Chunker(max_chunk_size=10))
+    plan = create_graph(dxc.MockModel(), chunker=chunker).compile()
+
+    assert plan.cost("lease\nrent\nparties")["chunks"] == (2, 4)
+    assert len(chunker.index) == 0
+
+
+def test_plan_execute_matches_extract(counting_model, create_graph):
+    model = counting_model
+    node = create_graph(model)
+    plan = node.compile()
+
+    for doc_text in ["lease", "employment", "other", "unknown"]:
+        assert plan.execute(doc_text) == node.extract(doc_text)
+
+    model.calls.clear()
+    result = plan.execute("lease")
+    assert list(result) == ["doc_type", "text_lease"]
+    assert len(model.calls) == 2
+
+
+def test_plan_execute_runs_shared_task_once(counting_model):
+    model = counting_model
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type", query="What type?", categories=["lease"], model=model
+    )
+    text_extractor = dxc.TextExtractor(name="type_text", query="What type?", model=model)
+    node = dxc.Node(root_extractor, children={"lease": [dxc.Node(text_extractor)]})
+    plan = node.compile()
+
+    # Different extractor types send different prompts, so nothing is merged here.
+    assert len(plan.model_tasks()) == 2
+
+    same_query = dxc.TextExtractor(name="again", query="What is the rent?", model=model)
+    other = dxc.TextExtractor(name="rent", query="What is the rent?", model=model)
+    node = dxc.Node(
+        root_extractor, children={"lease": [dxc.Node(other), dxc.Node(same_query)]}
+    )
+    model.calls.clear()
+    assert node.compile().execute("lease") == {
+        "doc_type": "lease",
+        "rent": "lease",
+        "again": "lease",
+    }
+    assert model.queries.count("What is the rent?") == 1
+
+
+def test_plan_execute_passes_chunks_to_model_tasks(create_graph):
+    chunker = CountingChunker()
+    plan = create_graph(dxc.MockModel(), chunker=chunker).compile()
+
+    assert plan.execute("lease")["text_lease"] == "lease"
+    assert chunker.calls == 1
+
+
+def test_plan_execute_runs_tasks_concurrently(counting_model):
+    model = counting_model
+    model.delay = 0.1
+    root_extractor = dxc.CategoryExtractor(
+        name="doc_type", query="What type?", categories=["lease"], model=model
+    )
+    children = [
+        dxc.Node(dxc.TextExtractor(name=f"text_{i}", query=f"q{i}", model=model))
+        for i in range(3)
+    ]
+    plan = dxc.Node(root_extractor, children={"lease": children}).compile()
+
+    assert plan.execute("lease", max_workers=4)["text_2"] == "lease"
+    assert model.peak == 3
+    model.peak = 0
+    assert plan.execute("lease", max_workers=1)["text_2"] == "lease"
+    assert model.peak == 1
+
+
+def test_plan_execute_raises_task_errors(create_graph):
+    class FailingModel(dxc.MockModel):
+        def batch_complete(self, query, context, task_description=None, system_prompt=None):
+            if query == "What is the content?" and context == ["lease"]:
+                raise RuntimeError("boom")
+            return super().batch_complete(query, context, task_description, system_prompt)
+
+    plan = create_graph(FailingModel()).compile()
+    assert plan.execute("employment")["text_employment"] == "employment"
+    with pytest.raises(RuntimeError, match="boom"):
+        plan.execute("lease")
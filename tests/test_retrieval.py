@@ -0,0 +1,43 @@
+import doxstractor as dxc
+
+
+class RecordingModel(dxc.MockModel):
+    def __init__(self):
+        super().__init__()
+        self.contexts = []
+
+    def batch_complete(self, query, context, task_description=None, system_prompt=None):
+        self.contexts.append(list(context))
+        return super().batch_complete(query, context, task_description, system_prompt)
+
+
+def test_retriever_sends_only_relevant_chunks():
+    lines = [f"Clause {i}: the tenant shall keep the premises clean." for i in range(50)]
+    lines[31] = "The employee base salary is 575,000 dollars per year."
+    doc = "\n".join(lines)
+    model = RecordingModel()
+    extractor = dxc.NumericExtractor(
+        name="salary",
+        query="What is the base salary?",
+        model=model,
+        max_chunk_size=60,
+        retriever=dxc.BM25Retriever(top_k=1),
+    )
+
+    assert extractor.extract(doc) == "575,000"
+    assert model.contexts == [[lines[31]]]
+
+
+def test_retriever_falls_back_to_full_scan():
+    doc = "alpha\nbeta\ngamma"
+    model = RecordingModel()
+    extractor = dxc.TextExtractor(
+        name="text",
+        query="What is the salary?",
+        model=model,
+        max_chunk_size=6,
+        retriever=dxc.BM25Retriever(top_k=1),
+    )
+    extractor.extract(doc)
+
+    assert model.contexts == [["alpha", "beta", "gamma"]]
@@ -0,0 +1,33 @@
+import json
+import subprocess
+import sys
+
+
+BACKENDS = ["anthropic", "httpx", "requests", "tokenizers", "torch", "transformers"]
+
+LOADED_BACKENDS = f"""
+import json, sys
+import doxstractor as dxc
+model = dxc.MockModel()
+print(json.dumps([m for m in {BACKENDS!r} if m in sys.modules]))
+"""
+
+
+def test_core_import_skips_backends():
+    output = subprocess.run(
+        [sys.executable, "-c", LOADED_BACKENDS],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+
+    # Loading the backends takes seconds and hundreds of MB, the core package gets by without them.
+    assert json.loads(output) == []
+
+
+def test_backends_load_on_first_access():
+    code = "import sys, doxstractor as dxc; dxc.AnthropicAPIModel; print('anthropic' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "True"
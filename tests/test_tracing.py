@@ -0,0 +1,42 @@
+import doxstractor as dxc
+from doxstractor import tracing
+
+
+def test_profile_aggregator_attributes_calls_to_nodes(create_graph):
+    model = dxc.CachedModel(dxc.MockModel(model="mock"))
+    node = create_graph(model, max_chunk_size=5)
+    profiler = dxc.ProfileAggregator()
+
+    with tracing.use_tracer(profiler):
+        for _ in range(2):
+            assert node.extract("lease\nterms")["doc_type"] == "lease"
+    rows = profiler.rows()
+
+    assert set(rows) == {"doc_type", "text_lease"}
+    for row in rows.values():
+        assert row["runs"] == 2
+        assert row["model_calls"] == 2
+        assert row["chunks"] == 4
+        assert row["response_chars"] == 20
+        assert row["extract_s"] >= row["model_s"]
+    # The second document is answered from the cache, the child shares chunks with the root.
+    assert rows["doc_type"]["cache_hits"] == 2
+    assert rows["text_lease"]["cache_hits"] == 2
+    assert profiler.table().splitlines()[0].split()[:3] == ["node", "runs", "extract_s"]
+
+
+def test_no_tracer_is_a_no_op():
+    assert tracing.get_tracer() is None
+    with tracing.span(tracing.NODE, "name") as span:
+        span.set(chunks=1)
+        tracing.add(retries=1)
+    assert not isinstance(span, tracing.Span)
+
+
+def test_no_tracer_skips_measurements(monkeypatch, create_graph):
+    def fail(*args):
+        raise AssertionError("measured without a tracer")
+
+    monkeypatch.setattr(tracing, "prompt_chars", fail)
+    monkeypatch.setattr(tracing, "response_chars", fail)
+    assert create_graph(dxc.MockModel()).extract("lease")["doc_type"] == "lease"